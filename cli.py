@@ -45,7 +45,6 @@ import random
 
 from npz_trajectory import NpzTrajectory
 
-from ego_trajectory_encoder import EgoTrajectoryEncoder
 
 # from llama_test import get_llama_embeddingK
 
@@ -110,12 +109,39 @@ from learning.trajectory_classifier import train_classifier
 
 from scenario import Scenario
 
+from trag_retriever import TRAGRetriever
+
+from mutable_embedding_store import MutableEmbeddingStore
+
+from scenario_behaviour_index import ScenarioBehaviourIndex
+
+from kinematic_attributes import KinematicAttributeIndex
+
+from trajectory_similarity import (
+    DISTANCES,
+    TrajectorySimilaritySearch,
+    create_trajectory_coordinate_store,
+    gt_marginal_for_file,
+)
+from trajectory_corpus_encoding import (
+    encode_coordinates,
+    encode_trajectory_corpus,
+    load_trajectory_encoder,
+)
+
+from retrieval_client import RetrievalClient
+
 
 class SimpleShell(cmd.Cmd):
     prompt = "(waymo_cli) "
     loaded_scenario = None
     loaded_trajectory = None
     loaded_npz_trajectory = None
+    retriever = None
+    behaviour_index = None
+    kinematic_index = None
+    similarity_search = None
+    vehicle_files = None
 
     with open("config.yml", "r") as file:
         config = yaml.safe_load(file)
@@ -351,6 +377,50 @@ class SimpleShell(cmd.Cmd):
             return
         self.loaded_npz_trajectory.animate_scenario_past()
 
+    def do_find_similar_trajectories(self, arg: str):
+        """Finds the trajectories whose future is shaped most like the one of
+        the loaded NPZ trajectory, or of the loaded trajectory if no NPZ
+        trajectory is loaded.
+
+        Args:
+            arg (str): Distance to use, "euclidean" (default), "dtw" or "frechet".
+        """
+        example = self.loaded_npz_trajectory
+        if example is None:
+            example = self.loaded_trajectory
+        if example is None:
+            print(
+                "No trajectory has been loaded yet. Please load a trajectory before calling this command."
+            )
+            return
+        distance = arg.strip() or "euclidean"
+        if distance not in DISTANCES:
+            print(f"\nUnknown distance: {distance}. Choose one of {DISTANCES}.\n")
+            return
+
+        if self.similarity_search is None:
+            self.similarity_search = TrajectorySimilaritySearch.from_files()
+
+        distances, indices, stats = self.similarity_search.search(
+            example, k=10, distance=distance
+        )
+        print("\n")
+        for value, index in zip(distances, indices):
+            print(f"{float(value):.2f}: {self.vehicle_file_name(index)}")
+        print(
+            f"Exact distances computed for {int(stats['exact'])} "
+            f"of {int(stats['candidates'])} trajectories"
+        )
+        print("\n")
+
+    def vehicle_file_name(self, index: int) -> str:
+        """File name of a row of the stores built from the vehicle_a files,
+        e.g. the trajectory coordinates or the kinematic attribute table.
+        """
+        if self.vehicle_files is None:
+            self.vehicle_files = list_vehicle_files_absolute()
+        return self.vehicle_files[int(index)].split("/")[-1]
+
     def do_create_intra_distribution_for(self, arg: str):
         with open("config.yml") as config:
             config = yaml.safe_load(config)
@@ -430,34 +500,78 @@ class SimpleShell(cmd.Cmd):
             file.write("}")
 
     def do_create_trajectory_encoder_labeled_npz_dataset(self, arg: str):
-        torch.set_printoptions(profile="full")
-        model = EgoTrajectoryEncoder()
-        model.load_state_dict(
-            torch.load(
-                "/home/pmueller/llama_traffic/models/trajectory_encoder_wv_cos.pth"
+        """Encodes all trajectories of the coordinate store with the trajectory
+        encoder into datasets/encoder_output_a_cos.npy. An interrupted run
+        continues from its last checkpoint.
+        Optional argument: "float16" to store half precision rows.
+        """
+        dtype = arg.strip() or "float32"
+        if not os.path.exists("datasets/trajectory_coordinates.npy"):
+            print("Creating trajectory coordinate store...")
+            create_trajectory_coordinate_store()
+        model_path = "/home/pmueller/llama_traffic/models/trajectory_encoder_wv_cos.pth"
+        model = load_trajectory_encoder(model_path)
+        encode_trajectory_corpus(model, dtype=dtype, model_path=model_path)
+
+    def do_update_trajectory_embedding_index(self, arg: str):
+        """Updates the trajectory embedding index to the current npz dataset.
+        Only trajectories that are not indexed yet are encoded and appended,
+        removed trajectories are tombstoned and the index is compacted once
+        too many rows are dead. Running retrievers pick up the new generation
+        without a restart.
+        """
+        with open("config.yml") as config:
+            config = yaml.safe_load(config)
+            data_directory = config["npz_dataset"]
+        index_directory = "datasets/trajectory_embedding_index"
+
+        paths = {
+            path.split("/")[-1]: path
+            for path in list_vehicle_files_absolute(data_directory)
+        }
+        # The index is seeded and extended with the same encoder, otherwise
+        # old and new rows would live in different embedding spaces
+        model_path = "/home/pmueller/llama_traffic/models/trajectory_encoder_wv_cos.pth"
+        model = load_trajectory_encoder(model_path)
+        if not os.path.exists(
+            os.path.join(index_directory, MutableEmbeddingStore.MANIFEST_FILE)
+        ):
+            print("Creating trajectory embedding index...")
+            if not os.path.exists("datasets/trajectory_coordinates.npy"):
+                create_trajectory_coordinate_store()
+            # Finishes or resumes the encoding, a finished output is kept
+            encode_trajectory_corpus(model, model_path=model_path)
+            # The encoder output follows the order of the vehicle_a files
+            store = MutableEmbeddingStore.create(
+                index_directory,
+                "datasets/encoder_output_a_cos.npy",
+                [path.split("/")[-1] for path in list_vehicle_files_absolute()],
             )
-        )
-        model.eval()
-        model.to("cuda")
-        with torch.no_grad():
-            with open("datasets/direction_labeled_npz_vehicle_a.json") as file:
-                data_json = json.load(file)
-                keys = list(data_json.keys())
-                # coordinates = torch.Tensor(item["Coordinates"] for item in list(data_json.values()))
-                with open("datasets/encoder_output_vehicle_a_cos.json", "a") as output:
-                    output.write("{")
-                    for i in tqdm(range(len(keys))):
-                        key = keys[i]
-                        coordinates = torch.Tensor(data_json[key]["Coordinates"]).to(
-                            "cuda"
-                        )
-
-                        encoder_output = model(coordinates.unsqueeze(0)).squeeze()
-                        output.write(
-                            f'"{key.split("/")[-1]}" : {encoder_output.tolist()}'
-                            + ",\n"
-                        )
-                    output.write("}")
+            # Unreadable files were encoded from rows of zeros
+            if os.path.exists("datasets/trajectory_coordinates_valid.npy"):
+                valid = np.load("datasets/trajectory_coordinates_valid.npy")
+                store.delete(np.flatnonzero(~valid))
+            print("Finished")
+
+        unreadable = []
+
+        def encode(names):
+            # Unreadable files get a row of zeros and are tombstoned after
+            # the sync, so they are tried again on the next update
+            coordinates = np.zeros((len(names), 80, 2), dtype=np.float32)
+            for i, name in enumerate(tqdm(names)):
+                gt_marginal = gt_marginal_for_file(paths[name])
+                if gt_marginal is None:
+                    unreadable.append(name)
+                else:
+                    coordinates[i] = gt_marginal
+            return encode_coordinates(model, coordinates)
+
+        store = MutableEmbeddingStore(index_directory)
+        result = store.sync(list(paths), encode)
+        result["unreadable"] = store.delete(store.ids_for_names(unreadable))
+        result["compacted"] = store.compact_if_needed()
+        print(result)
 
     def do_plot_random_npz_trajectory(self, arg: str):
 
@@ -1028,6 +1142,141 @@ class SimpleShell(cmd.Cmd):
         print(*similarities.items(), sep="\n")
         print("\n")
 
+    def do_retrieve_trajectories(self, arg: str):
+        """Retrieves the trajectories that best match the given text input.
+        Uses the retrieval server if it is running (see retrieval_server.py),
+        otherwise the indices are loaded into this process first.
+
+        Args:
+            arg (str): The verbal description of the wanted trajectory.
+        """
+        self.retrieve_for_text_input(arg, mode="trajectory")
+
+    def do_retrieve_scenarios(self, arg: str):
+        """Retrieves the scenarios that best match the given text input.
+        Uses the retrieval server if it is running (see retrieval_server.py),
+        otherwise the indices are loaded into this process first.
+
+        Args:
+            arg (str): The verbal description of the wanted scenario.
+        """
+        self.retrieve_for_text_input(arg, mode="scenario")
+
+    def do_retrieve_scenes(self, arg: str):
+        """Retrieves the scenarios whose agents match the given counts, e.g.
+        "Left>=2 AND Stationary>=1" for two vehicles turning left while one
+        is stationary. Counts can be given for every direction bucket,
+        every scenario feature and "agents".
+
+        Args:
+            arg (str): Count conditions joined by AND.
+        """
+        if arg == "":
+            print(
+                (
+                    "\nYou have provided no count conditions."
+                    "\nPlease provide conditions like Left>=2 AND Stationary>=1.\n"
+                )
+            )
+            return
+
+        if self.behaviour_index is None:
+            print("Building scenario behaviour index...")
+            self.behaviour_index = ScenarioBehaviourIndex.from_files()
+            print("Finished")
+
+        try:
+            scenarios = self.behaviour_index.search_text(arg)
+        except ValueError as error:
+            print(f"\n{error}\n")
+            return
+
+        print("\n")
+        print(f"Number of matching scenarios: {len(scenarios)}")
+        for scenario in scenarios[:10]:
+            description = self.behaviour_index.describe(scenario)
+            print(f"{description['scenario']}: {description['counts']}")
+            print(*description["files"], sep="\n")
+        print("\n")
+
+    def do_filter_trajectories_by_kinematics(self, arg: str):
+        """Lists the trajectories matching kinematic conditions, e.g.
+        "max_decel>4 AND Left" for hard braking while turning left.
+        Conditions can be given for mean_speed, max_speed, max_decel,
+        peak_yaw_rate, path_length and stop_duration, direction buckets
+        without an operator restrict the direction.
+
+        Args:
+            arg (str): Conditions joined by AND.
+        """
+        if arg == "":
+            print(
+                (
+                    "\nYou have provided no kinematic conditions."
+                    "\nPlease provide conditions like max_decel>4 AND Left.\n"
+                )
+            )
+            return
+
+        if self.kinematic_index is None:
+            print("Loading kinematic attribute index...")
+            self.kinematic_index = KinematicAttributeIndex.from_files()
+            print("Finished")
+
+        try:
+            indices = self.kinematic_index.search_text(arg)
+        except ValueError as error:
+            print(f"\n{error}\n")
+            return
+
+        print("\n")
+        print(f"Number of matching trajectories: {len(indices)}")
+        for index in indices[:10]:
+            print(
+                f"{self.vehicle_file_name(index)}: "
+                f"{self.kinematic_index.describe(index)}"
+            )
+        print("\n")
+
+    def retrieve_for_text_input(self, arg: str, mode: str, k: int = 10):
+        if arg == "":
+            print(
+                (
+                    "\nYou have provided no text input."
+                    "\nPlease provide a verbal description of what you want to retrieve.\n"
+                )
+            )
+            return
+
+        with open("config.yml", "r") as file:
+            config = yaml.safe_load(file)
+            server_url = config["retrieval_server_url"]
+
+        client = RetrievalClient(server_url)
+        if client.is_running():
+            try:
+                result = client.retrieve(arg, mode=mode, k=k)
+            except RuntimeError as error:
+                print(error)
+                return
+            values, vehicles = result["values"], result["vehicles"]
+        else:
+            print("Retrieval server not running, loading the retriever locally...")
+            if self.retriever is None:
+                self.retriever = TRAGRetriever()
+            if mode == "trajectory":
+                values, _, vehicles = self.retriever.retrieve_trajectory_indirect(
+                    arg, k=k
+                )
+            else:
+                values, _, vehicles = self.retriever.retrieve_scenario_direct(arg, k=k)
+            values = values.tolist()
+
+        print("\n")
+        for value, vehicle in zip(values, vehicles):
+            print(f"{value:.4f}: {vehicle}")
+        print("\n")
+
     def do_get_trajectories_for_text_input(self, arg: str):
         """Returns a list of the scenarios that contain the given text input in their name.
 
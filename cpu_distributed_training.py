@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import socket
+import time
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data.distributed import DistributedSampler
+
+from ego_trajectory_encoder import EgoTrajectoryEncoder
+from sharded_retrieval import THREAD_ENVIRONMENT_VARIABLES
+from trajectory_encoder_dataset import TrajectoryEncoderDataset
+
+
+def pin_threads(local_rank: int, threads_per_process: int):
+    """Restricts a process to its own block of cores and threads.
+
+    Rank r runs on the r-th block of ``threads_per_process`` cores, so the
+    intra-op threads of different ranks never compete for a core.
+    """
+    torch.set_num_threads(threads_per_process)
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        first = (local_rank * threads_per_process) % len(cores)
+        os.sched_setaffinity(
+            0, cores[first : first + threads_per_process] or cores
+        )
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def cosine_loss(outputs, labels):
+    # Same objective as train_ego_trajectory_encoder.py
+    return 1 - torch.mean(torch.abs(nn.functional.cosine_similarity(labels, outputs)))
+
+
+def synthetic_trajectory_dataset(num_samples: int = 4096, num_timesteps: int = 80):
+    """Random walks with random unit targets, for measuring throughput."""
+    generator = torch.Generator().manual_seed(0)
+    coordinates = torch.cumsum(
+        torch.randn(num_samples, num_timesteps, 2, generator=generator), dim=1
+    )
+    labels = nn.functional.normalize(
+        torch.randn(num_samples, 1024, generator=generator), dim=1
+    )
+    return TensorDataset(coordinates, labels)
+
+
+def ddp_worker(rank: int, world_size: int, port: int, config: dict, results):
+    """Trains the EgoTrajectoryEncoder in one DDP process on the CPU.
+
+    Args:
+        rank (int): Rank of this process.
+        world_size (int): Number of processes.
+        port (int): Port of the gloo rendezvous on localhost.
+        config (dict): Training options, see ``train_ego_trajectory_encoder_ddp``.
+        results: Queue rank 0 puts its measured throughput into, or None.
+    """
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    pin_threads(rank, config["threads_per_process"])
+    torch.manual_seed(config["seed"])
+
+    if config["synthetic"]:
+        dataset = synthetic_trajectory_dataset(config["num_samples"])
+        collate_fn = None
+    else:
+        dataset = TrajectoryEncoderDataset()
+        collate_fn = dataset.collate
+    # Every rank reads its own shard of the samples
+    sampler = DistributedSampler(
+        dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=config["seed"]
+    )
+    dataloader = DataLoader(
+        dataset,
+        batch_size=config["batch_size"],
+        sampler=sampler,
+        collate_fn=collate_fn,
+        drop_last=True,
+    )
+
+    # Gradients are all-reduced in buckets while the backward pass continues
+    model = DistributedDataParallel(
+        EgoTrajectoryEncoder(),
+        bucket_cap_mb=config["bucket_cap_mb"],
+        gradient_as_bucket_view=True,
+    )
+    optimizer = torch.optim.Adam(model.parameters(), lr=config["learning_rate"])
+
+    num_samples = 0
+    start = None
+    for epoch in range(config["epochs"]):
+        sampler.set_epoch(epoch)
+        running_loss = 0.0
+        num_steps = 0
+        for step, (inputs, labels) in enumerate(dataloader):
+            if step == config["max_steps"]:
+                break
+            # The first steps include allocating buffers and are not timed
+            if epoch == 0 and step == config["warmup_steps"]:
+                dist.barrier()
+                start = time.perf_counter()
+                num_samples = 0
+            optimizer.zero_grad()
+            with torch.autocast("cpu", dtype=torch.bfloat16, enabled=config["bf16"]):
+                outputs = model(inputs)
+            loss = cosine_loss(outputs.float(), labels)
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.item()
+            num_samples += len(inputs)
+            num_steps += 1
+        if rank == 0:
+            print(
+                f"Epoch {epoch + 1}, "
+                f"Train Loss: {running_loss / max(num_steps, 1):.3f}"
+            )
+
+    dist.barrier()
+    elapsed = time.perf_counter() - start if start is not None else float("nan")
+    if rank == 0:
+        if results is not None:
+            # Every rank processes the same number of samples
+            results.put(num_samples * world_size / elapsed)
+        if config["output_path"] is not None:
+            torch.save(model.module.state_dict(), config["output_path"])
+    dist.destroy_process_group()
+
+
+def train_ego_trajectory_encoder_ddp(
+    num_processes: int = 4,
+    threads_per_process: int = None,
+    epochs: int = 10,
+    batch_size: int = 16,
+    learning_rate: float = 1e-4,
+    bf16: bool = True,
+    bucket_cap_mb: int = 25,
+    synthetic: bool = False,
+    num_samples: int = 4096,
+    max_steps: int = None,
+    warmup_steps: int = 5,
+    output_path: str = "models/trajectory_encoder_wv_cos.pth",
+    seed: int = 42,
+) -> float:
+    """Trains the EgoTrajectoryEncoder with gloo DDP across local CPU processes.
+
+    Returns:
+        float: Training throughput in samples/s over all processes.
+    """
+    if threads_per_process is None:
+        threads_per_process = max(1, (os.cpu_count() or 1) // num_processes)
+    config = {
+        "threads_per_process": threads_per_process,
+        "epochs": epochs,
+        "batch_size": batch_size,
+        "learning_rate": learning_rate,
+        "bf16": bf16,
+        "bucket_cap_mb": bucket_cap_mb,
+        "synthetic": synthetic,
+        "num_samples": num_samples,
+        "max_steps": max_steps,
+        "warmup_steps": warmup_steps,
+        "output_path": output_path,
+        "seed": seed,
+    }
+    context = mp.get_context("spawn")
+    results = context.SimpleQueue()
+
+    # BLAS reads its thread count at import, i.e. from the worker environment
+    previous = {name: os.environ.get(name) for name in THREAD_ENVIRONMENT_VARIABLES}
+    for name in THREAD_ENVIRONMENT_VARIABLES:
+        os.environ[name] = str(threads_per_process)
+    try:
+        mp.start_processes(
+            ddp_worker,
+            args=(num_processes, free_port(), config, results),
+            nprocs=num_processes,
+            start_method="spawn",
+        )
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+    return results.get()
+
+
+class ThreadPinning(pl.Callback):
+    """Pins every Lightning DDP process to its own block of cores."""
+
+    def __init__(self, threads_per_process: int):
+        self.threads_per_process = threads_per_process
+
+    def setup(self, trainer, pl_module, stage):
+        pin_threads(trainer.local_rank, self.threads_per_process)
+
+
+def cpu_ddp_trainer(
+    num_processes: int = 4,
+    threads_per_process: int = None,
+    bf16: bool = True,
+    **trainer_kwargs,
+) -> pl.Trainer:
+    """Lightning trainer for the REDEncoder or ScenarioCNN on many-core CPUs.
+
+    One gloo DDP process per ``num_processes``, each pinned to
+    ``threads_per_process`` cores, with bf16 autocast. Lightning replaces
+    the DataLoader sampler with a DistributedSampler, so every process
+    trains on its own shard of the samples.
+    """
+    from pytorch_lightning.strategies import DDPStrategy
+
+    if threads_per_process is None:
+        threads_per_process = max(1, (os.cpu_count() or 1) // num_processes)
+    callbacks = trainer_kwargs.pop("callbacks", [])
+    return pl.Trainer(
+        accelerator="cpu",
+        devices=num_processes,
+        strategy=DDPStrategy(process_group_backend="gloo", bucket_cap_mb=25),
+        precision="bf16-mixed" if bf16 else "32-true",
+        callbacks=[ThreadPinning(threads_per_process), *callbacks],
+        **trainer_kwargs,
+    )
+
+
+def benchmark_cpu_ddp_scaling(
+    process_counts=(1, 2, 4, 8),
+    threads_per_process: int = None,
+    batch_size: int = 64,
+    max_steps: int = 30,
+    bf16: bool = True,
+    output_path: str = "output/cpu_ddp_scaling.json",
+) -> dict:
+    """Measures training throughput and scaling efficiency on synthetic data.
+
+    Every process gets the same batch size and number of threads, so ideal
+    scaling is a throughput of N times the single process throughput; the
+    efficiency is the measured fraction of that.
+    """
+    if threads_per_process is None:
+        threads_per_process = max(1, (os.cpu_count() or 1) // max(process_counts))
+    report = {}
+    for num_processes in process_counts:
+        throughput = train_ego_trajectory_encoder_ddp(
+            num_processes=num_processes,
+            threads_per_process=threads_per_process,
+            epochs=1,
+            batch_size=batch_size,
+            bf16=bf16,
+            synthetic=True,
+            num_samples=batch_size * max_steps * num_processes,
+            max_steps=max_steps,
+            output_path=None,
+        )
+        report[num_processes] = {"samples_per_second": throughput}
+    single = report[process_counts[0]]["samples_per_second"] / process_counts[0]
+    for num_processes, result in report.items():
+        result["efficiency"] = result["samples_per_second"] / (single * num_processes)
+        print(
+            f"{num_processes} processes: {result['samples_per_second']:.1f} samples/s, "
+            f"efficiency {result['efficiency']:.0%}"
+        )
+    with open(output_path, "w") as report_file:
+        json.dump(report, report_file, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--no-bf16", action="store_true")
+    parser.add_argument("--benchmark", action="store_true")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_cpu_ddp_scaling(
+            process_counts=tuple(
+                2**i for i in range(int(np.log2(args.processes)) + 1)
+            ),
+            threads_per_process=args.threads,
+            bf16=not args.no_bf16,
+        )
+    else:
+        train_ego_trajectory_encoder_ddp(
+            num_processes=args.processes,
+            threads_per_process=args.threads,
+            bf16=not args.no_bf16,
+        )
@@ -1,6 +1,8 @@
 import torch
 import pytorch_lightning as pl
 
+from typing import Optional
+
 from torch import nn, Tensor
 from local_attention import LocalAttention
 from npz_trajectory import NpzTrajectory
@@ -13,7 +15,7 @@ class EgoTrajectoryEncoder(nn.Module):
     def __init__(
         self,
         max_dist=50.0,
-        # num_timesteps=11,
+        num_timesteps=80,
         num_layers=6,
         dim_model=128,
         num_heads=8,
@@ -27,7 +29,11 @@ class EgoTrajectoryEncoder(nn.Module):
             out_features=dim_model,
         )
         self.max_dist = max_dist
-        # self.num_timesteps = num_timesteps
+        # Time encoding of trajectories with num_timesteps points, not part of
+        # the state dict
+        self.register_buffer(
+            "time_encoding", time_encoding(num_timesteps), persistent=False
+        )
 
         self.layers = nn.ModuleList(
             [
@@ -38,17 +44,19 @@ class EgoTrajectoryEncoder(nn.Module):
         self.linear = nn.Linear(dim_model, dim_output)
 
     def forward(self, pos_src_tokens):
-        pos_src_tokens /= self.max_dist
-        batch_size = pos_src_tokens.size(0)
-        time_encoding = torch.arange(
-            0, pos_src_tokens.shape[1], device=pos_src_tokens.device
-        ) / (pos_src_tokens.shape[1] - 1)
-        time_encoding = time_encoding.expand(batch_size, -1)[:, :, None]
+        # Not in place, the caller's tensor stays unchanged
+        pos_src_tokens = pos_src_tokens / self.max_dist
+        batch_size, num_timesteps = pos_src_tokens.shape[:2]
+        encoding = self.time_encoding
+        if len(encoding) != num_timesteps:
+            encoding = time_encoding(num_timesteps, pos_src_tokens.device)
+        encoding = encoding.to(pos_src_tokens.dtype)
+        encoding = encoding.expand(batch_size, -1)[:, :, None]
 
         src = torch.cat(
             (
                 pos_src_tokens,
-                time_encoding,
+                encoding,
             ),
             dim=2,
         )
@@ -117,6 +125,11 @@ class EgoTrajectoryEncoder(nn.Module):
 #         return self.linear(src)
 
 
+def time_encoding(num_timesteps: int, device: Optional[torch.device] = None) -> Tensor:
+    """Relative time of every step, from 0 for the first to 1 for the last."""
+    return torch.arange(0, num_timesteps, device=device) / (num_timesteps - 1)
+
+
 class TransformerEncoderLayer(nn.Module):
     def __init__(self, dim_model, num_heads, dim_feedforward, dropout):
         super().__init__()
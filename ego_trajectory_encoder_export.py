@@ -0,0 +1,272 @@
+import json
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn, Tensor
+
+from ego_trajectory_encoder import (
+    EgoTrajectoryEncoder,
+    TransformerEncoderLayer,
+    time_encoding,
+)
+
+EXPORT_METHODS = ("torchscript", "compile", "onnx")
+
+
+class InferenceEncoderLayer(nn.Module):
+    """``TransformerEncoderLayer`` for inference, with the same weights.
+
+    Self-attention is written out with plain linear layers and matmuls, so
+    the layer can be scripted, exported to ONNX and dynamically quantized as
+    a whole, including the attention projections.
+    """
+
+    def __init__(self, dim_model: int, num_heads: int, dim_feedforward: int):
+        super().__init__()
+        self.num_heads = num_heads
+        self.scale = float((dim_model // num_heads) ** -0.5)
+        self.in_proj = nn.Linear(dim_model, 3 * dim_model)
+        self.out_proj = nn.Linear(dim_model, dim_model)
+        self.norm1 = nn.LayerNorm(dim_model)
+        self.linear1 = nn.Linear(dim_model, dim_feedforward)
+        self.linear2 = nn.Linear(dim_feedforward, dim_model)
+        self.norm2 = nn.LayerNorm(dim_model)
+
+    @classmethod
+    def from_layer(cls, layer: TransformerEncoderLayer):
+        attention = layer.attn.sublayer
+        feed_forward = layer.feed_forward.sublayer
+        inference_layer = cls(
+            attention.embed_dim, attention.num_heads, feed_forward[0].out_features
+        )
+        with torch.no_grad():
+            inference_layer.in_proj.weight.copy_(attention.in_proj_weight)
+            inference_layer.in_proj.bias.copy_(attention.in_proj_bias)
+        inference_layer.out_proj.load_state_dict(attention.out_proj.state_dict())
+        inference_layer.norm1.load_state_dict(layer.attn.norm.state_dict())
+        inference_layer.linear1.load_state_dict(feed_forward[0].state_dict())
+        inference_layer.linear2.load_state_dict(feed_forward[2].state_dict())
+        inference_layer.norm2.load_state_dict(layer.feed_forward.norm.state_dict())
+        return inference_layer
+
+    def forward(self, src: Tensor) -> Tensor:
+        batch_size, num_tokens, dim_model = src.shape
+        # (3, B, heads, T, dim_head)
+        qkv = self.in_proj(src).view(batch_size, num_tokens, 3, self.num_heads, -1)
+        qkv = qkv.permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        weights = torch.softmax(torch.matmul(q, k.transpose(-2, -1)) * self.scale, -1)
+        attention = torch.matmul(weights, v).transpose(1, 2)
+        attention = attention.reshape(batch_size, num_tokens, dim_model)
+
+        src = self.norm1(src + self.out_proj(attention))
+        return self.norm2(src + self.linear2(torch.relu(self.linear1(src))))
+
+
+class InferenceEgoTrajectoryEncoder(nn.Module):
+    """``EgoTrajectoryEncoder`` rewritten for serving, with the same outputs.
+
+    - The input projection of ``cat(pos / max_dist, time)`` is split into a
+      ``(2, dim_model)`` position weight with ``max_dist`` folded in and a
+      precomputed ``(num_timesteps, dim_model)`` table of the time term, so
+      the input is neither divided nor concatenated, and never modified.
+    - The mean over the time steps is taken before the final linear layer
+      (both are linear), which then runs once per trajectory instead of once
+      per step.
+    - The layers are ``InferenceEncoderLayer``.
+    """
+
+    def __init__(self, encoder: EgoTrajectoryEncoder, num_timesteps: int = 80):
+        super().__init__()
+        weight = encoder.to_dim_model.weight.detach()
+        bias = encoder.to_dim_model.bias.detach()
+        self.register_buffer(
+            "position_weight", (weight[:, :2] / encoder.max_dist).T.contiguous()
+        )
+        self.register_buffer("time_weight", weight[:, 2].clone())
+        self.register_buffer("time_bias", bias.clone())
+        self.register_buffer(
+            "time_table",
+            time_encoding(num_timesteps, weight.device)[:, None] * self.time_weight
+            + self.time_bias,
+        )
+        self.layers = nn.ModuleList(
+            [InferenceEncoderLayer.from_layer(layer) for layer in encoder.layers]
+        )
+        self.linear = nn.Linear(encoder.linear.in_features, encoder.linear.out_features)
+        self.linear.load_state_dict(encoder.linear.state_dict())
+
+    def forward(self, pos_src_tokens: Tensor) -> Tensor:
+        table = self.time_table
+        if table.shape[0] != pos_src_tokens.shape[1]:
+            table = (
+                time_encoding(pos_src_tokens.shape[1], pos_src_tokens.device)[:, None]
+                * self.time_weight
+                + self.time_bias
+            )
+        src = torch.matmul(pos_src_tokens, self.position_weight) + table
+        for layer in self.layers:
+            src = layer(src)
+        return self.linear(src.mean(dim=1))
+
+
+class OnnxEgoTrajectoryEncoder:
+    """Runs an ONNX export with onnxruntime, called like the torch models."""
+
+    def __init__(self, path: str, num_threads: int = None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(self, pos_src_tokens: Tensor) -> Tensor:
+        (embeddings,) = self.session.run(
+            None, {"pos_src_tokens": pos_src_tokens.numpy()}
+        )
+        return torch.from_numpy(embeddings)
+
+
+def export_ego_trajectory_encoder(
+    encoder: EgoTrajectoryEncoder,
+    output_path: str = "models/trajectory_encoder_inference.pt",
+    method: str = "torchscript",
+    quantize: bool = False,
+    num_timesteps: int = 80,
+):
+    """Exports the encoder for CPU serving.
+
+    Args:
+        encoder (EgoTrajectoryEncoder): Trained encoder.
+        output_path (str): Where the TorchScript or ONNX model is saved.
+        method (str): "torchscript" (scripted and frozen), "compile"
+            (``torch.compile``, nothing is saved) or "onnx" (batch size is
+            dynamic, the number of time steps fixed to ``num_timesteps``).
+        quantize (bool): Whether the linear layers are dynamically quantized
+            to int8. Not available for ONNX.
+        num_timesteps (int): Trajectory length the time table is built for.
+
+    Returns:
+        Callable model mapping ``(B, T, 2)`` coordinates to ``(B, dim)``.
+    """
+    if method not in EXPORT_METHODS:
+        raise ValueError(f"Unknown export method: {method}")
+    if quantize and method == "onnx":
+        raise ValueError("Dynamically quantized models cannot be exported to ONNX")
+
+    model = InferenceEgoTrajectoryEncoder(encoder, num_timesteps).cpu().eval()
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {nn.Linear}, dtype=torch.qint8
+        )
+
+    if method == "compile":
+        return torch.compile(model)
+    if method == "torchscript":
+        model = torch.jit.freeze(torch.jit.script(model))
+        torch.jit.save(model, output_path)
+        return model
+    torch.onnx.export(
+        model,
+        torch.zeros(1, num_timesteps, 2),
+        output_path,
+        input_names=["pos_src_tokens"],
+        output_names=["embedding"],
+        dynamic_axes={
+            "pos_src_tokens": {0: "batch_size"},
+            "embedding": {0: "batch_size"},
+        },
+        opset_version=17,
+    )
+    return OnnxEgoTrajectoryEncoder(output_path)
+
+
+def benchmark_ego_trajectory_encoder(
+    encoder: EgoTrajectoryEncoder,
+    models: dict,
+    batch_sizes=(1, 8, 64, 256, 1024),
+    num_timesteps: int = 80,
+    repeats: int = 10,
+    output_path: str = "output/ego_trajectory_encoder_benchmark.json",
+) -> dict:
+    """Measures latency, throughput and agreement with the eager encoder on CPU.
+
+    The inputs are random walks, comparable in scale to real trajectories.
+    The agreement is the cosine similarity between every model's embeddings
+    and those of the eager encoder.
+
+    Args:
+        encoder (EgoTrajectoryEncoder): Eager reference model.
+        models (dict): Name to callable, e.g. from ``export_ego_trajectory_encoder``.
+        batch_sizes (tuple): Batch sizes to time.
+        num_timesteps (int): Trajectory length.
+        repeats (int): Timed calls per batch size, after two warm-up calls.
+        output_path (str): Where the report is saved as JSON.
+    """
+    encoder = encoder.cpu().eval()
+    generator = torch.Generator().manual_seed(0)
+    inputs = torch.cumsum(
+        torch.randn(max(batch_sizes), num_timesteps, 2, generator=generator), dim=1
+    )
+    with torch.inference_mode():
+        reference = encoder(inputs)
+
+    report = {}
+    for name, model in {"eager": encoder, **models}.items():
+        report[name] = {}
+        with torch.inference_mode():
+            similarity = F.cosine_similarity(model(inputs), reference, dim=1)
+            report[name]["cosine_mean"] = float(similarity.mean())
+            report[name]["cosine_min"] = float(similarity.min())
+            for batch_size in batch_sizes:
+                batch = inputs[:batch_size]
+                for _ in range(2):
+                    model(batch)
+                latencies = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    model(batch)
+                    latencies.append(time.perf_counter() - start)
+                latency = float(np.median(latencies))
+                report[name][str(batch_size)] = {
+                    "latency_ms": latency * 1000,
+                    "trajectories_per_second": batch_size / latency,
+                }
+        print(
+            f"{name}: cosine agreement {report[name]['cosine_mean']:.6f} "
+            f"(min {report[name]['cosine_min']:.6f})"
+        )
+        for batch_size in batch_sizes:
+            result = report[name][str(batch_size)]
+            print(
+                f"  batch {batch_size}: {result['latency_ms']:.2f} ms, "
+                f"{result['trajectories_per_second']:.0f} trajectories/s"
+            )
+
+    with open(output_path, "w") as report_file:
+        json.dump(report, report_file, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    encoder = EgoTrajectoryEncoder()
+    encoder.load_state_dict(
+        torch.load("models/trajectory_encoder_wv_cos.pth", map_location="cpu")
+    )
+    encoder.eval()
+    models = {
+        "torchscript": export_ego_trajectory_encoder(encoder),
+        "torchscript_int8": export_ego_trajectory_encoder(
+            encoder, "models/trajectory_encoder_inference_int8.pt", quantize=True
+        ),
+        "compile": export_ego_trajectory_encoder(encoder, method="compile"),
+        "onnx": export_ego_trajectory_encoder(
+            encoder, "models/trajectory_encoder_inference.onnx", method="onnx"
+        ),
+    }
+    benchmark_ego_trajectory_encoder(encoder, models)
@@ -0,0 +1,439 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from retrieval_cache import file_version
+
+
+class EmbeddingStore:
+    """Read-only store of L2-normalized trajectory embeddings.
+
+    The store is a directory holding one contiguous ``embeddings.npy`` matrix
+    (float32 or float16, rows normalized to unit length) and a ``meta.json``
+    describing it. The matrix is opened with ``mmap_mode="r"``, so a cold start
+    only maps the file and every process that opens the same store shares the
+    page cache instead of holding a private copy.
+
+    Because the rows are unit length, the cosine similarity of a query against
+    the whole corpus is a single matrix-vector product.
+    """
+
+    EMBEDDINGS_FILE = "embeddings.npy"
+    META_FILE = "meta.json"
+    CODES_FILE = "embeddings_int8.npy"
+    SCALES_FILE = "int8_scales.npy"
+
+    def __init__(
+        self,
+        directory: str = "datasets/trajectory_embedding_store",
+        quantized: bool = False,
+        rerank_factor: int = 4,
+    ):
+        """
+        Args:
+            directory (str): Directory of the store.
+            quantized (bool): Whether ``search`` runs its first pass over the
+                int8 codes written by ``quantize`` instead of the float rows.
+            rerank_factor (int): The quantized first pass keeps
+                ``k * rerank_factor`` candidates for the exact re-rank.
+        """
+        self.directory = directory
+        with open(os.path.join(directory, self.META_FILE)) as meta_file:
+            self.meta = json.load(meta_file)
+        self.embeddings = np.load(
+            os.path.join(directory, self.EMBEDDINGS_FILE), mmap_mode="r"
+        )
+        self.dtype = self.embeddings.dtype
+        self.dim = self.embeddings.shape[1]
+
+        self.codes = None
+        self.scales = None
+        if os.path.exists(os.path.join(directory, self.CODES_FILE)):
+            self.codes = np.load(os.path.join(directory, self.CODES_FILE), mmap_mode="r")
+            self.scales = np.load(os.path.join(directory, self.SCALES_FILE))
+        if quantized and self.codes is None:
+            raise ValueError(
+                f"{directory} has no int8 codes, call EmbeddingStore.quantize first"
+            )
+        self.quantized = quantized
+        self.rerank_factor = rerank_factor
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    @classmethod
+    def build(
+        cls,
+        source_path: str = "datasets/encoder_output_a_mse.npy",
+        directory: str = "datasets/trajectory_embedding_store",
+        dtype: str = "float32",
+        chunk_size: int = 65536,
+    ):
+        """Creates a store from a raw ``(N, dim)`` encoder output matrix.
+
+        The source is read through a memory map and normalized chunk by chunk,
+        so building never holds more than ``chunk_size`` rows in memory.
+
+        Args:
+            source_path (str): Path to the ``.npy`` file with the encoder outputs.
+            directory (str): Directory the store is written to.
+            dtype (str): Storage dtype of the normalized matrix, "float32" or "float16".
+            chunk_size (int): Number of rows normalized at once.
+
+        Returns:
+            EmbeddingStore: The opened store.
+        """
+        source = np.load(source_path, mmap_mode="r")
+        return cls.write(directory, source, source_path, dtype, chunk_size)
+
+    @classmethod
+    def write(
+        cls,
+        directory: str,
+        source: np.ndarray,
+        source_name: str,
+        dtype: str = "float32",
+        chunk_size: int = 65536,
+    ):
+        """Normalizes the rows of an (optionally memory-mapped) array into a new store."""
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"Unsupported embedding store dtype: {dtype}")
+
+        os.makedirs(directory, exist_ok=True)
+        num_rows, dim = source.shape
+
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(directory, cls.EMBEDDINGS_FILE),
+            mode="w+",
+            dtype=dtype,
+            shape=(num_rows, dim),
+        )
+        for start in range(0, num_rows, chunk_size):
+            chunk = np.asarray(source[start : start + chunk_size], dtype=np.float32)
+            embeddings[start : start + chunk_size] = normalize_rows(chunk)
+        embeddings.flush()
+        del embeddings
+
+        meta = {
+            "source": source_name,
+            "count": int(num_rows),
+            "dim": int(dim),
+            "dtype": dtype,
+        }
+        with open(os.path.join(directory, cls.META_FILE), "w") as meta_file:
+            json.dump(meta, meta_file, indent=4)
+
+        return cls(directory)
+
+    @classmethod
+    def open_or_build(
+        cls,
+        directory: str = "datasets/trajectory_embedding_store",
+        source_path: str = "datasets/encoder_output_a_mse.npy",
+        dtype: str = "float32",
+    ):
+        if os.path.exists(os.path.join(directory, cls.META_FILE)):
+            return cls(directory)
+        return cls.build(source_path=source_path, directory=directory, dtype=dtype)
+
+    def quantize(self, chunk_size: int = 65536):
+        """Writes per-dimension int8 codes of the rows next to the float matrix.
+
+        Every dimension gets its own scale ``max(|x_d|) / 127``, so the codes
+        take a quarter of the float32 size while each dimension keeps the full
+        int8 range. The float matrix stays in place for the exact re-rank.
+        """
+        max_abs = np.zeros(self.dim, dtype=np.float32)
+        for start in range(0, len(self), chunk_size):
+            chunk = np.abs(self.embeddings[start : start + chunk_size])
+            max_abs = np.maximum(max_abs, chunk.max(axis=0))
+        scales = (max_abs / 127).astype(np.float32)
+        scales[scales == 0] = 1.0
+
+        codes = np.lib.format.open_memmap(
+            os.path.join(self.directory, self.CODES_FILE),
+            mode="w+",
+            dtype=np.int8,
+            shape=self.embeddings.shape,
+        )
+        for start in range(0, len(self), chunk_size):
+            chunk = self.embeddings[start : start + chunk_size].astype(np.float32)
+            codes[start : start + chunk_size] = np.clip(
+                np.rint(chunk / scales), -127, 127
+            )
+        codes.flush()
+        del codes
+        np.save(os.path.join(self.directory, self.SCALES_FILE), scales)
+
+        self.codes = np.load(os.path.join(self.directory, self.CODES_FILE), mmap_mode="r")
+        self.scales = scales
+
+    def version(self) -> tuple:
+        """Changes whenever the store is rewritten."""
+        return file_version(
+            os.path.join(self.directory, self.EMBEDDINGS_FILE),
+            os.path.join(self.directory, self.META_FILE),
+            os.path.join(self.directory, self.CODES_FILE),
+        )
+
+    def normalize_query(self, query) -> np.ndarray:
+        """Returns the query as a unit-length float32 vector of shape ``(dim,)``."""
+        return self.normalize_queries(np.asarray(query).reshape(1, -1))[0]
+
+    def normalize_queries(self, queries) -> np.ndarray:
+        """Returns the queries as unit-length float32 rows of shape ``(Q, dim)``."""
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        if queries.shape[1] != self.dim:
+            raise ValueError(
+                f"Query has dimension {queries.shape[1]}, store has dimension {self.dim}"
+            )
+        return normalize_rows(queries)
+
+    def score(self, query, chunk_size: int = 65536) -> np.ndarray:
+        """Cosine similarity of the query against every stored row.
+
+        Args:
+            query: Embedding of shape ``(dim,)`` or ``(1, dim)``. It does not
+                need to be normalized.
+            chunk_size (int): Rows upcast at once when the store is float16.
+
+        Returns:
+            np.ndarray: float32 similarities of shape ``(N,)``.
+        """
+        query = self.normalize_query(query)
+        if self.dtype == np.float32:
+            # Reads straight from the mapped pages, no copy of the matrix
+            return self.embeddings @ query
+
+        similarities = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), chunk_size):
+            chunk = self.embeddings[start : start + chunk_size].astype(np.float32)
+            similarities[start : start + chunk_size] = chunk @ query
+        return similarities
+
+    def search(
+        self,
+        queries,
+        k: int,
+        chunk_size: int = 65536,
+        ids: np.ndarray = None,
+        mask: np.ndarray = None,
+    ):
+        """Top-k cosine search for a batch of queries.
+
+        Every corpus chunk is scored against all queries with one matrix
+        product and merged into a running top-k per query with
+        ``np.argpartition``, so memory stays bounded by ``Q * (k + chunk_size)``
+        and the corpus is never fully sorted.
+
+        Args:
+            queries: Query embeddings of shape ``(Q, dim)`` or ``(dim,)``.
+            k (int): Number of neighbours per query.
+            chunk_size (int): Number of corpus rows scored at once.
+            ids (np.ndarray): Sorted row ids to restrict the search to. Only
+                these rows are read from the store.
+            mask (np.ndarray): Boolean mask over all rows. Every row is scored
+                and rows outside the mask are dropped afterwards.
+
+        With ``quantized=True`` the search is answered by ``search_quantized``.
+
+        Returns:
+            tuple: ``(scores, ids)``, both of shape ``(Q, k)`` and sorted by
+            descending similarity, equal similarities by ascending id. k is
+            capped at the number of candidate rows.
+        """
+        queries = self.normalize_queries(queries)
+        if self.quantized:
+            return self.search_quantized(
+                queries, k, self.rerank_factor, chunk_size, ids, mask
+            )
+        return self.scan(self.embeddings, queries, k, chunk_size, ids, mask)
+
+    def search_quantized(
+        self,
+        queries,
+        k: int,
+        rerank_factor: int = 4,
+        chunk_size: int = 65536,
+        ids: np.ndarray = None,
+        mask: np.ndarray = None,
+    ):
+        """Top-k search with an int8 first pass and an exact float re-rank.
+
+        The int8 codes are scanned for ``k * rerank_factor`` candidates per
+        query, then only the candidate rows are read from the float matrix
+        and scored exactly. Same arguments and results as ``search``.
+        """
+        if self.codes is None:
+            raise ValueError(
+                f"{self.directory} has no int8 codes, call EmbeddingStore.quantize first"
+            )
+        queries = self.normalize_queries(queries)
+        # numpy has no int8 matrix product, so every chunk of codes is upcast;
+        # small chunks keep that copy in the CPU cache
+        _, candidates = self.scan(
+            self.codes,
+            queries * self.scales,
+            k * rerank_factor,
+            min(chunk_size, 8192),
+            ids,
+            mask,
+        )
+        return self.rerank(queries, candidates, k)
+
+    def rerank(self, queries, candidates: np.ndarray, k: int):
+        """Scores candidate ids exactly and keeps the top-k per query.
+
+        Args:
+            queries: Query embeddings of shape ``(Q, dim)``.
+            candidates (np.ndarray): Candidate row ids of shape ``(Q, C)``.
+            k (int): Number of neighbours per query.
+
+        Returns:
+            tuple: ``(scores, ids)`` sorted like the results of ``search``.
+        """
+        queries = self.normalize_queries(queries)
+        # Read every candidate row once, even if several queries share it
+        unique_ids, positions = np.unique(candidates, return_inverse=True)
+        rows = self.embeddings[unique_ids].astype(np.float32)
+        exact_scores = np.take_along_axis(
+            queries @ rows.T, positions.reshape(candidates.shape), axis=1
+        )
+        return sort_top_k(*merge_top_k(exact_scores, candidates, k))
+
+    def scan(
+        self,
+        matrix: np.ndarray,
+        queries: np.ndarray,
+        k: int,
+        chunk_size: int = 65536,
+        ids: np.ndarray = None,
+        mask: np.ndarray = None,
+    ):
+        """Chunked top-k of ``queries @ matrix.T``, see ``search``."""
+        if ids is not None:
+            num_candidates = len(ids)
+        elif mask is not None:
+            num_candidates = int(np.count_nonzero(mask))
+        else:
+            num_candidates = len(self)
+        k = min(k, num_candidates)
+        best_scores = np.empty((queries.shape[0], 0), dtype=np.float32)
+        best_ids = np.empty((queries.shape[0], 0), dtype=np.int64)
+        if k <= 0:
+            # No candidate rows, e.g. an all-False mask
+            return best_scores, best_ids
+
+        num_rows = len(self) if ids is None else len(ids)
+        for start in range(0, num_rows, chunk_size):
+            if ids is None:
+                row_ids = np.arange(
+                    start, min(start + chunk_size, num_rows), dtype=np.int64
+                )
+                chunk = matrix[start : start + chunk_size]
+            else:
+                row_ids = np.asarray(ids[start : start + chunk_size], dtype=np.int64)
+                chunk = matrix[row_ids]
+            if chunk.dtype != np.float32:
+                chunk = chunk.astype(np.float32)
+            chunk_scores = queries @ chunk.T
+            if mask is not None:
+                chunk_scores[:, ~mask[row_ids]] = -np.inf
+            chunk_ids = np.broadcast_to(row_ids, chunk_scores.shape)
+            best_scores, best_ids = merge_top_k(
+                np.concatenate((best_scores, chunk_scores), axis=1),
+                np.concatenate((best_ids, chunk_ids), axis=1),
+                k,
+            )
+
+        return sort_top_k(best_scores, best_ids)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def merge_top_k(scores: np.ndarray, ids: np.ndarray, k: int):
+    """Keeps the k highest scores per row (unordered) together with their ids.
+
+    Ties at the k-th score are resolved towards the smaller id, so the result
+    does not depend on how the corpus was chunked or sharded.
+    """
+    if k <= 0:
+        return scores[:, :0], ids[:, :0]
+    if scores.shape[1] <= k:
+        return scores, ids
+    selected = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, selected, axis=1)
+    top_ids = np.take_along_axis(ids, selected, axis=1)
+
+    kth_scores = top_scores.min(axis=1, keepdims=True)
+    ambiguous = np.count_nonzero(scores == kth_scores, axis=1) > np.count_nonzero(
+        top_scores == kth_scores, axis=1
+    )
+    for row in np.flatnonzero(ambiguous):
+        order = np.lexsort((ids[row], -scores[row]))[:k]
+        top_scores[row], top_ids[row] = scores[row, order], ids[row, order]
+    return top_scores, top_ids
+
+
+def sort_top_k(scores: np.ndarray, ids: np.ndarray):
+    """Sorts every row by descending score, equal scores by ascending id."""
+    order = np.lexsort((ids, -scores), axis=-1)
+    return (
+        np.take_along_axis(scores, order, axis=-1),
+        np.take_along_axis(ids, order, axis=-1),
+    )
+
+
+def benchmark_quantized_search(
+    store: EmbeddingStore,
+    num_queries: int = 64,
+    k: int = 100,
+    rerank_factors=(1, 2, 4, 8),
+):
+    """Prints recall@k, latency and memory of the int8 tier against float search.
+
+    Queries are randomly chosen stored rows, so they follow the distribution
+    of the corpus.
+    """
+    if store.codes is None:
+        store.quantize()
+    rng = np.random.default_rng(0)
+    queries = np.asarray(
+        store.embeddings[np.sort(rng.choice(len(store), num_queries, replace=False))],
+        dtype=np.float32,
+    )
+
+    start = time.perf_counter()
+    _, reference = store.scan(store.embeddings, store.normalize_queries(queries), k)
+    float_latency = time.perf_counter() - start
+    print(
+        f"float: {store.embeddings.nbytes / 2**20:.1f} MiB, "
+        f"{float_latency / num_queries * 1000:.2f} ms/query"
+    )
+
+    for rerank_factor in rerank_factors:
+        start = time.perf_counter()
+        _, ids = store.search_quantized(queries, k, rerank_factor=rerank_factor)
+        latency = time.perf_counter() - start
+        recall = np.mean(
+            [
+                len(np.intersect1d(row, reference_row)) / reference.shape[1]
+                for row, reference_row in zip(ids, reference)
+            ]
+        )
+        print(
+            f"int8, rerank x{rerank_factor}: {store.codes.nbytes / 2**20:.1f} MiB, "
+            f"{latency / num_queries * 1000:.2f} ms/query, recall@{k}: {recall:.4f}"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_quantized_search(EmbeddingStore.open_or_build())
@@ -0,0 +1,231 @@
+import re
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm import tqdm
+
+from npz_utils import list_vehicle_files_absolute
+from scenario_behaviour_index import SortedColumns, parse_range_query
+from scenario_bitmap_index import DIRECTION_BUCKETS
+
+KINEMATIC_ATTRIBUTES = [
+    "mean_speed",  # m/s
+    "max_speed",  # m/s
+    "max_decel",  # m/s², positive when braking
+    "peak_yaw_rate",  # rad/s, absolute
+    "path_length",  # m
+    "stop_duration",  # s
+]
+
+# Waymo motion data is sampled at 10 Hz
+TIME_STEP = 0.1
+# Below this speed (m/s) a vehicle counts as stopped and its heading is ignored
+STOP_SPEED = 0.5
+
+
+def ego_past_vectors(vector_data: np.ndarray):
+    """Returns the past vectors of the ego agent, oldest first, or None.
+
+    The scenes are centered on the ego agent, so its polyline is the agent
+    polyline that ends in the origin.
+    """
+    vectors, idx = vector_data[:, :44], vector_data[:, 44]
+    for i in np.unique(idx):
+        polyline = vectors[idx == i]
+        if (
+            polyline[:, 8:11].sum() > 0
+            and polyline[-1, 0] == 0
+            and polyline[-1, 1] == 0
+        ):
+            return polyline
+    return None
+
+
+def kinematic_attributes(
+    vector_data: np.ndarray, gt_marginal: np.ndarray, future_valid: np.ndarray = None
+) -> np.ndarray:
+    """Computes the ``KINEMATIC_ATTRIBUTES`` of one trajectory.
+
+    The past is taken from the ego vectors (position, speed in column 2,
+    velocity yaw in column 3), the future from the ground truth positions.
+    Speeds, accelerations and yaw rates are finite differences over
+    consecutive valid time steps.
+
+    Args:
+        vector_data (np.ndarray): ``vector_data`` of the npz file.
+        gt_marginal (np.ndarray): ``(80, 2)`` future positions.
+        future_valid (np.ndarray): ``(80,)`` validity of the future positions.
+
+    Returns:
+        np.ndarray: float32 attributes, NaN where they cannot be computed.
+    """
+    past = ego_past_vectors(vector_data)
+    if past is None:
+        past = np.zeros((1, 44), dtype=np.float32)
+    if future_valid is None:
+        future_valid = np.ones(len(gt_marginal), dtype=bool)
+
+    # Current position is the origin, followed by the future positions
+    positions = np.concatenate(([[0.0, 0.0]], gt_marginal[:, :2]))
+    valid = np.concatenate(([True], np.asarray(future_valid) > 0))
+    pairs = valid[:-1] & valid[1:]
+    steps = np.diff(positions, axis=0)[pairs]
+    future_speeds = np.linalg.norm(steps, axis=1) / TIME_STEP
+    future_headings = np.arctan2(steps[:, 1], steps[:, 0])
+
+    past_steps = np.linalg.norm(np.diff(past[:, :2], axis=0), axis=1)
+    speeds = np.concatenate((past[:, 2], future_speeds))
+    path_length = past_steps.sum() + future_speeds.sum() * TIME_STEP
+
+    accelerations = (
+        np.concatenate((np.diff(past[:, 2]), np.diff(future_speeds))) / TIME_STEP
+    )
+    max_decel = max(0.0, -accelerations.min()) if len(accelerations) else np.nan
+
+    moving = speeds > STOP_SPEED
+    yaw_rates = np.concatenate(
+        (
+            heading_rates(past[:, 3], moving[: len(past)]),
+            heading_rates(future_headings, moving[len(past) :]),
+            [0.0],
+        )
+    )
+
+    return np.array(
+        [
+            speeds.mean(),
+            speeds.max(),
+            max_decel,
+            yaw_rates.max(),
+            path_length,
+            np.count_nonzero(~moving) * TIME_STEP,
+        ],
+        dtype=np.float32,
+    )
+
+
+def heading_rates(headings: np.ndarray, moving: np.ndarray) -> np.ndarray:
+    """Absolute yaw rates between consecutive steps in which the agent moves."""
+    # Wrap the differences to [-pi, pi) so crossing +-pi is not a full turn
+    differences = (np.diff(headings) + np.pi) % (2 * np.pi) - np.pi
+    return np.abs(differences[moving[:-1] & moving[1:]]) / TIME_STEP
+
+
+def kinematic_attributes_for_file(path: str) -> np.ndarray:
+    try:
+        with np.load(path) as data:
+            # Only the needed members of the archive are decompressed
+            return kinematic_attributes(
+                data["vector_data"], data["gt_marginal"], data["future_val_marginal"]
+            )
+    except (OSError, KeyError, ValueError):
+        return np.full(len(KINEMATIC_ATTRIBUTES), np.nan, dtype=np.float32)
+
+
+def create_kinematic_attribute_table(
+    vehicle_list: list = None,
+    output_path: str = "output/kinematic_attributes.npy",
+    num_workers: int = 8,
+) -> np.ndarray:
+    """Computes the attributes of every trajectory and saves them as ``(N, 6)``.
+
+    Rows follow ``vehicle_list``, by default the vehicle_a files in the order
+    of ``list_vehicle_files_absolute``, like the direction labels.
+    """
+    if vehicle_list is None:
+        vehicle_list = list_vehicle_files_absolute()
+    table = np.empty((len(vehicle_list), len(KINEMATIC_ATTRIBUTES)), dtype=np.float32)
+    with Pool(num_workers) as pool:
+        for index, attributes in enumerate(
+            tqdm(
+                pool.imap(kinematic_attributes_for_file, vehicle_list, chunksize=64),
+                total=len(vehicle_list),
+            )
+        ):
+            table[index] = attributes
+    np.save(output_path, table)
+    return table
+
+
+class KinematicAttributeIndex:
+    """Range queries over the kinematic attribute table.
+
+    Every attribute column is sorted once (see ``SortedColumns``), so a
+    predicate like ``max_decel > 4`` is a binary search. Results can be
+    restricted to direction buckets and are row ids in the order of the
+    embedding store, usable as ``ids`` of a filtered vector search.
+    """
+
+    def __init__(self, table: np.ndarray, direction_labels: np.ndarray = None):
+        self.table = np.asarray(table, dtype=np.float32)
+        self.columns = SortedColumns(self.table, KINEMATIC_ATTRIBUTES)
+        self.direction_labels = (
+            None if direction_labels is None else np.asarray(direction_labels)
+        )
+
+    @classmethod
+    def from_files(
+        cls,
+        table_path: str = "output/kinematic_attributes.npy",
+        direction_labels_path: str = "datasets/raw_direction_labels.npy",
+    ):
+        return cls(np.load(table_path), np.load(direction_labels_path))
+
+    def __len__(self):
+        return len(self.table)
+
+    def search(self, predicates: dict, directions=()) -> np.ndarray:
+        """Trajectories whose attributes lie in all given ranges.
+
+        Args:
+            predicates (dict): Maps an attribute to inclusive ``(low, high)``
+                bounds, None for unbounded, e.g. ``{"max_decel": (4.0, None)}``.
+            directions (list): Direction buckets of which a result must have one.
+
+        Returns:
+            np.ndarray: Sorted row ids.
+        """
+        candidates = None
+        if directions:
+            if self.direction_labels is None:
+                raise ValueError("The index was built without direction labels")
+            for name in directions:
+                if name not in DIRECTION_BUCKETS:
+                    raise ValueError(f"Unknown direction bucket: {name}")
+            candidates = np.flatnonzero(
+                np.isin(
+                    self.direction_labels,
+                    [DIRECTION_BUCKETS.index(name) for name in directions],
+                )
+            )
+        return self.columns.search(predicates, candidates)
+
+    def search_text(self, query: str) -> np.ndarray:
+        """``search`` for a query like "max_decel>4 AND mean_speed>10 AND Left".
+
+        Conditions without an operator are direction buckets, of which a
+        result must have one.
+        """
+        conditions = re.split(r"\s+AND\s+", query.strip(), flags=re.IGNORECASE)
+        directions = [
+            condition.strip()
+            for condition in conditions
+            if condition.strip() in DIRECTION_BUCKETS
+        ]
+        ranges = [
+            condition
+            for condition in conditions
+            if condition.strip() not in DIRECTION_BUCKETS
+        ]
+        predicates = parse_range_query(" AND ".join(ranges)) if ranges else {}
+        return self.search(predicates, directions)
+
+    def describe(self, index: int) -> dict:
+        return {
+            name: float(value)
+            for name, value in zip(KINEMATIC_ATTRIBUTES, self.table[index])
+        }
+
+
+if __name__ == "__main__":
+    create_kinematic_attribute_table()
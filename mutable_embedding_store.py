@@ -0,0 +1,359 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+from embedding_store import EmbeddingStore, merge_top_k, normalize_rows, sort_top_k
+
+
+class MutableEmbeddingStore:
+    """Embedding index that supports appends, deletes and compaction.
+
+    The index is a directory of immutable segments, each an ordinary
+    ``EmbeddingStore`` plus the stable ids (``ids.npy``) and file names
+    (``names.json``) of its rows. ``manifest.json`` lists the live segments,
+    the tombstoned ids and a generation number:
+
+    - ``append`` writes a new segment with fresh ids,
+    - ``delete`` tombstones ids, their rows stay on disk until compaction,
+    - ``compact`` rewrites all live rows into one segment, keeping their ids.
+
+    Every change increments the generation and replaces the manifest
+    atomically. Readers call ``refresh`` (``search`` does so itself) and pick
+    up new generations without a restart. Segments dropped by a compaction
+    are listed as ``garbage_segments`` and only deleted by the next commit,
+    so readers that have just read the previous manifest can still open
+    them.
+    """
+
+    MANIFEST_FILE = "manifest.json"
+    IDS_FILE = "ids.npy"
+    NAMES_FILE = "names.json"
+
+    def __init__(self, directory: str = "datasets/trajectory_embedding_index"):
+        self.directory = directory
+        self.manifest_stat = None
+        self.generation = None
+        self.refresh()
+
+    @classmethod
+    def create(
+        cls,
+        directory: str,
+        source_path: str,
+        names: list,
+        dtype: str = "float32",
+    ):
+        """Creates an index whose first segment holds an existing encoder output.
+
+        Args:
+            directory (str): Directory of the new index.
+            source_path (str): ``.npy`` encoder outputs, e.g. encoder_output_a_mse.npy.
+            names (list): File name of every row, in row order.
+            dtype (str): Storage dtype of the segments.
+        """
+        os.makedirs(directory, exist_ok=True)
+        source = np.load(source_path, mmap_mode="r")
+        if len(source) != len(names):
+            raise ValueError(
+                f"{source_path} has {len(source)} rows but {len(names)} names were given"
+            )
+        manifest = {
+            "generation": 0,
+            "dtype": dtype,
+            "dim": int(source.shape[1]),
+            "next_id": 0,
+            "next_segment": 0,
+            "segments": [],
+            "tombstones": [],
+            "garbage_segments": [],
+        }
+        cls.write_manifest(directory, manifest)
+        store = cls(directory)
+        store.append(source, names)
+        return store
+
+    @classmethod
+    def write_manifest(cls, directory: str, manifest: dict):
+        path = os.path.join(directory, cls.MANIFEST_FILE)
+        with open(path + ".tmp", "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+        os.replace(path + ".tmp", path)
+
+    def refresh(self) -> bool:
+        """Reopens the index if another process committed a new generation.
+
+        Returns:
+            bool: Whether a new generation was loaded.
+        """
+        path = os.path.join(self.directory, self.MANIFEST_FILE)
+        stat = os.stat(path)
+        stat = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if stat == self.manifest_stat:
+            return False
+        with open(path) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.manifest_stat = stat
+        if manifest["generation"] == self.generation:
+            return False
+
+        self.manifest = manifest
+        self.generation = manifest["generation"]
+        self.dim = manifest["dim"]
+        self.segments = []
+        self.names = {}
+        tombstones = np.array(manifest["tombstones"], dtype=np.int64)
+        for segment in manifest["segments"]:
+            segment_directory = os.path.join(self.directory, segment)
+            ids = np.load(os.path.join(segment_directory, self.IDS_FILE))
+            with open(os.path.join(segment_directory, self.NAMES_FILE)) as names_file:
+                self.names.update(zip(ids.tolist(), json.load(names_file)))
+            self.segments.append(
+                {
+                    "store": EmbeddingStore(segment_directory),
+                    "ids": ids,
+                    "live": ~np.isin(ids, tombstones),
+                }
+            )
+        for index in manifest["tombstones"]:
+            self.names.pop(index, None)
+        return True
+
+    def __len__(self):
+        return sum(int(np.count_nonzero(segment["live"])) for segment in self.segments)
+
+    def version(self) -> tuple:
+        self.refresh()
+        return ((self.directory, self.generation),)
+
+    def dead_fraction(self) -> float:
+        total = sum(len(segment["ids"]) for segment in self.segments)
+        return 1 - len(self) / total if total else 0.0
+
+    def name_for_id(self, index: int) -> str:
+        return self.names[int(index)]
+
+    def ids_for_names(self, names) -> np.ndarray:
+        wanted = set(names)
+        return np.array(
+            [index for index, name in self.names.items() if name in wanted],
+            dtype=np.int64,
+        )
+
+    def append(self, embeddings: np.ndarray, names: list) -> np.ndarray:
+        """Adds rows as a new segment.
+
+        Returns:
+            np.ndarray: The stable ids assigned to the rows.
+        """
+        self.refresh()
+        if len(embeddings) == 0:
+            return np.empty(0, dtype=np.int64)
+        manifest = dict(self.manifest)
+        ids = np.arange(
+            manifest["next_id"], manifest["next_id"] + len(embeddings), dtype=np.int64
+        )
+        segment = f"segment_{manifest['next_segment']:06d}"
+        self.write_segment(segment, embeddings, ids, list(names))
+
+        manifest["segments"] = manifest["segments"] + [segment]
+        manifest["next_id"] += len(embeddings)
+        manifest["next_segment"] += 1
+        self.commit(manifest)
+        return ids
+
+    def delete(self, ids) -> int:
+        """Tombstones rows by id.
+
+        Returns:
+            int: Number of ids that were live before.
+        """
+        self.refresh()
+        tombstones = set(self.manifest["tombstones"])
+        new = {int(index) for index in ids if int(index) in self.names} - tombstones
+        if new:
+            manifest = dict(self.manifest)
+            manifest["tombstones"] = sorted(tombstones | new)
+            self.commit(manifest)
+        return len(new)
+
+    def compact(self, chunk_size: int = 65536):
+        """Rewrites all live rows into a single segment and drops the tombstones."""
+        self.refresh()
+        manifest = dict(self.manifest)
+        segment = f"segment_{manifest['next_segment']:06d}"
+
+        live_ids = np.concatenate(
+            [s["ids"][s["live"]] for s in self.segments] or [np.empty(0, np.int64)]
+        )
+        self.write_segment(
+            segment,
+            LiveRows(self.segments),
+            live_ids,
+            [self.names[index] for index in live_ids.tolist()],
+            chunk_size,
+        )
+
+        old_segments = manifest["segments"]
+        manifest["segments"] = [segment]
+        manifest["tombstones"] = []
+        manifest["next_segment"] += 1
+        self.commit(manifest, old_segments)
+
+    def compact_if_needed(self, max_dead_fraction: float = 0.2, max_segments: int = 16):
+        """Compacts once too many rows are tombstoned or too many segments exist.
+
+        Returns:
+            bool: Whether the index was compacted.
+        """
+        self.refresh()
+        if (
+            self.dead_fraction() > max_dead_fraction
+            or len(self.segments) > max_segments
+        ):
+            self.compact()
+            return True
+        return False
+
+    def sync(self, names: list, encode, batch_size: int = 4096) -> dict:
+        """Brings the index in line with a list of trajectory files.
+
+        Files that are no longer listed are tombstoned and files that are not
+        indexed yet are encoded and appended, so only the new trajectories
+        have to go through the encoder.
+
+        Args:
+            names (list): File names that should be in the index.
+            encode: Function mapping a list of file names to an ``(n, dim)`` array.
+            batch_size (int): Number of new files encoded and appended at once.
+
+        Returns:
+            dict: Number of appended and deleted rows and the new generation.
+        """
+        self.refresh()
+        wanted = set(names)
+        deleted = self.delete(
+            [index for index, name in self.names.items() if name not in wanted]
+        )
+        indexed = set(self.names.values())
+        new_names = [name for name in names if name not in indexed]
+        for start in range(0, len(new_names), batch_size):
+            batch = new_names[start : start + batch_size]
+            self.append(encode(batch), batch)
+        return {
+            "appended": len(new_names),
+            "deleted": deleted,
+            "generation": self.generation,
+        }
+
+    def write_segment(
+        self,
+        segment: str,
+        embeddings,
+        ids: np.ndarray,
+        names: list,
+        chunk_size: int = 65536,
+    ):
+        segment_directory = os.path.join(self.directory, segment)
+        EmbeddingStore.write(
+            segment_directory,
+            embeddings,
+            source_name=segment,
+            dtype=self.manifest["dtype"],
+            chunk_size=chunk_size,
+        )
+        np.save(os.path.join(segment_directory, self.IDS_FILE), ids)
+        with open(os.path.join(segment_directory, self.NAMES_FILE), "w") as names_file:
+            json.dump(names, names_file)
+
+    def commit(self, manifest: dict, retired_segments: list = ()):
+        """Writes the next generation of the manifest.
+
+        Segments retired by the previous commit are deleted now, one
+        generation after they left the manifest, and ``retired_segments``
+        become the new garbage.
+        """
+        garbage = self.manifest.get("garbage_segments", [])
+        manifest["garbage_segments"] = list(retired_segments)
+        manifest["generation"] = self.generation + 1
+        self.write_manifest(self.directory, manifest)
+        self.refresh()
+        for segment in garbage:
+            shutil.rmtree(os.path.join(self.directory, segment), ignore_errors=True)
+
+    def normalize_queries(self, queries) -> np.ndarray:
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        return normalize_rows(queries)
+
+    def normalize_query(self, query) -> np.ndarray:
+        return self.normalize_queries(query)[0]
+
+    def search(
+        self,
+        queries,
+        k: int,
+        chunk_size: int = 65536,
+        ids: np.ndarray = None,
+        mask: np.ndarray = None,
+    ):
+        """Top-k search over the live rows of all segments.
+
+        Same contract as ``EmbeddingStore.search``, except that ``ids``,
+        ``mask`` and the returned ids refer to the stable ids.
+        """
+        self.refresh()
+        queries = self.normalize_queries(queries)
+        all_scores, all_ids = [], []
+        for segment in self.segments:
+            live = segment["live"]
+            if ids is not None:
+                live = live & np.isin(segment["ids"], ids)
+            if mask is not None:
+                in_mask = segment["ids"] < len(mask)
+                in_mask[in_mask] = mask[segment["ids"][in_mask]]
+                live = live & in_mask
+            if not live.any():
+                # E.g. a segment whose rows are all tombstoned
+                continue
+            scores, positions = segment["store"].search(
+                queries, k=k, chunk_size=chunk_size, mask=live
+            )
+            all_scores.append(scores)
+            all_ids.append(segment["ids"][positions])
+
+        if not all_scores:
+            empty = np.empty((len(queries), 0))
+            return empty.astype(np.float32), empty.astype(np.int64)
+        scores, result_ids = merge_top_k(
+            np.concatenate(all_scores, axis=1), np.concatenate(all_ids, axis=1), k
+        )
+        return sort_top_k(scores, result_ids)
+
+
+class LiveRows:
+    """Live rows of several segments, sliceable like one array while compacting."""
+
+    def __init__(self, segments: list):
+        self.segments = segments
+        self.shape = (
+            sum(int(np.count_nonzero(s["live"])) for s in segments),
+            segments[0]["store"].dim if segments else 0,
+        )
+        self.positions = [np.flatnonzero(s["live"]) for s in segments]
+        self.offsets = np.concatenate(([0], np.cumsum([len(p) for p in self.positions])))
+
+    def __getitem__(self, item):
+        start = item.start or 0
+        stop = min(self.shape[0] if item.stop is None else item.stop, self.shape[0])
+        parts = []
+        for segment, positions, offset in zip(
+            self.segments, self.positions, self.offsets
+        ):
+            lower, upper = max(start, offset), min(stop, offset + len(positions))
+            if lower < upper:
+                rows = positions[lower - offset : upper - offset]
+                parts.append(segment["store"].embeddings[rows])
+        return np.concatenate(parts)
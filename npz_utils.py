@@ -55,12 +55,14 @@ def get_random_npz_trajectory():
 
 def list_vehicle_files_absolute(
     directory="/storage_local/fzi_datasets_tmp/waymo_open_motion_dataset/unzipped/train-2e6/",
+    prefix="vehicle_a",
 ):
     """
     Listet alle Dateien in einem angegebenen Verzeichnis auf, die mit 'vehicle' beginnen und gibt ihre absoluten Pfade zurück.
 
     Args:
     directory (str): Der Pfad zum Verzeichnis, in dem gesucht werden soll.
+    prefix (str): Der Präfix der Dateinamen, z.B. 'vehicle_a' oder 'vehicle_' für alle Teilmengen.
 
     Returns:
     list: Eine Liste von absoluten Pfaden zu Dateien, die mit 'vehicle' beginnen.
@@ -70,7 +72,7 @@ def list_vehicle_files_absolute(
     for filename in os.listdir(directory):
         # if counter == 50000:
         #     break
-        if filename.startswith("vehicle_a"):
+        if filename.startswith(prefix):
             absolute_path = os.path.abspath(os.path.join(directory, filename))
             vehicle_files.append(absolute_path)
             counter += 1
@@ -0,0 +1,236 @@
+import os
+import time
+
+import numpy as np
+
+from embedding_store import EmbeddingStore
+
+PROJECTION_METHODS = ("pca", "random")
+
+
+class ProjectedEmbeddingStore:
+    """Retrieval over the embedding store projected to a few dimensions.
+
+    The corpus rows are multiplied with a ``(dim, d)`` projection, normalized
+    again and stored as an ordinary ``EmbeddingStore`` in ``directory``, so a
+    scan reads ``d / dim`` of the bytes of the full store. Queries are
+    projected on the fly. With ``rerank_factor`` the projected search returns
+    ``k * rerank_factor`` candidates that are re-ranked exactly against the
+    full store.
+
+    "pca" uses the leading eigenvectors of the uncentered second moment
+    ``X^T X`` of the normalized rows, which preserves the inner products the
+    cosine search depends on. "random" is a Gaussian random projection.
+    """
+
+    PROJECTION_FILE = "projection.npy"
+
+    def __init__(
+        self,
+        directory: str,
+        full_store: EmbeddingStore = None,
+        rerank_factor: int = None,
+    ):
+        """
+        Args:
+            directory (str): Directory of the projected store.
+            full_store (EmbeddingStore): Store the projection was learned from,
+                needed for re-ranking.
+            rerank_factor (int): If given, the projected search keeps
+                ``k * rerank_factor`` candidates and re-ranks them in full dimension.
+        """
+        if rerank_factor is not None and full_store is None:
+            raise ValueError("Re-ranking needs the full dimension store")
+        self.directory = directory
+        self.projection = np.load(os.path.join(directory, self.PROJECTION_FILE))
+        self.store = EmbeddingStore(directory)
+        self.full_store = full_store
+        self.rerank_factor = rerank_factor
+        self.dim = self.store.dim
+
+    @classmethod
+    def build(
+        cls,
+        full_store: EmbeddingStore,
+        directory: str,
+        dim: int,
+        method: str = "pca",
+        dtype: str = "float32",
+        chunk_size: int = 65536,
+        seed: int = 0,
+    ):
+        """Learns a projection from the full store and writes the projected corpus.
+
+        Args:
+            full_store (EmbeddingStore): Store with the full dimension rows.
+            directory (str): Directory the projected store is written to.
+            dim (int): Target dimension, e.g. 64, 128 or 256.
+            method (str): "pca" or "random".
+            dtype (str): Storage dtype of the projected rows.
+            chunk_size (int): Number of rows read at once.
+            seed (int): Seed of the random projection.
+        """
+        if method == "pca":
+            second_moment = np.zeros((full_store.dim, full_store.dim), dtype=np.float64)
+            for start in range(0, len(full_store), chunk_size):
+                chunk = full_store.embeddings[start : start + chunk_size].astype(
+                    np.float32
+                )
+                second_moment += chunk.T @ chunk
+            _, eigenvectors = np.linalg.eigh(second_moment)
+            # eigh sorts the eigenvalues ascending
+            projection = eigenvectors[:, ::-1][:, :dim].astype(np.float32)
+        elif method == "random":
+            rng = np.random.default_rng(seed)
+            projection = rng.standard_normal((full_store.dim, dim)).astype(np.float32)
+            projection /= np.sqrt(dim)
+        else:
+            raise ValueError(f"Unknown projection method: {method}")
+
+        EmbeddingStore.write(
+            directory,
+            ProjectedRows(full_store.embeddings, projection),
+            source_name=f"{method} projection to {dim} of {full_store.directory}",
+            dtype=dtype,
+            chunk_size=chunk_size,
+        )
+        np.save(os.path.join(directory, cls.PROJECTION_FILE), projection)
+        return cls(directory, full_store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def version(self) -> tuple:
+        return self.store.version()
+
+    def nbytes(self) -> int:
+        return self.store.embeddings.nbytes + self.projection.nbytes
+
+    def project(self, queries) -> np.ndarray:
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        return queries @ self.projection
+
+    def normalize_queries(self, queries) -> np.ndarray:
+        return self.store.normalize_queries(self.project(queries))
+
+    def normalize_query(self, query) -> np.ndarray:
+        return self.normalize_queries(query)[0]
+
+    def score(self, query, chunk_size: int = 65536) -> np.ndarray:
+        """Cosine similarity in the projected space against every row."""
+        return self.store.score(self.project(query)[0], chunk_size)
+
+    def search(
+        self,
+        queries,
+        k: int,
+        chunk_size: int = 65536,
+        ids: np.ndarray = None,
+        mask: np.ndarray = None,
+    ):
+        """Same contract as ``EmbeddingStore.search``, queries in full dimension."""
+        candidate_k = k if self.rerank_factor is None else k * self.rerank_factor
+        scores, candidates = self.store.search(
+            self.project(queries), candidate_k, chunk_size, ids, mask
+        )
+        if self.rerank_factor is None:
+            return scores, candidates
+        return self.full_store.rerank(queries, candidates, k)
+
+
+class ProjectedRows:
+    """Rows of a matrix multiplied with a projection, sliceable while writing."""
+
+    def __init__(self, embeddings: np.ndarray, projection: np.ndarray):
+        self.embeddings = embeddings
+        self.projection = projection
+        self.shape = (embeddings.shape[0], projection.shape[1])
+
+    def __getitem__(self, item):
+        return self.embeddings[item].astype(np.float32) @ self.projection
+
+
+def benchmark_projected_retrieval(
+    retriever,
+    directory: str = "datasets/trajectory_projections",
+    dims=(64, 128, 256),
+    methods=PROJECTION_METHODS,
+    rerank_factor: int = 2,
+):
+    """Compares per-bucket accuracy, latency and memory of projected retrieval.
+
+    The accuracy is the one of ``benchmark_indirect_trajectory_retrieval``:
+    the fraction of the top-k trajectories that lie in the synonym's bucket,
+    with k the size of that bucket. Every projection is evaluated with and
+    without full dimension re-ranking.
+
+    Args:
+        retriever (TRAGRetriever): Retriever whose embedding store is projected.
+        directory (str): Projected stores are kept at ``{directory}/{method}_{d}``.
+        dims: Target dimensions.
+        methods: Projection methods.
+        rerank_factor (int): Candidate factor of the re-ranking variant.
+
+    Returns:
+        dict: Mean accuracy per bucket, latency and memory of every variant.
+    """
+    full_store = retriever.embedding_store
+
+    def evaluate(store, memory):
+        start = time.perf_counter()
+        accuracies = retriever.benchmark_indirect_trajectory_retrieval(
+            store, verbose=False
+        )
+        latency = (time.perf_counter() - start) / len(accuracies)
+        buckets = {}
+        for key, accuracy in accuracies.items():
+            direction = retriever.index_direction_mapping[
+                retriever.synonym_bucket_mapping[key]
+            ]
+            buckets.setdefault(direction, []).append(accuracy)
+        return {
+            "mean_accuracy": float(np.mean(list(accuracies.values()))),
+            "bucket_accuracy": {
+                direction: float(np.mean(values))
+                for direction, values in buckets.items()
+            },
+            "latency_ms": latency * 1000,
+            "memory_mb": memory / 2**20,
+        }
+
+    results = {"full": evaluate(full_store, full_store.embeddings.nbytes)}
+    for method in methods:
+        for dim in dims:
+            store_directory = os.path.join(directory, f"{method}_{dim}")
+            if os.path.exists(
+                os.path.join(store_directory, ProjectedEmbeddingStore.PROJECTION_FILE)
+            ):
+                store = ProjectedEmbeddingStore(store_directory, full_store)
+            else:
+                print(f"Building {method} projection to {dim} dimensions...")
+                store = ProjectedEmbeddingStore.build(
+                    full_store, store_directory, dim, method
+                )
+                print("Finished")
+            results[f"{method}_{dim}"] = evaluate(store, store.nbytes())
+            store.rerank_factor = rerank_factor
+            results[f"{method}_{dim}_rerank"] = evaluate(store, store.nbytes())
+
+    for name, result in results.items():
+        print(
+            f"{name}: accuracy {result['mean_accuracy']:.4f}, "
+            f"{result['latency_ms']:.1f} ms/query, {result['memory_mb']:.1f} MiB"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    from retrieval_evaluation import write_report
+    from trag_retriever import TRAGRetriever
+
+    write_report(
+        benchmark_projected_retrieval(TRAGRetriever()),
+        "output/projected_retrieval_report.json",
+    )
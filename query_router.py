@@ -0,0 +1,145 @@
+import json
+import threading
+from collections import deque
+
+import numpy as np
+
+from retrieval_cache import normalize_query_text
+from retrieval_evaluation import latency_percentiles
+from synonyms import BUCKET_SYNONYMS, SCENARIO_SYNONYMS
+
+ROUTING_PATHS = ("cache", "lexical", "embedding", "error")
+
+
+class QueryRouter:
+    """Resolves known query phrases without running the UAE model.
+
+    Every synonym phrase, and every direction bucket name, is stored under its
+    normalized text together with its cached UAE embedding and the direction
+    bucket or scenario feature it stands for. A query whose normalized text
+    is such a phrase gets the cached embedding from a hash lookup; all other
+    queries fall back to encoding. Phrases that normalize to the same text
+    but belong to different targets are left out, so a lexical hit is never
+    ambiguous.
+    """
+
+    def __init__(
+        self,
+        bucket_embedding_cache: dict,
+        synonym_embedding_cache: dict,
+        scenario_synonym_embedding_cache: dict,
+    ):
+        self.phrases = {}
+        ambiguous = set()
+
+        def add(phrase, embedding, target):
+            key = normalize_phrase(phrase)
+            if key in self.phrases and self.phrases[key]["target"] != target:
+                ambiguous.add(key)
+            self.phrases[key] = {
+                "embedding": np.asarray(embedding, dtype=np.float32).reshape(-1),
+                "target": target,
+            }
+
+        for direction, synonyms in BUCKET_SYNONYMS.items():
+            add(direction, bucket_embedding_cache[direction], ("direction", direction))
+            for synonym in synonyms:
+                add(synonym, synonym_embedding_cache[synonym], ("direction", direction))
+        for feature, synonyms in SCENARIO_SYNONYMS.items():
+            for synonym in synonyms:
+                add(
+                    synonym,
+                    scenario_synonym_embedding_cache[synonym],
+                    ("feature", feature),
+                )
+        for key in ambiguous:
+            del self.phrases[key]
+
+        self.lookups = 0
+        self.hits = 0
+        self.latencies = {path: deque(maxlen=1000) for path in ROUTING_PATHS}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_files(
+        cls,
+        bucket_embedding_cache_path: str = "datasets/uae_buckets_cache.json",
+        synonym_embedding_cache_path: str = "datasets/synonyms_uae_cache.json",
+        scenario_synonym_embedding_cache_path: str = "datasets/scenario_synonym_embedding_cache.json",
+    ):
+        caches = []
+        for path in (
+            bucket_embedding_cache_path,
+            synonym_embedding_cache_path,
+            scenario_synonym_embedding_cache_path,
+        ):
+            with open(path) as cache:
+                caches.append(json.load(cache))
+        return cls(*caches)
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def route(self, text: str):
+        """Looks up a query.
+
+        Returns:
+            dict: ``{"embedding", "target"}`` with target ``("direction", bucket)``
+            or ``("feature", scenario feature)``, or None if the phrase is unknown.
+        """
+        entry = self.phrases.get(normalize_phrase(text))
+        with self.lock:
+            self.lookups += 1
+            if entry is not None:
+                self.hits += 1
+        return entry
+
+    def encode(self, texts: list, encode_batch) -> tuple:
+        """Embeds texts, encoding only the ones without a lexical hit.
+
+        Args:
+            texts (list): Query texts.
+            encode_batch: Function encoding a list of texts, e.g.
+                ``encode_batch_with_uae``.
+
+        Returns:
+            tuple: ``(embeddings, paths)`` with embeddings of shape
+            ``(len(texts), dim)`` and the path ("lexical" or "embedding") of
+            every text.
+        """
+        entries = [self.route(text) for text in texts]
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        encoded = encode_batch([texts[i] for i in missing]) if missing else []
+
+        embeddings = [None] * len(texts)
+        for i, entry in enumerate(entries):
+            if entry is not None:
+                embeddings[i] = entry["embedding"]
+        for row, i in enumerate(missing):
+            embeddings[i] = np.asarray(encoded[row], dtype=np.float32).reshape(-1)
+        paths = ["lexical" if entry is not None else "embedding" for entry in entries]
+        return np.stack(embeddings), paths
+
+    def record(self, path: str, seconds: float):
+        """Records the end-to-end latency of a query answered through ``path``."""
+        with self.lock:
+            self.latencies[path].append(seconds)
+
+    def stats(self) -> dict:
+        with self.lock:
+            output = {
+                "phrases": len(self.phrases),
+                "lookups": self.lookups,
+                "lexical_hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            }
+            latencies = {path: list(values) for path, values in self.latencies.items()}
+        for path, values in latencies.items():
+            if values:
+                output[f"{path}_latency"] = latency_percentiles(values)
+        return output
+
+
+def normalize_phrase(text: str) -> str:
+    """Normalizes query text and treats hyphens and underscores as spaces."""
+    return normalize_query_text(text.replace("-", " ").replace("_", " "))
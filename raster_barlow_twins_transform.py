@@ -64,8 +64,22 @@ class BarlowTwinsTransform:
             ]
         )
 
+        # Scenario rasters have more channels than a PIL image, only the
+        # geometric augmentations apply to them, jointly on all channels
+        self.raster_transform = transforms.Compose(
+            [
+                transforms.RandomRotation(10),
+                transforms.RandomResizedCrop(
+                    self.input_height, scale=(0.6, 1.0), antialias=True
+                ),
+            ]
+        )
+
     def __call__(self, sample):
+        sample = torch.from_numpy(sample)
+        if sample.ndim == 3 and sample.shape[0] > 4:
+            return self.raster_transform(sample), self.raster_transform(sample)
         return (
-            self.transform(torch.from_numpy(sample)),
-            self.transform(torch.from_numpy(sample)),
+            self.transform(sample),
+            self.transform(sample),
         )
@@ -0,0 +1,276 @@
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm import tqdm
+
+from npz_utils import list_vehicle_files_absolute
+
+
+def encode_raster(raster: np.ndarray):
+    """Encodes a ``(C, H, W)`` raster channel by channel.
+
+    A channel whose pixels are all 0 or one value v (occupancy maps drawn
+    with 255) is stored as one bit per pixel plus v, every other channel as
+    uint8. The payload holds the bit-packed channels first, then the uint8
+    channels, both in channel order.
+
+    Args:
+        raster (np.ndarray): Raster with integer values in 0..255.
+
+    Returns:
+        tuple: ``(payload, packed, values)``, the uint8 payload, a ``(C,)``
+        mask of the bit-packed channels and their ``(C,)`` uint8 values.
+    """
+    if raster.dtype != np.uint8:
+        converted = raster.astype(np.uint8)
+        if not np.array_equal(converted, raster):
+            raise ValueError("Raster values are not representable as uint8")
+        raster = converted
+    flat = raster.reshape(raster.shape[0], -1)
+    values = flat.max(axis=1)
+    packed = np.all((flat == 0) | (flat == values[:, None]), axis=1)
+    bits = np.packbits(flat[packed] != 0, axis=1)
+    payload = np.concatenate((bits.reshape(-1), flat[~packed].reshape(-1)))
+    return payload, packed, values
+
+
+def decode_raster(
+    payload: np.ndarray, packed: np.ndarray, values: np.ndarray, shape: tuple
+) -> np.ndarray:
+    """Inverse of ``encode_raster``, returns the uint8 ``(C, H, W)`` raster."""
+    num_channels, height, width = shape
+    num_packed = int(np.count_nonzero(packed))
+    bytes_per_channel = (height * width + 7) // 8
+    num_bit_bytes = num_packed * bytes_per_channel
+
+    raster = np.empty(shape, dtype=np.uint8)
+    bits = np.unpackbits(
+        payload[:num_bit_bytes].reshape(num_packed, bytes_per_channel),
+        axis=1,
+        count=height * width,
+    )
+    raster[packed] = (bits * values[packed][:, None]).reshape(num_packed, height, width)
+    raster[~packed] = payload[num_bit_bytes:].reshape(-1, height, width)
+    return raster
+
+
+def encode_raster_file(path: str):
+    """Encodes the raster of an npz file and checks that it decodes exactly.
+
+    Returns:
+        tuple: ``encode_raster`` output and the ``(C, H, W)`` shape, or None
+        if the file cannot be read or its raster cannot be stored exactly.
+    """
+    try:
+        with np.load(path) as data:
+            raster = data["raster"]
+    except (OSError, KeyError, ValueError):
+        return None
+    # npz rasters are stored channels last
+    raster = np.ascontiguousarray(raster.transpose(2, 0, 1))
+    try:
+        payload, packed, values = encode_raster(raster)
+        decoded = decode_raster(payload, packed, values, raster.shape)
+        if not np.array_equal(decoded, raster):
+            raise ValueError("Raster does not survive the round trip")
+    except ValueError as error:
+        print(f"Skipping {path}: {error}")
+        return None
+    return payload, packed, values, raster.shape
+
+
+class RasterStore:
+    """Read-only store of encoded scenario rasters, see ``encode_raster``.
+
+    The store is a directory with the concatenated payloads in
+    ``rasters.bin``, the payload offsets of every raster, the per-channel
+    packing masks and values, and a ``meta.json`` with the raster shape.
+    Rasters follow the order of the converted file list, missing files have
+    an empty payload and decode to None. The payloads are memory-mapped, so
+    DataLoader workers share the page cache.
+    """
+
+    DATA_FILE = "rasters.bin"
+    OFFSETS_FILE = "offsets.npy"
+    PACKED_FILE = "packed.npy"
+    VALUES_FILE = "values.npy"
+    META_FILE = "meta.json"
+
+    def __init__(self, directory: str = "datasets/raster_store"):
+        self.directory = directory
+        self.open()
+
+    def open(self):
+        with open(os.path.join(self.directory, self.META_FILE)) as meta_file:
+            self.meta = json.load(meta_file)
+        self.shape = tuple(self.meta["shape"])
+        self.data = np.memmap(
+            os.path.join(self.directory, self.DATA_FILE), dtype=np.uint8, mode="r"
+        )
+        self.offsets = np.load(os.path.join(self.directory, self.OFFSETS_FILE))
+        self.packed = np.load(os.path.join(self.directory, self.PACKED_FILE))
+        self.values = np.load(os.path.join(self.directory, self.VALUES_FILE))
+
+    def __getstate__(self):
+        # Pickling the memory map would copy the whole store into every worker
+        return {"directory": self.directory}
+
+    def __setstate__(self, state):
+        self.directory = state["directory"]
+        self.open()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        start, end = self.offsets[index], self.offsets[index + 1]
+        if start == end:
+            return None
+        return decode_raster(
+            np.asarray(self.data[start:end]),
+            self.packed[index],
+            self.values[index],
+            self.shape,
+        )
+
+    @property
+    def compression_ratio(self) -> float:
+        raw = np.prod(self.shape) * np.count_nonzero(np.diff(self.offsets))
+        return float(raw / max(1, self.offsets[-1]))
+
+    @classmethod
+    def create(
+        cls,
+        vehicle_list: list = None,
+        directory: str = "datasets/raster_store",
+        num_workers: int = 8,
+    ):
+        """Encodes the rasters of an npz corpus into a new store.
+
+        Every raster is decoded again right after encoding and compared with
+        the original, so every stored raster is exact. Files that cannot be
+        read or stored exactly are skipped and decode to None.
+
+        Args:
+            vehicle_list (list): npz files, by default the vehicle_a files in
+                the order of ``list_vehicle_files_absolute``.
+            directory (str): Directory of the store.
+            num_workers (int): Processes reading and encoding npz files.
+        """
+        if vehicle_list is None:
+            vehicle_list = list_vehicle_files_absolute()
+        os.makedirs(directory, exist_ok=True)
+
+        offsets = np.zeros(len(vehicle_list) + 1, dtype=np.int64)
+        num_skipped = 0
+        packed = None
+        values = None
+        shape = None
+        with open(os.path.join(directory, cls.DATA_FILE), "wb") as data_file:
+            with Pool(num_workers) as pool:
+                for index, encoded in enumerate(
+                    tqdm(
+                        pool.imap(encode_raster_file, vehicle_list, chunksize=16),
+                        total=len(vehicle_list),
+                    )
+                ):
+                    size = 0
+                    if encoded is None:
+                        num_skipped += 1
+                    else:
+                        payload, raster_packed, raster_values, shape = encoded
+                        if packed is None:
+                            num_channels = len(raster_packed)
+                            packed = np.zeros(
+                                (len(vehicle_list), num_channels), dtype=bool
+                            )
+                            values = np.zeros(
+                                (len(vehicle_list), num_channels), dtype=np.uint8
+                            )
+                        packed[index] = raster_packed
+                        values[index] = raster_values
+                        data_file.write(payload.tobytes())
+                        size = len(payload)
+                    offsets[index + 1] = offsets[index] + size
+
+        if shape is None:
+            raise ValueError("No raster could be read")
+        if num_skipped:
+            print(f"Skipped {num_skipped} files")
+        np.save(os.path.join(directory, cls.OFFSETS_FILE), offsets)
+        np.save(os.path.join(directory, cls.PACKED_FILE), packed)
+        np.save(os.path.join(directory, cls.VALUES_FILE), values)
+        with open(os.path.join(directory, cls.META_FILE), "w") as meta_file:
+            json.dump(
+                {
+                    "count": len(vehicle_list),
+                    "shape": list(shape),
+                    "files": [path.split("/")[-1] for path in vehicle_list],
+                },
+                meta_file,
+            )
+        store = cls(directory)
+        print(f"Finished, compression ratio {store.compression_ratio:.1f}")
+        return store
+
+
+def verify_raster_store(
+    store: RasterStore, vehicle_list: list = None, num_samples: int = 100
+) -> bool:
+    """Compares random rasters of the store with the npz files they came from."""
+    if vehicle_list is None:
+        vehicle_list = list_vehicle_files_absolute()
+    rng = np.random.default_rng(0)
+    for index in rng.choice(len(store), min(num_samples, len(store)), replace=False):
+        raster = store[index]
+        if raster is None:
+            continue
+        with np.load(vehicle_list[index]) as data:
+            original = data["raster"].transpose(2, 0, 1)
+        if not np.array_equal(raster, original):
+            print(f"Raster {index} ({vehicle_list[index]}) differs")
+            return False
+    print("All sampled rasters are exact")
+    return True
+
+
+def benchmark_raster_loading(
+    store: RasterStore, vehicle_list: list = None, num_samples: int = 200
+):
+    """Prints rasters/s of loading from the npz files and from the store."""
+    if vehicle_list is None:
+        vehicle_list = list_vehicle_files_absolute()
+    # Only rasters that were converted
+    indices = np.flatnonzero(np.diff(store.offsets))
+    indices = np.sort(
+        np.random.default_rng(0).choice(
+            indices, min(num_samples, len(indices)), replace=False
+        )
+    )
+
+    start = time.perf_counter()
+    for index in indices:
+        with np.load(vehicle_list[index]) as data:
+            data["raster"].transpose(2, 0, 1).astype(np.float32)
+    npz_rate = len(indices) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for index in indices:
+        store[index]
+    store_rate = len(indices) / (time.perf_counter() - start)
+
+    print(
+        f"npz: {npz_rate:.1f} rasters/s, store: {store_rate:.1f} rasters/s "
+        f"({store_rate / npz_rate:.1f}x), "
+        f"compression ratio {store.compression_ratio:.1f}"
+    )
+    return npz_rate, store_rate
+
+
+if __name__ == "__main__":
+    store = RasterStore.create()
+    verify_raster_store(store)
+    benchmark_raster_loading(store)
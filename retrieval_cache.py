@@ -0,0 +1,83 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache:
+    """Bounded LRU cache for retrieval results with a time-to-live.
+
+    Keys are built with ``make_key`` from the normalized query text, the
+    retrieval mode, k, the filter and the index version. Results computed
+    against an older embedding matrix or older labels therefore never match
+    again, and the cache drops all entries once it sees a new version.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def make_key(self, text: str, mode: str, k: int, filter_key=(), version=()):
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+        return (normalize_query_text(text), mode, int(k), filter_key, version)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+                if entry is not None:
+                    del self.entries[key]
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def normalize_query_text(text: str) -> str:
+    """Lowercases, strips punctuation at the ends and collapses whitespace."""
+    return " ".join(re.sub(r"^\W+|\W+$", "", text.lower()).split())
+
+
+def file_version(*paths) -> tuple:
+    """Identifies the current state of files by their modification time and size."""
+    version = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            version.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(version)
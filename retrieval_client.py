@@ -0,0 +1,58 @@
+import json
+import urllib.error
+import urllib.request
+
+
+class RetrievalClient:
+    """Thin client for the retrieval server started with retrieval_server.py."""
+
+    def __init__(self, url: str = "http://127.0.0.1:8765", timeout: float = 30.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def is_running(self) -> bool:
+        try:
+            return self.health()["status"] == "ok"
+        except (urllib.error.URLError, OSError, ValueError):
+            return False
+
+    def health(self) -> dict:
+        return self.get("/health", timeout=1.0)
+
+    def metrics(self) -> dict:
+        return self.get("/metrics")
+
+    def retrieve(self, query: str, mode: str = "trajectory", k: int = 10) -> dict:
+        """Returns the top-k matches as a dict with values, indices and vehicles.
+
+        Raises:
+            RuntimeError: With the error message of the server if it rejected
+                or failed the request.
+        """
+        body = json.dumps({"query": query, "mode": mode, "k": k}).encode()
+        request = urllib.request.Request(
+            f"{self.url}/retrieve",
+            data=body,
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as error:
+            raise RuntimeError(
+                f"Retrieval server error {error.code}: {self.error_message(error)}"
+            ) from error
+
+    @staticmethod
+    def error_message(error: urllib.error.HTTPError) -> str:
+        """The "error" field of the JSON body the server sends with a failure."""
+        try:
+            return json.loads(error.read())["error"]
+        except (ValueError, KeyError, TypeError):
+            return error.reason
+
+    def get(self, path: str, timeout: float = None) -> dict:
+        with urllib.request.urlopen(
+            f"{self.url}{path}", timeout=timeout or self.timeout
+        ) as response:
+            return json.loads(response.read())
@@ -0,0 +1,194 @@
+import json
+import time
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+
+def ranking_metrics(relevance: np.ndarray, ks=(1, 10, 100, 1000)) -> dict:
+    """Computes retrieval metrics for one ranked list.
+
+    All metrics are derived from cumulative sums over the ranked relevance
+    vector, so no Python loop runs over the corpus. The number of relevant
+    items is taken from the relevance vector itself.
+
+    Args:
+        relevance (np.ndarray): Boolean relevance of every corpus item in
+            ranked order (best match first).
+        ks (tuple): Cut-offs for precision@k and recall@k.
+
+    Returns:
+        dict: AUC, average precision, R-precision and precision/recall@k.
+        Metrics that are undefined because there are no relevant (or, for
+        the AUC, no irrelevant) items are None. Cut-offs beyond the end of
+        the ranking are evaluated on the whole ranking.
+    """
+    relevance = np.asarray(relevance, dtype=bool)
+    num_relevant = int(np.count_nonzero(relevance))
+    num_irrelevant = relevance.size - num_relevant
+
+    true_positives = np.cumsum(relevance)
+    ranks = np.arange(1, relevance.size + 1)
+
+    if num_relevant and num_irrelevant:
+        # Each irrelevant item is a step right at the current true positive rate
+        auc = float(np.mean(true_positives[~relevance]) / num_relevant)
+    else:
+        auc = None
+
+    if num_relevant:
+        average_precision = float(
+            np.sum(true_positives[relevance] / ranks[relevance]) / num_relevant
+        )
+        r_precision = float(true_positives[num_relevant - 1] / num_relevant)
+    else:
+        average_precision = None
+        r_precision = None
+
+    metrics = {
+        "num_relevant": num_relevant,
+        "auc": auc,
+        "average_precision": average_precision,
+        "r_precision": r_precision,
+    }
+    for k in ks:
+        # Keys keep the requested k, a shorter ranking is cut at its end
+        cut = min(k, relevance.size)
+        if cut == 0:
+            metrics[f"precision@{k}"] = None
+            metrics[f"recall@{k}"] = None
+            continue
+        metrics[f"precision@{k}"] = float(true_positives[cut - 1] / cut)
+        metrics[f"recall@{k}"] = (
+            float(true_positives[cut - 1] / num_relevant) if num_relevant else None
+        )
+    return metrics
+
+
+def roc_curve_from_ranking(relevance: np.ndarray):
+    """Returns (true positive rates, false positive rates) of a ranked list.
+
+    Walking down the ranking, each relevant item moves the curve up and each
+    irrelevant item moves it right; both are cumulative sums.
+    """
+    relevance = np.asarray(relevance, dtype=bool)
+    tpr = np.concatenate(([0.0], np.cumsum(relevance) / np.count_nonzero(relevance)))
+    fpr = np.concatenate(
+        ([0.0], np.cumsum(~relevance) / np.count_nonzero(~relevance))
+    )
+    return tpr, fpr
+
+
+def evaluate_retrieval(
+    query_embeddings: dict,
+    query_groups: dict,
+    relevance_masks: dict,
+    score_fn,
+    ks=(1, 10, 100, 1000),
+    plot_folder: str = None,
+) -> dict:
+    """Evaluates a retrieval function over a set of labelled queries.
+
+    Works for direction retrieval (groups are buckets, masks compare the
+    direction labels) as well as for scenario feature retrieval (groups are
+    features, masks are the feature columns).
+
+    Args:
+        query_embeddings (dict): Query name to query embedding.
+        query_groups (dict): Query name to the group (bucket or feature) it targets.
+        relevance_masks (dict): Group to a boolean mask over the corpus.
+        score_fn: Callable mapping a query embedding to similarities over the corpus.
+        ks (tuple): Cut-offs for precision@k and recall@k.
+        plot_folder (str): If given, a ROC curve per query is saved there.
+
+    Returns:
+        dict: Per-query metrics, per-group mean/std and query latency percentiles.
+        The latency covers ``score_fn`` only, not the full ranking used for
+        the metrics.
+    """
+    per_query = {}
+    latencies = []
+    for name, embedding in query_embeddings.items():
+        start = time.perf_counter()
+        similarities = score_fn(embedding)
+        latencies.append(time.perf_counter() - start)
+        ranking = np.argsort(-similarities, kind="stable")
+
+        relevance = relevance_masks[query_groups[name]][ranking]
+        per_query[name] = {
+            "group": query_groups[name],
+            **ranking_metrics(relevance, ks),
+        }
+
+        if plot_folder is not None and per_query[name]["auc"] is not None:
+            tpr, fpr = roc_curve_from_ranking(relevance)
+            plot_roc_curve(
+                fpr, tpr, per_query[name]["auc"], name, f"{plot_folder}/roc_{name}.png"
+            )
+
+    return {
+        "queries": per_query,
+        "groups": summarize_by_group(per_query),
+        "latency": latency_percentiles(latencies),
+    }
+
+
+def summarize_by_group(per_query: dict) -> dict:
+    groups = {}
+    for metrics in per_query.values():
+        groups.setdefault(str(metrics["group"]), []).append(metrics)
+
+    summary = {}
+    for group, entries in groups.items():
+        summary[group] = {"num_queries": len(entries)}
+        for metric in entries[0]:
+            if metric in ("group", "num_relevant"):
+                continue
+            # Queries for which the metric is undefined are left out
+            values = np.array(
+                [entry[metric] for entry in entries if entry[metric] is not None]
+            )
+            summary[group][metric] = {
+                "mean": float(np.mean(values)) if values.size else None,
+                "std": float(np.std(values)) if values.size else None,
+            }
+        summary[group]["num_relevant"] = entries[0]["num_relevant"]
+    return summary
+
+
+def latency_percentiles(latencies, percentiles=(50, 90, 99)) -> dict:
+    latencies_ms = np.array(latencies) * 1000
+    output = {"mean_ms": float(latencies_ms.mean())}
+    for percentile in percentiles:
+        output[f"p{percentile}_ms"] = float(np.percentile(latencies_ms, percentile))
+    return output
+
+
+def plot_roc_curve(fpr, tpr, auc, title, path):
+    plt.figure()
+    plt.plot(fpr, tpr, color="darkorange", lw=2, label="ROC curve (area = %0.2f)" % auc)
+    plt.plot([0, 1], [0, 1], color="navy", lw=2, linestyle="--")
+    plt.xlim([0.0, 1.0])
+    plt.ylim([0.0, 1.05])
+    plt.xlabel("False Positive Rate")
+    plt.ylabel("True Positive Rate")
+    plt.title(f"Receiver Operating Characteristic ({title})")
+    plt.legend(loc="lower right")
+    plt.savefig(path)
+    plt.close()
+
+
+def finite_or_none(value):
+    """Replaces NaN and infinite floats, which strict JSON does not allow, by None."""
+    if isinstance(value, dict):
+        return {key: finite_or_none(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [finite_or_none(item) for item in value]
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def write_report(report: dict, path: str):
+    with open(path, "w") as report_file:
+        json.dump(finite_or_none(report), report_file, indent=4, allow_nan=False)
@@ -0,0 +1,247 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from retrieval_evaluation import latency_percentiles
+from trag_retriever import TRAGRetriever
+from uae_explore import encode_batch_with_uae, load_uae_model
+
+# Largest number of results per request
+MAX_K = 1000
+RETRIEVAL_MODES = ("trajectory", "scenario")
+
+
+class PendingRequest:
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """Collects concurrently submitted requests into batches.
+
+    A single worker thread takes the first waiting request, then keeps
+    collecting until either ``max_batch_size`` requests are waiting or
+    ``max_wait_ms`` have passed, and hands the whole batch to ``handle_batch``.
+    """
+
+    def __init__(self, handle_batch, max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        self.handle_batch = handle_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.batch_sizes = deque(maxlen=1000)
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, item):
+        request = PendingRequest(item)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.batch_sizes.append(len(batch))
+            try:
+                results = self.handle_batch([request.item for request in batch])
+                for request, result in zip(batch, results):
+                    request.result = result
+            except Exception as error:
+                for request in batch:
+                    request.error = error
+            finally:
+                for request in batch:
+                    request.done.set()
+
+
+class RetrievalService:
+    """Keeps the retriever, the embedding stores and the UAE model in memory.
+
+    Text queries of all concurrent clients that the query router does not
+    know are encoded together in one UAE forward pass, and all queries are
+    scored with one batched search per retrieval mode.
+    """
+
+    def __init__(self, max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        self.started = time.time()
+        self.retriever = TRAGRetriever()
+        self.retriever.get_scenario_index()
+        print("Loading UAE model...")
+        load_uae_model()
+        print("Finished")
+
+        self.latencies = deque(maxlen=1000)
+        self.num_requests = 0
+        self.num_errors = 0
+        self.lock = threading.Lock()
+        self.batcher = MicroBatcher(
+            self.handle_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms
+        )
+
+    def retrieve(self, query: str, mode: str = "trajectory", k: int = 10) -> dict:
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode: {mode}")
+        if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= MAX_K:
+            raise ValueError(f"k must be an integer between 1 and {MAX_K}")
+        start = time.perf_counter()
+        path = "cache"
+        try:
+            key = self.retriever.cache_key(query, f"server-{mode}", k)
+            result = self.retriever.query_cache.get(key)
+            if result is None:
+                result = self.batcher.submit({"query": query, "mode": mode, "k": k})
+                path = result.pop("path")
+                self.retriever.query_cache.put(key, result)
+            # The cached result is shared, the path belongs to this request
+            return {**result, "path": path}
+        except Exception:
+            path = "error"
+            with self.lock:
+                self.num_errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.num_requests += 1
+                self.latencies.append(elapsed)
+            self.retriever.query_router.record(path, elapsed)
+
+    def handle_batch(self, items: list) -> list:
+        # Known phrases take their cached embedding, only the rest go through UAE
+        embeddings, paths = self.retriever.query_router.encode(
+            [item["query"] for item in items], encode_batch_with_uae
+        )
+        results = [None] * len(items)
+
+        for mode in RETRIEVAL_MODES:
+            positions = [i for i, item in enumerate(items) if item["mode"] == mode]
+            if not positions:
+                continue
+            k = max(items[i]["k"] for i in positions)
+            if mode == "trajectory":
+                values, indices, vehicles = self.retriever.retrieve_batch(
+                    embeddings[positions], k=k
+                )
+            else:
+                values, indices, vehicles = self.retriever.retrieve_scenario_batch(
+                    embeddings[positions], k=k
+                )
+
+            for row, i in enumerate(positions):
+                item_k = items[i]["k"]
+                results[i] = {
+                    "values": values[row, :item_k].tolist(),
+                    "indices": indices[row, :item_k].tolist(),
+                    "vehicles": vehicles[row][:item_k],
+                    "path": paths[i],
+                }
+        return results
+
+    def health(self) -> dict:
+        return {
+            "status": "ok",
+            "uptime_s": time.time() - self.started,
+            "num_trajectories": len(self.retriever.embedding_store),
+            "num_scenarios": len(self.retriever.get_scenario_index()),
+        }
+
+    def metrics(self) -> dict:
+        with self.lock:
+            latencies = list(self.latencies)
+            output = {"num_requests": self.num_requests, "num_errors": self.num_errors}
+        batch_sizes = list(self.batcher.batch_sizes)
+        output["mean_batch_size"] = float(np.mean(batch_sizes)) if batch_sizes else 0.0
+        if latencies:
+            output["latency"] = latency_percentiles(latencies)
+        output["query_cache"] = self.retriever.query_cache.stats()
+        output["query_router"] = self.retriever.query_router.stats()
+        return output
+
+
+class RetrievalRequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, self.service.health())
+        elif self.path == "/metrics":
+            self.send_json(200, self.service.metrics())
+        else:
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/retrieve":
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            result = self.service.retrieve(
+                request["query"],
+                mode=request.get("mode", "trajectory"),
+                k=request.get("k", 10),
+            )
+        except (KeyError, ValueError) as error:
+            self.send_json(400, {"error": str(error)})
+            return
+        except Exception as error:
+            self.send_json(500, {"error": str(error)})
+            return
+        self.send_json(200, result)
+
+    def send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    max_batch_size: int = 32,
+    max_wait_ms: float = 5.0,
+):
+    RetrievalRequestHandler.service = RetrievalService(
+        max_batch_size=max_batch_size, max_wait_ms=max_wait_ms
+    )
+    server = ThreadingHTTPServer((host, port), RetrievalRequestHandler)
+    print(f"Retrieval server listening on http://{host}:{port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.max_batch_size, args.max_wait_ms)
@@ -1,10 +1,20 @@
 import torch
+from torch.utils.data import get_worker_info
 import numpy as np
 
-from torch.distributions.uniform import Uniform
-
 
 class RoadEnvGraphAugmentations:
+    """Random rotation and shift of road environment graphs.
+
+    ``augment_batch`` transforms a whole padded batch at once: one rotation
+    matrix and shift per sample, applied with a single batched matmul on the
+    device of the batch. The random parameters are drawn on the CPU, from
+    the global torch RNG or, given ``seed``, from an own generator, so runs
+    are reproducible on any device. DataLoader workers reseed the generator
+    from their worker seed, otherwise every worker would draw the same
+    rotations and shifts.
+    """
+
     def __init__(
         self,
         min_rot_angle: float = -10.0,
@@ -13,37 +23,58 @@ class RoadEnvGraphAugmentations:
         max_shift_x: float = 1.0,
         min_shift_y: float = -1.0,
         max_shift_y: float = 1.0,
+        seed: int = None,
     ) -> None:
-        self.rot_distribution = Uniform(low=min_rot_angle, high=max_rot_angle)
-        self.shift_x_distribution = Uniform(low=min_shift_x, high=max_shift_x)
-        self.shift_y_distribution = Uniform(low=min_shift_y, high=max_shift_y)
-
-    def rotate_vectors(self, v, angle):
-        x, y = v[:, 0], v[:, 1]
-        x_rot = x * torch.cos(torch.deg2rad(angle)) - y * torch.sin(
-            torch.deg2rad(angle)
-        )
-        y_rot = y * torch.cos(torch.deg2rad(angle)) + x * torch.sin(
-            torch.deg2rad(angle)
+        self.low = torch.tensor([min_rot_angle, min_shift_x, min_shift_y])
+        self.high = torch.tensor([max_rot_angle, max_shift_x, max_shift_y])
+        self.seed = seed
+        self.generator = None if seed is None else torch.Generator().manual_seed(seed)
+        self.worker_seed = None
+
+    def random_parameters(self, batch_size: int) -> torch.Tensor:
+        """``(batch_size, 3)`` angles in degrees and x, y shifts."""
+        if self.generator is not None:
+            worker = get_worker_info()
+            if worker is not None and worker.seed != self.worker_seed:
+                # The worker seed differs per worker and epoch
+                self.worker_seed = worker.seed
+                self.generator.manual_seed((self.seed + worker.seed) % 2**63)
+        return self.low + (self.high - self.low) * torch.rand(
+            (batch_size, 3), generator=self.generator
         )
-        v[:, 0], v[:, 1] = x_rot, y_rot
 
-        return v
+    def augment_batch(self, graphs: torch.Tensor, mask: torch.Tensor = None):
+        """Rotates and shifts the positions of a batch of graphs.
 
-    def __call__(self, sample):
-        sample_a = sample
-        sample_b = np.copy(sample)
+        Args:
+            graphs (torch.Tensor): ``(B, N, D)`` with positions in the first two
+                features, e.g. padded ``(x, y, idx_embedding)`` graphs.
+            mask (torch.Tensor): Optional ``(B, N)`` mask of the valid tokens,
+                padded tokens are left unchanged.
 
-        sample_a = torch.from_numpy(sample_a)
-        sample_b = torch.from_numpy(sample_b)
+        Returns:
+            torch.Tensor: Augmented copy of ``graphs``.
+        """
+        parameters = self.random_parameters(graphs.shape[0]).to(
+            device=graphs.device, dtype=graphs.dtype
+        )
+        angles = torch.deg2rad(parameters[:, 0])
+        cos, sin = torch.cos(angles), torch.sin(angles)
+        # Row vectors: (x, y) @ [[cos, sin], [-sin, cos]]
+        # = (x cos - y sin, x sin + y cos)
+        rotations = torch.stack(
+            (torch.stack((cos, sin), dim=1), torch.stack((-sin, cos), dim=1)), dim=1
+        )
 
-        rot_angle = self.rot_distribution.sample()
-        x_shift = self.shift_x_distribution.sample()
-        y_shift = self.shift_y_distribution.sample()
+        positions = torch.bmm(graphs[:, :, :2], rotations) + parameters[:, None, 1:]
+        augmented = torch.cat((positions, graphs[:, :, 2:]), dim=2)
+        if mask is not None:
+            augmented = torch.where(mask[:, :, None].bool(), augmented, graphs)
+        return augmented
 
-        sample_b = self.rotate_vectors(sample_b, rot_angle)
-        sample_b[:, 0] += x_shift
-        sample_b[:, 1] += y_shift
+    def __call__(self, sample):
+        sample_a = torch.from_numpy(sample)
+        sample_b = self.augment_batch(sample_a[None])[0]
 
         return (sample_a, sample_b)
 
@@ -72,51 +103,44 @@ def waymo_vectors_to_road_env_graph(
     lane_sampling_rate: int = 3,
     agent_radius: float = 30.0,
 ) -> np.ndarray:
+    """Builds the ``(N, 3)`` road environment graph ``(x, y, idx_embedding)``.
+
+    Lane polylines are subsampled to every ``lane_sampling_rate``-th point
+    plus their first and last point, within ``max_dist`` of the origin.
+    Agents within ``agent_radius`` contribute their current position. Lane
+    points come first, then agents, both in the order of the polyline ids.
+    All polylines are processed at once on the rows grouped by polyline id.
+    """
     vectors, idx_global = waymo_vectors[:, :45], waymo_vectors[:, 44].flatten()
-    road_lanes = []
-    agents = []
-
-    for idx in np.unique(idx_global):
-        _vectors = vectors[idx_global == idx]
-
-        if _vectors[:, 13:17].sum() > 0:
-            road_lanes.append(_vectors)
-        # Agent trajectories to current agent position if in radius of interest
-        elif _vectors[:, 5:12].sum() > 0:
-            distance = np.sqrt(_vectors[-1][0] ** 2 + _vectors[-1][1] ** 2)
-            if distance <= agent_radius:
-                agents.append(_vectors[-1])
-
-    road_lanes_sub = np.array([])
-
-    for lane in road_lanes:
-        last_idx = lane.shape[0] - 1
-        _lane = [
-            elem
-            for idx, elem in enumerate(lane)
-            if (not idx % lane_sampling_rate or idx in [0, last_idx])
-            and (abs(elem[0] / max_dist) < 1 and abs(elem[1] / max_dist) < 1)
-        ]
-        _lane = np.array(_lane)
-
-        if len(_lane):
-            if not len(road_lanes_sub):
-                road_lanes_sub = _lane
-            else:
-                road_lanes_sub = np.concatenate((road_lanes_sub, _lane))
-
-    agents = np.array(agents)
-
-    if len(agents) and len(road_lanes_sub):
-        lanes_and_agents = np.concatenate((road_lanes_sub, agents))
-    elif not len(agents):
-        lanes_and_agents = road_lanes_sub
-    else:
-        lanes_and_agents = agents
-
-    road_graph = waymo_one_hot_to_embedding_idx(lanes_and_agents)
-
-    return road_graph
+    if not len(vectors):
+        return np.zeros((0, 3))
+
+    # Group the rows by polyline, keeping the order of the rows in a polyline
+    order = np.argsort(idx_global, kind="stable")
+    vectors, idx_global = vectors[order], idx_global[order]
+    starts = np.flatnonzero(np.r_[True, idx_global[1:] != idx_global[:-1]])
+    lengths = np.diff(np.r_[starts, len(vectors)])
+    polyline = np.repeat(np.arange(len(starts)), lengths)
+    position = np.arange(len(vectors)) - starts[polyline]
+    last = starts + lengths - 1
+
+    is_lane = np.add.reduceat(vectors[:, 13:17].sum(axis=1), starts) > 0
+    is_agent = ~is_lane & (np.add.reduceat(vectors[:, 5:12].sum(axis=1), starts) > 0)
+
+    # Agent trajectories to current agent position if in radius of interest
+    distance = np.sqrt(vectors[last, 0] ** 2 + vectors[last, 1] ** 2)
+    agent_rows = last[is_agent & (distance <= agent_radius)]
+
+    lane_mask = (
+        is_lane[polyline]
+        & ((position % lane_sampling_rate == 0) | (position == lengths[polyline] - 1))
+        & (np.abs(vectors[:, 0] / max_dist) < 1)
+        & (np.abs(vectors[:, 1] / max_dist) < 1)
+    )
+
+    return waymo_one_hot_to_embedding_idx(
+        np.concatenate((vectors[lane_mask], vectors[agent_rows]))
+    )
 
 
 def waymo_vectors_to_past_ego_trajectory(waymo_vectors, semantic_offset=4):
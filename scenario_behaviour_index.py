@@ -0,0 +1,235 @@
+import re
+
+import numpy as np
+
+from npz_utils import SCENARIO_FEATURES, list_vehicle_files_absolute
+from scenario_bitmap_index import DIRECTION_BUCKETS
+
+RANGE_QUERY_PATTERN = re.compile(
+    r"^\s*([\w-]+)\s*(>=|<=|==|=|>|<)\s*(-?\d+(?:\.\d*)?)\s*$"
+)
+
+
+def scenario_key(filename: str) -> str:
+    """Scenario part of an npz file name.
+
+    ``vehicle_d_13657_00002_4856147881.npz`` belongs to scenario
+    ``13657_00002``. The subset letter and the agent id are dropped, so
+    agents of the same scenario end up together across all subsets.
+    """
+    parts = filename.split("/")[-1].removesuffix(".npz").split("_")
+    return "_".join(parts[2:-1])
+
+
+class ScenarioBehaviourIndex:
+    """Per-scenario agent counts with count-range queries.
+
+    For every scenario the agents are counted per direction bucket and per
+    scenario feature, plus the total number of agents. Every count column is
+    kept as a posting list of scenario ids sorted by count, so a predicate
+    like ``Left >= 2`` is one binary search that yields a contiguous slice of
+    scenarios. A query starts from its smallest slice and checks the other
+    predicates on those scenarios only.
+    """
+
+    def __init__(
+        self,
+        vehicle_list: list,
+        direction_labels: np.ndarray,
+        scenario_features: np.ndarray,
+    ):
+        """
+        Args:
+            vehicle_list (list): npz file paths, one per trajectory.
+            direction_labels (np.ndarray): ``(N,)`` direction bucket indices in
+                the order of ``vehicle_list``.
+            scenario_features (np.ndarray): ``(N, 12)`` one-hot scenario
+                features in the order of ``vehicle_list``.
+        """
+        self.files = np.array([path.split("/")[-1] for path in vehicle_list])
+        self.scenarios, row_scenario = np.unique(
+            [scenario_key(name) for name in self.files], return_inverse=True
+        )
+        num_scenarios = len(self.scenarios)
+        direction_labels = np.asarray(direction_labels)
+        scenario_features = np.asarray(scenario_features)
+
+        self.columns = [*DIRECTION_BUCKETS, *SCENARIO_FEATURES, "agents"]
+        self.counts = np.zeros((num_scenarios, len(self.columns)), dtype=np.int32)
+        for index in range(len(DIRECTION_BUCKETS)):
+            self.counts[:, index] = np.bincount(
+                row_scenario[direction_labels == index], minlength=num_scenarios
+            )
+        for index in range(len(SCENARIO_FEATURES)):
+            self.counts[:, len(DIRECTION_BUCKETS) + index] = np.bincount(
+                row_scenario[scenario_features[:, index] == 1],
+                minlength=num_scenarios,
+            )
+        self.counts[:, -1] = np.bincount(row_scenario, minlength=num_scenarios)
+
+        # Posting list per column: scenario ids sorted by their count
+        self.count_columns = SortedColumns(self.counts, self.columns)
+
+        # Agent files per scenario, members[offsets[s] : offsets[s + 1]]
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts[:, -1])))
+        self.members = np.argsort(row_scenario, kind="stable")
+
+    @classmethod
+    def from_files(
+        cls,
+        direction_labels_path: str = "datasets/raw_direction_labels.npy",
+        scenario_features_path: str = "output/scenario_features.npy",
+        vehicle_list: list = None,
+    ):
+        if vehicle_list is None:
+            vehicle_list = list_vehicle_files_absolute()
+        return cls(
+            vehicle_list,
+            np.load(direction_labels_path, mmap_mode="r"),
+            np.load(scenario_features_path, mmap_mode="r"),
+        )
+
+    def __len__(self):
+        return len(self.scenarios)
+
+    def search(self, predicates: dict) -> np.ndarray:
+        """Scenarios whose counts lie in all given ranges.
+
+        Args:
+            predicates (dict): Maps a column (direction bucket, scenario
+                feature or "agents") to ``(low, high)``, both inclusive and
+                None for unbounded, e.g. ``{"Left": (2, None), "Stationary": (1, None)}``.
+
+        Returns:
+            np.ndarray: Sorted ids of the matching scenarios.
+        """
+        return self.count_columns.search(predicates)
+
+    def search_text(self, query: str) -> np.ndarray:
+        """``search`` for a query like "Left>=2 AND Stationary>=1"."""
+        return self.search(parse_range_query(query))
+
+    def agent_files(self, scenario: int) -> list:
+        members = self.members[self.offsets[scenario] : self.offsets[scenario + 1]]
+        return self.files[members].tolist()
+
+    def describe(self, scenario: int) -> dict:
+        return {
+            "scenario": str(self.scenarios[scenario]),
+            "counts": {
+                name: int(count)
+                for name, count in zip(self.columns, self.counts[scenario])
+                if count
+            },
+            "files": self.agent_files(scenario),
+        }
+
+
+class SortedColumns:
+    """Columnar range index: per column the row ids sorted by value.
+
+    A range predicate on a column is two binary searches into its sorted
+    values and yields a contiguous slice of row ids. NaN values sort last
+    and never match.
+    """
+
+    def __init__(self, values: np.ndarray, columns: list):
+        self.values = values
+        self.columns = list(columns)
+        self.postings = np.argsort(values, axis=0, kind="stable")
+        self.sorted_values = np.take_along_axis(values, self.postings, axis=0)
+        if np.issubdtype(values.dtype, np.floating):
+            self.num_valid = np.count_nonzero(~np.isnan(values), axis=0)
+        else:
+            self.num_valid = np.full(len(self.columns), len(values))
+
+    def column(self, name: str) -> int:
+        if name not in self.columns:
+            raise ValueError(f"Unknown column: {name}")
+        return self.columns.index(name)
+
+    def range(self, name: str, low=None, high=None):
+        """Slice of the posting list of ``name`` with ``low <= value <= high``.
+
+        Returns:
+            tuple: ``(column, start, end)``.
+        """
+        column = self.column(name)
+        values = self.sorted_values[: self.num_valid[column], column]
+        start = 0 if low is None else np.searchsorted(values, low, side="left")
+        end = len(values) if high is None else np.searchsorted(values, high, side="right")
+        return column, int(start), int(max(start, end))
+
+    def search(self, predicates: dict, candidates: np.ndarray = None) -> np.ndarray:
+        """Rows whose values lie in all ``{column: (low, high)}`` ranges.
+
+        Args:
+            predicates (dict): Inclusive bounds per column, None for unbounded.
+            candidates (np.ndarray): Optional row ids the result is restricted to.
+
+        Returns:
+            np.ndarray: Sorted ids of the matching rows.
+        """
+        ranges = {
+            name: self.range(name, low, high) for name, (low, high) in predicates.items()
+        }
+        first = None
+        if ranges:
+            # Start from the most selective predicate
+            first = min(ranges, key=lambda name: ranges[name][2] - ranges[name][1])
+            column, start, end = ranges[first]
+            if candidates is None or end - start < len(candidates):
+                posting = self.postings[start:end, column]
+                candidates = (
+                    posting
+                    if candidates is None
+                    else posting[np.isin(posting, candidates)]
+                )
+            else:
+                first = None
+        if candidates is None:
+            return np.arange(len(self.values))
+
+        for name, (low, high) in predicates.items():
+            if name == first or len(candidates) == 0:
+                continue
+            values = self.values[candidates, ranges[name][0]]
+            # Comparisons with NaN are False, so missing values never match
+            keep = np.ones(len(candidates), dtype=bool)
+            if low is not None:
+                keep &= values >= low
+            if high is not None:
+                keep &= values <= high
+            candidates = candidates[keep]
+        return np.sort(candidates)
+
+
+def parse_range_query(query: str) -> dict:
+    """Parses "Left>=2 AND Stationary>=1" into ``(low, high)`` predicates per column.
+
+    Bounds are inclusive, strict bounds are moved to the next float, which
+    works for integer counts and float attributes alike. Several conditions
+    on the same column are intersected.
+    """
+    predicates = {}
+    for condition in re.split(r"\s+AND\s+", query.strip(), flags=re.IGNORECASE):
+        match = RANGE_QUERY_PATTERN.match(condition)
+        if match is None:
+            raise ValueError(f"Cannot parse range condition: {condition}")
+        name, operator, value = match.group(1), match.group(2), float(match.group(3))
+        above, below = np.nextafter(value, np.inf), np.nextafter(value, -np.inf)
+        low, high = {
+            ">=": (value, None),
+            ">": (above, None),
+            "<=": (None, value),
+            "<": (None, below),
+            "==": (value, value),
+            "=": (value, value),
+        }[operator]
+        previous_low, previous_high = predicates.get(name, (None, None))
+        if previous_low is not None:
+            low = previous_low if low is None else max(low, previous_low)
+        if previous_high is not None:
+            high = previous_high if high is None else min(high, previous_high)
+        predicates[name] = (low, high)
+    return predicates
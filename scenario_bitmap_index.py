@@ -0,0 +1,132 @@
+import numpy as np
+
+from npz_utils import SCENARIO_FEATURES
+
+DIRECTION_BUCKETS = [
+    "Left",
+    "Right",
+    "Stationary",
+    "Straight",
+    "Straight-Left",
+    "Straight-Right",
+    "Right-U-Turn",
+    "Left-U-Turn",
+]
+
+# Number of set bits for every possible byte value
+POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(
+    axis=1
+)
+
+
+class ScenarioBitmapIndex:
+    """Bit-packed inverted index over scenario features and direction buckets.
+
+    Every scenario feature and every direction bucket owns one bitmap with a
+    bit per trajectory, packed eight rows to a byte. Boolean filters are
+    answered by AND-ing (features) and OR-ing (buckets) those bitmaps, which
+    touches 1/8 byte per row instead of the labels themselves.
+    """
+
+    def __init__(
+        self,
+        scenario_features: np.ndarray,
+        direction_labels: np.ndarray,
+        prefilter_threshold: float = 0.2,
+    ):
+        """
+        Args:
+            scenario_features (np.ndarray): ``(N, 12)`` one-hot matrix in the
+                order of ``SCENARIO_FEATURES``.
+            direction_labels (np.ndarray): ``(N,)`` direction bucket indices.
+            prefilter_threshold (float): Largest fraction of matching rows for
+                which only the matching rows are scored. Above it the whole
+                corpus is scored and filtered afterwards.
+        """
+        self.num_rows = len(direction_labels)
+        self.prefilter_threshold = prefilter_threshold
+        self.feature_bitmaps = {
+            feature: np.packbits(scenario_features[:, index] == 1)
+            for index, feature in enumerate(SCENARIO_FEATURES)
+        }
+        self.direction_bitmaps = {
+            direction: np.packbits(direction_labels == index)
+            for index, direction in enumerate(DIRECTION_BUCKETS)
+        }
+        self.counts = {
+            name: self.count(bitmap)
+            for name, bitmap in {
+                **self.feature_bitmaps,
+                **self.direction_bitmaps,
+            }.items()
+        }
+
+    @classmethod
+    def from_files(
+        cls,
+        scenario_features_path: str = "output/scenario_features.npy",
+        direction_labels_path: str = "datasets/raw_direction_labels.npy",
+        **kwargs,
+    ):
+        return cls(
+            np.load(scenario_features_path, mmap_mode="r"),
+            np.load(direction_labels_path, mmap_mode="r"),
+            **kwargs,
+        )
+
+    def count(self, bitmap: np.ndarray) -> int:
+        return int(POPCOUNT_TABLE[bitmap].sum())
+
+    def filter(self, features=(), directions=(), exclude_features=()) -> np.ndarray:
+        """Returns the packed bitmap of rows matching the filter.
+
+        A row matches if it has all ``features``, none of ``exclude_features``
+        and, if any ``directions`` are given, one of these directions.
+        """
+        for name in (*features, *exclude_features):
+            if name not in self.feature_bitmaps:
+                raise ValueError(f"Unknown scenario feature: {name}")
+        for name in directions:
+            if name not in self.direction_bitmaps:
+                raise ValueError(f"Unknown direction bucket: {name}")
+
+        bitmap = np.packbits(np.ones(self.num_rows, dtype=bool))
+        if directions:
+            bitmap = np.bitwise_or.reduce(
+                [self.direction_bitmaps[name] for name in directions]
+            )
+
+        # Most selective bitmaps first so empty results stop early
+        for name in sorted(features, key=lambda name: self.counts[name]):
+            bitmap = bitmap & self.feature_bitmaps[name]
+            if not bitmap.any():
+                return bitmap
+        for name in exclude_features:
+            bitmap = bitmap & ~self.feature_bitmaps[name]
+        return bitmap
+
+    def to_mask(self, bitmap: np.ndarray) -> np.ndarray:
+        return np.unpackbits(bitmap, count=self.num_rows).astype(bool)
+
+    def row_ids(self, bitmap: np.ndarray) -> np.ndarray:
+        return np.flatnonzero(np.unpackbits(bitmap, count=self.num_rows))
+
+    def plan(self, features=(), directions=(), exclude_features=()) -> dict:
+        """Decides how a filtered vector query is executed.
+
+        Returns:
+            dict: ``strategy`` is "prefilter" (score only the matching rows,
+            given as ``ids``) or "postfilter" (score everything and drop the
+            rows outside ``mask``), plus the match count and selectivity.
+        """
+        bitmap = self.filter(features, directions, exclude_features)
+        num_matches = self.count(bitmap)
+        selectivity = num_matches / self.num_rows
+        plan = {"num_matches": num_matches, "selectivity": selectivity}
+        if selectivity <= self.prefilter_threshold:
+            plan["strategy"] = "prefilter"
+            plan["ids"] = self.row_ids(bitmap)
+        else:
+            plan["strategy"] = "postfilter"
+            plan["mask"] = self.to_mask(bitmap)
+        return plan
@@ -30,12 +30,26 @@ class ScenarioCNN(pl.LightningModule):
         x = self.fc(x)
         return x
 
+    def on_train_epoch_start(self):
+        # Streaming datasets like ScenarioRasterStream draw a new shard order
+        # every epoch. The hook runs before the DataLoader starts its workers,
+        # so they get a copy of the dataset with the new epoch
+        dataset = getattr(self.trainer.train_dataloader, "dataset", None)
+        if hasattr(dataset, "set_epoch"):
+            dataset.set_epoch(self.current_epoch)
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # Rasters are streamed as uint8 and only converted on the device
+        x, y = batch
+        if x.dtype == torch.uint8:
+            x = x.float() / 255
+        return x, y
+
     def training_step(self, batch, batch_idx):
         x, y = batch
         y_hat = self(x)
         loss = F.mse_loss(y_hat, y.float())
-        self.log("train_loss", loss)
-        print(loss)
+        self.log("train_loss", loss, prog_bar=True)
         return loss
 
     def configure_optimizers(self):
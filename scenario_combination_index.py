@@ -0,0 +1,92 @@
+import json
+
+import numpy as np
+
+from embedding_store import normalize_rows
+
+
+class ScenarioCombinationIndex:
+    """Exact scenario retrieval over the distinct scenario feature combinations.
+
+    The direct embedding of a scenario only depends on its 12-bit feature
+    vector, so at most 2^12 different embeddings exist however large the
+    corpus is. Queries are scored against these combination embeddings once
+    and the ranked combinations are expanded through a combination to member
+    ids inverted list (CSR layout: ``members[offsets[c] : offsets[c + 1]]``).
+    """
+
+    def __init__(self, scenario_features: np.ndarray, embedding_cache: dict):
+        """
+        Args:
+            scenario_features (np.ndarray): ``(N, 12)`` one-hot scenario features.
+            embedding_cache (dict): Maps ``str(feature_list)`` of a combination
+                to its embedding, as in ``datasets/scenario_embedding_cache.json``.
+        """
+        scenario_features = np.asarray(scenario_features).astype(np.int64)
+        num_bits = scenario_features.shape[1]
+        codes = scenario_features @ (1 << np.arange(num_bits - 1, -1, -1))
+
+        unique_codes, self.row_combination = np.unique(codes, return_inverse=True)
+        self.combinations = (
+            unique_codes[:, None] >> np.arange(num_bits - 1, -1, -1)
+        ) & 1
+        self.combination_embeddings = normalize_rows(
+            np.array(
+                [embedding_cache[str(bits.tolist())] for bits in self.combinations],
+                dtype=np.float32,
+            )
+        )
+
+        sizes = np.bincount(self.row_combination, minlength=len(unique_codes))
+        self.offsets = np.concatenate(([0], np.cumsum(sizes)))
+        self.members = np.argsort(self.row_combination, kind="stable")
+        self.num_rows = len(codes)
+
+    @classmethod
+    def from_files(
+        cls,
+        scenario_features_path: str = "output/scenario_features.npy",
+        embedding_cache_path: str = "datasets/scenario_embedding_cache.json",
+    ):
+        with open(embedding_cache_path) as embedding_cache:
+            cache = json.load(embedding_cache)
+        return cls(np.load(scenario_features_path), cache)
+
+    def __len__(self):
+        return self.num_rows
+
+    def score(self, query) -> np.ndarray:
+        """Cosine similarity of the query against every scenario, shape ``(N,)``."""
+        query = normalize_rows(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+        return (self.combination_embeddings @ query)[self.row_combination]
+
+    def search(self, queries, k: int):
+        """Top-k scenarios per query.
+
+        Args:
+            queries: Query embeddings of shape ``(Q, dim)`` or ``(dim,)``.
+            k (int): Number of scenarios per query.
+
+        Returns:
+            tuple: ``(scores, ids)`` of shape ``(Q, k)`` sorted by descending
+            similarity. Scenarios of equal similarity are ordered by id.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        k = min(k, self.num_rows)
+        combination_scores = normalize_rows(queries) @ self.combination_embeddings.T
+        sizes = np.diff(self.offsets)
+
+        scores = np.empty((len(queries), k), dtype=np.float32)
+        ids = np.empty((len(queries), k), dtype=np.int64)
+        for row, query_scores in enumerate(combination_scores):
+            order = np.argsort(-query_scores, kind="stable")
+            # Only expand as many combinations as are needed to fill k
+            needed = np.searchsorted(np.cumsum(sizes[order]), k) + 1
+            order = order[:needed]
+            ids[row] = np.concatenate(
+                [self.members[self.offsets[c] : self.offsets[c + 1]] for c in order]
+            )[:k]
+            scores[row] = np.repeat(query_scores[order], sizes[order])[:k]
+        return scores, ids
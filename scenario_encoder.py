@@ -27,6 +27,7 @@ class REDEncoder(pl.LightningModule):
         max_train_epochs: int = 200,
         learning_rate=1e-4,
         lambda_coeff=5e-3,
+        augmentations=None,
     ):
         super().__init__()
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -82,6 +83,8 @@ class REDEncoder(pl.LightningModule):
         ).to(device)
         self.max_epochs = max_train_epochs
         self.learning_rate = learning_rate
+        # RoadEnvGraphAugmentations creating the second view on the device
+        self.augmentations = augmentations
 
     def forward(
         self, idxs_src_tokens: Tensor, pos_src_tokens: Tensor, src_mask: Tensor
@@ -104,6 +107,19 @@ class REDEncoder(pl.LightningModule):
 
         return self.decoder(tgt, self.encoder(src, src_mask), src_mask)
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # Batches without a second view get it from the augmentations, as one
+        # batched transform on the device
+        if self.augmentations is not None and "sample_b" not in batch:
+            sample_a = batch["sample_a"]
+            batch["sample_b"] = {
+                "idx_src_tokens": sample_a["idx_src_tokens"],
+                "pos_src_tokens": self.augmentations.augment_batch(
+                    sample_a["pos_src_tokens"], batch["src_attn_mask"]
+                ),
+            }
+        return batch
+
     def shared_step(self, batch):
         road_env_tokens_a = self.forward(
             idxs_src_tokens=batch["sample_a"]["idx_src_tokens"],
@@ -1,8 +1,10 @@
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
 import torch
 from uae_explore import encode_with_uae
 from npz_utils import list_vehicle_files_absolute
+from raster_codec import RasterStore
 import numpy as np
+import time
 
 import json
 
@@ -31,3 +33,159 @@ class ScenarioEncoderDataset(Dataset):
 
     def __getitem__(self, idx):
         return self.x_data[idx], self.y_data[idx]
+
+
+class ScenarioRasterStream(IterableDataset):
+    """Streams scenario rasters from the npz corpus or from raster shards.
+
+    The sources are split into shards, contiguous groups of ``shard_size``
+    npz files or rasters of a ``RasterStore``, or ``.npy`` files of stacked
+    ``(N, 25, 224, 224)`` rasters.
+    Every DataLoader worker reads a disjoint subset of the shards, in an order
+    that changes every epoch, and shuffles its samples in a buffer of
+    ``shuffle_buffer`` rasters, so memory does not grow with the corpus.
+    Rasters stay uint8 until they are moved to the device, the transform
+    (e.g. ``BarlowTwinsTransform``) runs in the worker.
+    """
+
+    def __init__(
+        self,
+        paths: list = None,
+        targets: np.ndarray = None,
+        transform=None,
+        shard_size: int = 256,
+        shuffle_buffer: int = 512,
+        seed: int = 42,
+    ):
+        """
+        Args:
+            paths (list): npz files, by default the vehicle_a corpus, ``.npy``
+                raster shards or a ``RasterStore``.
+            targets (np.ndarray): Optional ``(N, D)`` targets in the order of
+                the rasters, e.g. a memory-mapped embedding file.
+            transform: Applied to every ``(25, 224, 224)`` uint8 raster.
+            shard_size (int): npz files per shard.
+            shuffle_buffer (int): Rasters held per worker for shuffling.
+            seed (int): Seed of the shard order and the shuffling.
+        """
+        if paths is None:
+            paths = list_vehicle_files_absolute()
+        self.targets = targets
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+        # Shards are (paths or store indices, index of the first raster)
+        self.raster_store = paths if isinstance(paths, RasterStore) else None
+        if self.raster_store is not None:
+            self.shards = [
+                (range(start, min(start + shard_size, len(paths))), start)
+                for start in range(0, len(paths), shard_size)
+            ]
+        elif all(path.endswith(".npy") for path in paths):
+            sizes = [len(np.load(path, mmap_mode="r")) for path in paths]
+            offsets = np.concatenate(([0], np.cumsum(sizes)))
+            self.shards = [([path], int(offsets[i])) for i, path in enumerate(paths)]
+        else:
+            self.shards = [
+                (paths[start : start + shard_size], start)
+                for start in range(0, len(paths), shard_size)
+            ]
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def read_shard(self, shard):
+        """Yields ``(index, raster)`` for every raster of a shard."""
+        paths, offset = shard
+        if self.raster_store is not None:
+            for index in paths:
+                raster = self.raster_store[index]
+                if raster is not None:
+                    yield index, raster
+            return
+        if paths[0].endswith(".npy"):
+            rasters = np.load(paths[0], mmap_mode="r")
+            for row in range(len(rasters)):
+                yield offset + row, np.array(rasters[row])
+            return
+        for row, path in enumerate(paths):
+            try:
+                with np.load(path) as data:
+                    raster = data["raster"]
+            except (OSError, KeyError, ValueError):
+                continue
+            # npz rasters are stored channels last
+            yield offset + row, np.ascontiguousarray(raster.transpose(2, 0, 1))
+
+    def sample(self, index: int, raster: np.ndarray):
+        if self.transform is None:
+            x = torch.from_numpy(raster)
+        else:
+            x = self.transform(raster)
+        if self.targets is None:
+            return x
+        return x, torch.from_numpy(np.asarray(self.targets[index], dtype=np.float32))
+
+    def __iter__(self):
+        worker = get_worker_info()
+        if worker is None:
+            worker_id, num_workers, base_seed = 0, 1, 0
+        else:
+            # The DataLoader draws a new base seed for every epoch, shared
+            # by all of its workers
+            worker_id, num_workers = worker.id, worker.num_workers
+            base_seed = worker.seed - worker.id
+        # Every worker draws the same shard order and takes every
+        # num_workers-th shard of it
+        order = np.random.default_rng((self.seed, self.epoch, base_seed)).permutation(
+            len(self.shards)
+        )
+        rng = np.random.default_rng((self.seed, self.epoch, base_seed, worker_id))
+
+        buffer = []
+        for shard in order[worker_id::num_workers]:
+            for index, raster in self.read_shard(self.shards[shard]):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append((index, raster))
+                    continue
+                position = rng.integers(len(buffer))
+                yield self.sample(*buffer[position])
+                buffer[position] = (index, raster)
+        rng.shuffle(buffer)
+        for index, raster in buffer:
+            yield self.sample(index, raster)
+
+
+def benchmark_raster_stream(
+    dataset: ScenarioRasterStream,
+    batch_size: int = 32,
+    num_workers: int = 4,
+    num_batches: int = 50,
+):
+    """Prints how many rasters per second a DataLoader gets from the stream."""
+    dataloader = DataLoader(
+        dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True
+    )
+    num_samples = 0
+    start = None
+    for i, batch in enumerate(dataloader):
+        # The first batch includes the worker start up and filling the buffer
+        if i == 0:
+            start = time.perf_counter()
+            continue
+        x = batch[0] if isinstance(batch, (list, tuple)) else batch
+        num_samples += len(x[0]) if isinstance(x, (list, tuple)) else len(x)
+        if i == num_batches:
+            break
+    elapsed = time.perf_counter() - start
+    print(
+        f"{num_samples / elapsed:.1f} samples/s "
+        f"({num_samples} samples, {num_workers} workers, batch size {batch_size})"
+    )
+    return num_samples / elapsed
+
+
+if __name__ == "__main__":
+    benchmark_raster_stream(ScenarioRasterStream())
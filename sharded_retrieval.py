@@ -0,0 +1,307 @@
+import json
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+
+from embedding_store import EmbeddingStore, merge_top_k, normalize_rows, sort_top_k
+from retrieval_cache import file_version
+
+THREAD_ENVIRONMENT_VARIABLES = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+)
+
+
+def shard_worker(directory: str, offset: int, connection):
+    """Serves search and score requests for one shard until it receives None."""
+    store = EmbeddingStore(directory)
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        method, arguments = request
+        try:
+            if method == "score":
+                connection.send(store.score(*arguments))
+            else:
+                queries, k, ids, mask = arguments
+                scores, local_ids = store.search(queries, k=k, ids=ids, mask=mask)
+                connection.send((scores, local_ids + offset))
+        except Exception as error:
+            connection.send(error)
+    connection.close()
+
+
+class ShardedEmbeddingStore:
+    """Embedding store split into contiguous shards served by worker processes.
+
+    Each shard is an ordinary ``EmbeddingStore`` directory. A worker process
+    per shard maps its shard read-only, so the rows live in the shared page
+    cache once. Queries are sent to all workers, every worker returns its
+    local top-k with global ids, and the lists are merged. Ties are resolved
+    by id in the shards and in the merge, so the results are the same as a
+    search over a single store with the same rows (scores may differ in the
+    last bit, since BLAS sums in a shape dependent order).
+
+    Workers are started with the "spawn" method, so scripts creating a
+    sharded store need an ``if __name__ == "__main__":`` guard.
+    """
+
+    MANIFEST_FILE = "shards.json"
+
+    def __init__(self, directory: str, threads_per_shard: int = None):
+        self.directory = directory
+        with open(os.path.join(directory, self.MANIFEST_FILE)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.shards = self.manifest["shards"]
+        self.dim = self.manifest["dim"]
+        self.num_rows = sum(shard["count"] for shard in self.shards)
+
+        if threads_per_shard is None:
+            threads_per_shard = max(1, (os.cpu_count() or 1) // len(self.shards))
+        self.connections = []
+        self.workers = []
+        context = mp.get_context("spawn")
+
+        # BLAS reads its thread count at import, i.e. from the worker environment
+        previous = {name: os.environ.get(name) for name in THREAD_ENVIRONMENT_VARIABLES}
+        for name in THREAD_ENVIRONMENT_VARIABLES:
+            os.environ[name] = str(threads_per_shard)
+        try:
+            for shard in self.shards:
+                parent_connection, child_connection = context.Pipe()
+                worker = context.Process(
+                    target=shard_worker,
+                    args=(
+                        os.path.join(directory, shard["directory"]),
+                        shard["offset"],
+                        child_connection,
+                    ),
+                    daemon=True,
+                )
+                worker.start()
+                self.connections.append(parent_connection)
+                self.workers.append(worker)
+        finally:
+            for name, value in previous.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+
+    @classmethod
+    def build(
+        cls,
+        source_paths: list,
+        directory: str,
+        num_shards: int,
+        dtype: str = "float32",
+    ):
+        """Splits one or more encoder output matrices into equally sized shards.
+
+        The sources are concatenated in the given order, e.g. the encoder
+        outputs of vehicle_a, vehicle_b and vehicle_d, and global ids follow
+        that order.
+        """
+        sources = [np.load(path, mmap_mode="r") for path in source_paths]
+        source_offsets = np.concatenate(([0], np.cumsum([len(s) for s in sources])))
+        num_rows = int(source_offsets[-1])
+        bounds = np.linspace(0, num_rows, num_shards + 1).astype(np.int64)
+
+        os.makedirs(directory, exist_ok=True)
+        shards = []
+        for index, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            shard_directory = f"shard_{index:03d}"
+            EmbeddingStore.write(
+                os.path.join(directory, shard_directory),
+                ConcatenatedRows(sources, source_offsets, start, end),
+                source_name=f"rows {start}-{end} of {source_paths}",
+                dtype=dtype,
+            )
+            shards.append(
+                {
+                    "directory": shard_directory,
+                    "offset": int(start),
+                    "count": int(end - start),
+                }
+            )
+
+        manifest = {
+            "dim": int(sources[0].shape[1]),
+            "dtype": dtype,
+            "sources": [
+                {"path": path, "offset": int(offset), "count": len(source)}
+                for path, offset, source in zip(source_paths, source_offsets, sources)
+            ],
+            "shards": shards,
+        }
+        with open(os.path.join(directory, cls.MANIFEST_FILE), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+
+    def __len__(self):
+        return self.num_rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+        self.workers = []
+
+    def version(self) -> tuple:
+        return file_version(
+            os.path.join(self.directory, self.MANIFEST_FILE),
+            *[
+                os.path.join(self.directory, shard["directory"], name)
+                for shard in self.shards
+                for name in (EmbeddingStore.EMBEDDINGS_FILE, EmbeddingStore.META_FILE)
+            ],
+        )
+
+    def locate(self, index: int):
+        """Returns (source path, row within that source) of a global id."""
+        for source in self.manifest["sources"]:
+            if source["offset"] <= index < source["offset"] + source["count"]:
+                return source["path"], index - source["offset"]
+        raise IndexError(f"Row {index} is outside of the sharded store")
+
+    def normalize_queries(self, queries) -> np.ndarray:
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        return normalize_rows(queries)
+
+    def normalize_query(self, query) -> np.ndarray:
+        return self.normalize_queries(query)[0]
+
+    def search(
+        self,
+        queries,
+        k: int,
+        chunk_size: int = 65536,
+        ids: np.ndarray = None,
+        mask: np.ndarray = None,
+    ):
+        """Same contract as ``EmbeddingStore.search``, fanned out over all shards.
+
+        Shards without candidate rows for ``ids`` or ``mask`` are skipped.
+        """
+        queries = self.normalize_queries(queries)
+        connections = []
+        for connection, shard in zip(self.connections, self.shards):
+            start, end = shard["offset"], shard["offset"] + shard["count"]
+            shard_ids = None
+            if ids is not None:
+                shard_ids = ids[(ids >= start) & (ids < end)] - start
+                if not len(shard_ids):
+                    continue
+            shard_mask = None
+            if mask is not None:
+                shard_mask = mask[start:end]
+                if not shard_mask.any():
+                    continue
+            connection.send(("search", (queries, k, shard_ids, shard_mask)))
+            connections.append(connection)
+
+        results = self.receive(connections)
+        if not results:
+            empty = np.empty((len(queries), 0))
+            return empty.astype(np.float32), empty.astype(np.int64)
+        scores, result_ids = merge_top_k(
+            np.concatenate([result[0] for result in results], axis=1),
+            np.concatenate([result[1] for result in results], axis=1),
+            k,
+        )
+        return sort_top_k(scores, result_ids)
+
+    def score(self, query, chunk_size: int = 65536) -> np.ndarray:
+        """Same contract as ``EmbeddingStore.score``, in global id order."""
+        for connection in self.connections:
+            connection.send(("score", (query, chunk_size)))
+        # Shards are contiguous id ranges in manifest order
+        return np.concatenate(self.receive(self.connections))
+
+    def receive(self, connections: list) -> list:
+        results = [connection.recv() for connection in connections]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+
+class ConcatenatedRows:
+    """Row range of several stacked arrays, sliceable like a single array."""
+
+    def __init__(self, sources, source_offsets, start, end):
+        self.sources = sources
+        self.source_offsets = source_offsets
+        self.start = start
+        self.shape = (int(end - start), sources[0].shape[1])
+
+    def __getitem__(self, item):
+        start = self.start + (item.start or 0)
+        stop = self.start + min(
+            self.shape[0] if item.stop is None else item.stop, self.shape[0]
+        )
+        parts = []
+        for source, offset in zip(self.sources, self.source_offsets):
+            lower, upper = max(start, offset), min(stop, offset + len(source))
+            if lower < upper:
+                parts.append(source[lower - offset : upper - offset])
+        return np.concatenate(parts)
+
+
+def benchmark_sharded_search(
+    source_paths: list,
+    directory: str = "datasets/trajectory_shards",
+    shard_counts=(1, 2, 4, 8),
+    num_queries: int = 64,
+    k: int = 100,
+):
+    """Prints the query throughput for several numbers of shards.
+
+    A store per shard count is built at ``{directory}_{num_shards}`` if it
+    does not exist yet, and every result is compared to the 1-shard result.
+    """
+    dim = np.load(source_paths[0], mmap_mode="r").shape[1]
+    queries = np.random.default_rng(0).standard_normal((num_queries, dim))
+
+    reference = None
+    for num_shards in shard_counts:
+        shard_directory = f"{directory}_{num_shards}"
+        manifest_path = os.path.join(
+            shard_directory, ShardedEmbeddingStore.MANIFEST_FILE
+        )
+        if not os.path.exists(manifest_path):
+            ShardedEmbeddingStore.build(source_paths, shard_directory, num_shards)
+        with ShardedEmbeddingStore(shard_directory) as store:
+            store.search(queries[:1], k=k)  # Warm up the page cache
+            start = time.perf_counter()
+            _, ids = store.search(queries, k=k)
+            elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = ids
+        print(
+            f"{num_shards} shards: {num_queries / elapsed:.1f} queries/s, "
+            f"identical to {shard_counts[0]} shard(s): {np.array_equal(ids, reference)}"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_sharded_search(
+        [
+            "datasets/encoder_output_a_mse.npy",
+            "datasets/encoder_output_b_mse.npy",
+            "datasets/encoder_output_d_mse.npy",
+        ]
+    )
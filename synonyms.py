@@ -0,0 +1,261 @@
+# Synonym phrases used to evaluate and route retrieval queries. Their UAE
+# embeddings are cached in datasets/synonyms_uae_cache.json (direction buckets)
+# and datasets/scenario_synonym_embedding_cache.json (scenario features).
+
+BUCKET_SYNONYMS = {
+    "Right-U-Turn": [
+        "Rightward complete reversal",
+        "180-degree turn to the right",
+        "Clockwise U-turn",
+        "Right circular turnaround",
+        "Right-hand loopback",
+        "Right flip turn",
+        "Full right pivot",
+        "Right about-face",
+        "Rightward return turn",
+        "Rightward reversing curve",
+    ],
+    "Left-U-Turn": [
+        "Leftward complete reversal",
+        "180-degree turn to the left",
+        "Counterclockwise U-turn",
+        "Left circular turnaround",
+        "Left-hand loopback",
+        "Left flip turn",
+        "Full left pivot",
+        "Left about-face",
+        "Leftward return turn",
+        "Leftward reversing curve",
+    ],
+    "Stationary": [
+        "At a standstill",
+        "Motionless",
+        "Unmoving",
+        "Static position",
+        "Immobilized",
+        "Not in motion",
+        "Fixed in place",
+        "Idle",
+        "Inert",
+        "Anchored",
+    ],
+    "Right": [
+        "Rightward",
+        "To the right",
+        "Right-hand side",
+        "Starboard",
+        "Rightward direction",
+        "Clockwise direction",
+        "Right-leaning",
+        "Rightward bound",
+        "Bearing right",
+        "Veering right",
+    ],
+    "Left": [
+        "Leftward",
+        "To the left",
+        "Left-hand side",
+        "Port",
+        "Leftward direction",
+        "Counterclockwise direction",
+        "Left-leaning",
+        "Leftward bound",
+        "Bearing left",
+        "Veering left",
+    ],
+    "Straight-Right": [
+        "Straight then right",
+        "Forward followed by a right turn",
+        "Proceed straight, then veer right",
+        "Continue straight before turning right",
+        "Advance straight, then bear right",
+        "Go straight, then curve right",
+        "Head straight, then pivot right",
+        "Move straight, then angle right",
+        "Straight-line, followed by a right deviation",
+        "Directly ahead, then a rightward shift",
+    ],
+    "Straight-Left": [
+        "Straight then left",
+        "Forward followed by a left turn",
+        "Proceed straight, then veer left",
+        "Continue straight before turning left",
+        "Advance straight, then bear left",
+        "Go straight, then curve left",
+        "Head straight, then pivot left",
+        "Move straight, then angle left",
+        "Straight-line, followed by a left deviation",
+        "Directly ahead, then a leftward shift",
+    ],
+    "Straight": [
+        "Directly ahead",
+        "Forward",
+        "Straightforward",
+        "In a straight line",
+        "Linearly",
+        "Unswervingly",
+        "Onward",
+        "Direct path",
+        "True course",
+        "Non-curving path",
+    ],
+}
+
+SCENARIO_SYNONYMS = {
+    "vehicle": [
+        "Automobile",
+        "Car",
+        "Motor vehicle",
+        "Conveyance",
+        "Transport",
+        "Machine",
+        "Motorcar",
+        "Auto",
+        "Truck",
+        "Van",
+    ],
+    "pedestrian": [
+        "Walker",
+        "Foot traveler",
+        "Stroller",
+        "Hiker",
+        "Jogger",
+        "Passerby",
+        "Wayfarer",
+        "Ramblers",
+        "Perambulator",
+        "Pedestrian traffic",
+    ],
+    "cyclist": [
+        "Biker",
+        "Bicycle rider",
+        "Bike enthusiast",
+        "Cyclist",
+        "Mountain biker",
+        "Road cyclist",
+        "Bicyclist",
+        "Cycle rider",
+        "Velocipedist",
+        "BMX rider",
+    ],
+    "freeway": [
+        "Expressway",
+        "Highway",
+        "Motorway",
+        "Interstate",
+        "Turnpike",
+        "Tollway",
+        "Superhighway",
+        "Thruway",
+        "Autobahn",
+        "Dual carriageway",
+    ],
+    "surface_street": [
+        "Road",
+        "City street",
+        "Urban roadway",
+        "Town road",
+        "Local street",
+        "Main street",
+        "Secondary road",
+        "Residential street",
+        "Public road",
+        "Thoroughfare",
+    ],
+    "bike_lane": [
+        "Bicycle path",
+        "Cycling lane",
+        "Bike path",
+        "Bicycle track",
+        "Cycle path",
+        "Bike trail",
+        "Cycling track",
+        "Bicycle lane",
+        "Bike route",
+        "Cycling route",
+    ],
+    "stop_sign": [
+        "Stop signal",
+        "Traffic stop sign",
+        "Road stop indicator",
+        "STOP board",
+        "Halt sign",
+        "Stop traffic sign",
+        "Roadblock sign",
+        "Intersection control sign",
+        "Mandatory stop sign",
+        "Octagonal traffic sign",
+    ],
+    "crosswalk": [
+        "Pedestrian crossing",
+        "Zebra crossing",
+        "Walkway",
+        "Crossing path",
+        "Pedestrian path",
+        "Cross path",
+        "Footpath",
+        "Pedestrian walkway",
+        "Street crossing",
+        "Pedestrian crossway",
+    ],
+    "speed_bump": [
+        "Speed hump",
+        "Traffic bump",
+        "Road hump",
+        "Speed breaker",
+        "Traffic calming measure",
+        "Speed bar",
+        "Rubber bump",
+        "Sleeping policeman",
+        "Traffic hump",
+        "Road bump",
+    ],
+    "driveway": [
+        "Drive",
+        "Private road",
+        "Carriageway",
+        "Access road",
+        "Residential drive",
+        "Entryway",
+        "Service road",
+        "Approach road",
+        "Front drive",
+        "Pathway",
+    ],
+    "parking_lot": [
+        "Car park",
+        "Parking area",
+        "Parking space",
+        "Vehicle parking",
+        "Auto lot",
+        "Parking garage",
+        "Parking ground",
+        "Motor park",
+        "Parkade",
+        "Parking deck",
+    ],
+    "intersection": [
+        "Crossroads",
+        "Junction",
+        "Road junction",
+        "Traffic intersection",
+        "Crossway",
+        "Four-way",
+        "Roundabout",
+        "T-intersection",
+        "Road crossing",
+        "Interchange",
+    ],
+    "turnaround": [
+        "U-turn spot",
+        "Turnabout area",
+        "Revolving area",
+        "Swing area",
+        "Turning point",
+        "Circular drive",
+        "Loop area",
+        "Turnback area",
+        "Rotating space",
+        "180-degree turn area",
+    ],
+}
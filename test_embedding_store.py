@@ -0,0 +1,30 @@
+import numpy as np
+
+from embedding_store import EmbeddingStore
+
+
+def make_store(directory, num_rows: int = 50, dim: int = 8) -> EmbeddingStore:
+    rows = np.random.default_rng(0).normal(size=(num_rows, dim)).astype(np.float32)
+    return EmbeddingStore.write(str(directory), rows, "test")
+
+
+def test_search_with_all_false_mask_returns_empty(tmp_path):
+    store = make_store(tmp_path / "store")
+    queries = np.random.default_rng(1).normal(size=(3, 8))
+
+    scores, ids = store.search(queries, k=5, mask=np.zeros(len(store), dtype=bool))
+
+    assert scores.shape == (3, 0)
+    assert ids.shape == (3, 0)
+
+
+def test_quantized_search_with_all_false_mask_returns_empty(tmp_path):
+    store = make_store(tmp_path / "store")
+    store.quantize()
+    store = EmbeddingStore(str(tmp_path / "store"), quantized=True)
+    queries = np.random.default_rng(1).normal(size=(3, 8))
+
+    scores, ids = store.search(queries, k=5, mask=np.zeros(len(store), dtype=bool))
+
+    assert scores.shape == (3, 0)
+    assert ids.shape == (3, 0)
@@ -0,0 +1,37 @@
+import numpy as np
+
+from mutable_embedding_store import MutableEmbeddingStore
+
+
+def make_index(tmp_path, num_rows: int = 100, dim: int = 8) -> MutableEmbeddingStore:
+    rows = np.random.default_rng(0).normal(size=(num_rows, dim)).astype(np.float32)
+    np.save(tmp_path / "source.npy", rows)
+    return MutableEmbeddingStore.create(
+        str(tmp_path / "index"),
+        str(tmp_path / "source.npy"),
+        [f"vehicle_a_{i}.npz" for i in range(num_rows)],
+    )
+
+
+def test_search_after_deleting_a_whole_segment(tmp_path):
+    store = make_index(tmp_path)
+    rows = np.random.default_rng(1).normal(size=(10, 8)).astype(np.float32)
+    appended = store.append(rows, [f"vehicle_b_{i}.npz" for i in range(10)])
+    store.delete(appended)
+
+    scores, ids = store.search(rows, k=5)
+
+    assert scores.shape == (10, 5)
+    assert not np.isin(ids, appended).any()
+
+
+def test_search_with_mask_outside_all_live_rows(tmp_path):
+    store = make_index(tmp_path)
+    store.delete(np.arange(10))
+    mask = np.zeros(100, dtype=bool)
+    mask[:10] = True
+
+    scores, ids = store.search(np.ones(8), k=5, mask=mask)
+
+    assert scores.shape == (1, 0)
+    assert ids.shape == (1, 0)
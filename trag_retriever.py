@@ -2,14 +2,29 @@ import numpy as np
 import json
 from npz_utils import list_vehicle_files_absolute
 import torch
-from uae_explore import encode_with_uae
-
-from sklearn.metrics import roc_curve, roc_auc_score
-import matplotlib.pyplot as plt
+from uae_explore import encode_batch_with_uae
+from embedding_store import EmbeddingStore, normalize_rows
+from retrieval_evaluation import evaluate_retrieval, write_report
+from scenario_bitmap_index import ScenarioBitmapIndex
+from scenario_combination_index import ScenarioCombinationIndex
+from mutable_embedding_store import MutableEmbeddingStore
+from retrieval_cache import QueryCache, file_version
+from query_router import QueryRouter
+import time
 
 
 class TRAGRetriever:
-    def __init__(self):
+    def __init__(self, embedding_store=None, vehicle_list=None):
+        """
+        Args:
+            embedding_store: Store to retrieve from, e.g. a ShardedEmbeddingStore
+                or a MutableEmbeddingStore that is updated in place. Defaults
+                to the vehicle_a store. The direction labels and scenario
+                bitmaps cover the vehicle_a rows only, so other stores need the
+                same rows in the same order.
+            vehicle_list (list): File paths in the row order of the store.
+                Defaults to the vehicle_a files.
+        """
 
         self.direction_index_mapping = {
             "Left": 0,
@@ -41,11 +56,25 @@ class TRAGRetriever:
         with open("datasets/synonyms_uae_cache.json") as synonym_cache:
             self.synonym_embedding_cache = json.load(synonym_cache)
         print("Finished")
-
-        print("Loading trajectory encoder output...")
-        self.encoded_trajectories_indirect = np.load(
-            "datasets/encoder_output_a_mse.npy"
+        print("Loading scenario synonym embedding cache...")
+        with open(
+            "datasets/scenario_synonym_embedding_cache.json"
+        ) as scenario_synonym_cache:
+            scenario_synonym_embedding_cache = json.load(scenario_synonym_cache)
+        print("Finished")
+        self.query_router = QueryRouter(
+            self.bucket_embedding_cache,
+            self.synonym_embedding_cache,
+            scenario_synonym_embedding_cache,
         )
+
+        print("Mapping trajectory embedding store...")
+        if embedding_store is None:
+            embedding_store = EmbeddingStore.open_or_build(
+                directory="datasets/trajectory_embedding_store",
+                source_path="datasets/encoder_output_a_mse.npy",
+            )
+        self.embedding_store = embedding_store
         print("Finished")
 
         with open("datasets/synonym_bucket_mapping.json") as synonym_bucket_mapping:
@@ -53,57 +82,257 @@ class TRAGRetriever:
 
         print("Loading trajectory buckets...")
         self.trajectory_buckets = np.load("datasets/raw_direction_labels.npy")
+        if not isinstance(embedding_store, MutableEmbeddingStore) and len(
+            embedding_store
+        ) != len(self.trajectory_buckets):
+            raise ValueError(
+                f"The embedding store has {len(embedding_store)} rows, but the "
+                f"direction labels cover {len(self.trajectory_buckets)} vehicle_a rows"
+            )
+        self.bucket_counts = np.bincount(
+            self.trajectory_buckets, minlength=len(self.index_direction_mapping)
+        )
 
         print("Finished")
 
-        print("Loading direct encoded trajectory buckets...")
-        self.encoded_trajectories_direct = np.zeros(
-            (self.trajectory_buckets.size, 1024)
-        )
-
-        for i, index in enumerate(self.trajectory_buckets):
-            self.encoded_trajectories_direct[i] = (
-                self.get_bucket_encoding_for_direction_index(index)
+        # Every trajectory is directly encoded by the embedding of its bucket,
+        # so direct retrieval only has to score the eight bucket embeddings.
+        self.bucket_embeddings = normalize_rows(
+            np.array(
+                [
+                    self.get_bucket_encoding_for_direction_index(index)
+                    for index in range(len(self.index_direction_mapping))
+                ],
+                dtype=np.float32,
             )
-        print(self.encoded_trajectories_direct.shape)
-
-        print("Finished")
-        self.vehicle_list = list_vehicle_files_absolute()
+        )
+        if vehicle_list is None:
+            vehicle_list = list_vehicle_files_absolute()
+        self.vehicle_list = vehicle_list
+        self.bitmap_index = None
+        self.scenario_index = None
+        self.query_cache = QueryCache(max_entries=1024, ttl_seconds=3600.0)
 
     def retrieve_trajectory_direct(self, user_input: str, k: int = 1):
-        embedded_user_input = torch.Tensor(encode_with_uae(user_input))
-        cos_sim = torch.nn.CosineSimilarity()
-        similarities = cos_sim(
-            torch.Tensor(self.encoded_trajectories_direct), embedded_user_input
-        )
-        torch.clamp(similarities, min=-1, max=1)
+        start = time.perf_counter()
+        key = self.cache_key(user_input, "direct", 10)
+        cached = self.query_cache.get(key)
+        if cached is not None:
+            self.query_router.record("cache", time.perf_counter() - start)
+            return cached
+
+        entry = self.query_router.route(user_input)
+        path = "embedding" if entry is None else "lexical"
+        if entry is not None and entry["target"][0] == "direction":
+            # Known direction phrases map straight to their bucket
+            embedded_user_input = self.bucket_embeddings[
+                self.direction_index_mapping[entry["target"][1]]
+            ]
+        else:
+            embedding = (
+                entry["embedding"]
+                if entry is not None
+                else encode_batch_with_uae([user_input])[0]
+            )
+            embedded_user_input = self.embedding_store.normalize_query(embedding)
+        bucket_similarities = self.bucket_embeddings @ embedded_user_input
+        similarities = torch.from_numpy(bucket_similarities[self.trajectory_buckets])
         values, indices = torch.topk(similarities, 10)
         vehicles = [self.get_vehicle_for_index(index) for index in indices]
-        values_list = values.tolist()
-        indices_list = indices.tolist()
-
-        # Print the values and indices
-        # print("Indices of top 10 values:", indices_list)
-        # print("Top 10 values:", values_list)
-        # print("Vehicles:", vehicles)
-        # print(similarities.shape)
+
+        self.query_cache.put(key, (values, indices, vehicles))
+        self.query_router.record(path, time.perf_counter() - start)
         return values, indices, vehicles
 
     def retrieve_trajectory_indirect(self, user_input: str, k: int = 1):
-        embedded_user_input = torch.Tensor(encode_with_uae(user_input))
-        cos_sim = torch.nn.CosineSimilarity()
-        similarities = cos_sim(
-            torch.Tensor(self.encoded_trajectories_indirect), embedded_user_input
+        values, indices, vehicles = self.retrieve_batch([user_input], k=k)
+        return (
+            torch.from_numpy(values[0]),
+            torch.from_numpy(indices[0]),
+            np.array(vehicles[0]),
+        )
+
+    def retrieve_batch(self, queries, k: int = 1, chunk_size: int = 65536):
+        """Indirect retrieval for many queries at once.
+
+        Args:
+            queries: Either a list of query texts or a ``(Q, 1024)`` matrix of
+                query embeddings.
+            k (int): Number of trajectories returned per query.
+            chunk_size (int): Number of corpus rows scored per matrix product.
+
+        Returns:
+            tuple: ``(values, indices, vehicles)`` where values and indices have
+            shape ``(Q, k)`` sorted by descending similarity and vehicles holds
+            the file names of the returned indices.
+        """
+        if len(queries) and isinstance(queries[0], str):
+            return self.retrieve_texts(
+                queries,
+                "trajectory",
+                k,
+                lambda embeddings: self.retrieve_batch(embeddings, k, chunk_size),
+            )
+        values, indices = self.embedding_store.search(
+            queries, k=k, chunk_size=chunk_size
         )
-        torch.clamp(similarities, min=-1, max=1)
-        values, indices = torch.topk(similarities, k)
-        vehicles = np.array([self.get_vehicle_for_index(index) for index in indices])
+        vehicles = [
+            [self.get_vehicle_for_index(index) for index in row] for row in indices
+        ]
         return values, indices, vehicles
 
+    def retrieve_filtered(
+        self,
+        queries,
+        k: int = 1,
+        features=(),
+        directions=(),
+        exclude_features=(),
+    ):
+        """Indirect retrieval restricted to trajectories matching a filter.
+
+        The bitmap index resolves the filter first. Selective filters score
+        only the surviving rows, unselective ones score the whole corpus and
+        drop non-matching rows afterwards.
+
+        Args:
+            queries: Query texts or a ``(Q, 1024)`` matrix of query embeddings.
+            k (int): Number of trajectories returned per query.
+            features (list): Scenario features every result must have.
+            directions (list): Direction buckets of which a result must have one.
+            exclude_features (list): Scenario features no result may have.
+
+        Returns:
+            tuple: ``(values, indices, vehicles)`` as in ``retrieve_batch``.
+        """
+        if len(queries) and isinstance(queries[0], str):
+            filter_key = (
+                tuple(sorted(features)),
+                tuple(sorted(directions)),
+                tuple(sorted(exclude_features)),
+            )
+            return self.retrieve_texts(
+                queries,
+                "filtered",
+                k,
+                lambda embeddings: self.retrieve_filtered(
+                    embeddings, k, features, directions, exclude_features
+                ),
+                filter_key=filter_key,
+            )
+        plan = self.get_bitmap_index().plan(features, directions, exclude_features)
+        values, indices = self.embedding_store.search(
+            queries, k=k, ids=plan.get("ids"), mask=plan.get("mask")
+        )
+        vehicles = [
+            [self.get_vehicle_for_index(index) for index in row] for row in indices
+        ]
+        return values, indices, vehicles
+
+    def get_bitmap_index(self):
+        if self.bitmap_index is None:
+            print("Building scenario bitmap index...")
+            self.bitmap_index = ScenarioBitmapIndex.from_files()
+            print("Finished")
+        return self.bitmap_index
+
     def retrieve_scenario_direct(self, user_input: str, k: int = 1):
-        pass
+        values, indices, vehicles = self.retrieve_scenario_batch([user_input], k=k)
+        return (
+            torch.from_numpy(values[0]),
+            torch.from_numpy(indices[0]),
+            np.array(vehicles[0]),
+        )
+
+    def retrieve_scenario_batch(self, queries, k: int = 1):
+        """Direct scenario retrieval for many queries at once.
+
+        Queries are scored against the distinct scenario feature combinations
+        only, and the best combinations are expanded to their scenarios.
+
+        Args:
+            queries: Query texts or a ``(Q, 1024)`` matrix of query embeddings.
+            k (int): Number of scenarios returned per query.
+
+        Returns:
+            tuple: ``(values, indices, vehicles)`` as in ``retrieve_batch``.
+        """
+        if len(queries) and isinstance(queries[0], str):
+            return self.retrieve_texts(
+                queries,
+                "scenario",
+                k,
+                lambda embeddings: self.retrieve_scenario_batch(embeddings, k),
+            )
+        values, indices = self.get_scenario_index().search(queries, k=k)
+        vehicles = [
+            [self.get_vehicle_for_index(index) for index in row] for row in indices
+        ]
+        return values, indices, vehicles
+
+    def get_scenario_index(self):
+        if self.scenario_index is None:
+            print("Building scenario combination index...")
+            self.scenario_index = ScenarioCombinationIndex.from_files()
+            print("Finished")
+        return self.scenario_index
+
+    def retrieve_texts(self, texts: list, mode: str, k: int, search, filter_key=()):
+        """Answers text queries from the query cache where possible.
+
+        The texts missing from the cache are embedded by the query router,
+        which only runs the UAE model for phrases it does not know, and
+        searched in one call to ``search``. Their results are cached.
+        """
+        start = time.perf_counter()
+        keys = [self.cache_key(text, mode, k, filter_key) for text in texts]
+        results = [self.query_cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        lookup_end = time.perf_counter()
+
+        paths = ["cache"] * len(texts)
+        if missing:
+            embeddings, missing_paths = self.query_router.encode(
+                [texts[i] for i in missing], encode_batch_with_uae
+            )
+            values, indices, vehicles = search(embeddings)
+            for row, i in enumerate(missing):
+                results[i] = (values[row], indices[row], vehicles[row])
+                self.query_cache.put(keys[i], results[i])
+                paths[i] = missing_paths[row]
+
+        # Per query latency: every query shares the cache lookup, the missing
+        # ones also share the embedding and search
+        lookup = (lookup_end - start) / len(texts)
+        search_share = (
+            (time.perf_counter() - lookup_end) / len(missing) if missing else 0.0
+        )
+        for path in paths:
+            self.query_router.record(
+                path, lookup if path == "cache" else lookup + search_share
+            )
+
+        return (
+            np.stack([result[0] for result in results]),
+            np.stack([result[1] for result in results]),
+            [result[2] for result in results],
+        )
+
+    def cache_key(self, text: str, mode: str, k: int, filter_key=()):
+        return self.query_cache.make_key(
+            text, mode, k, filter_key, version=self.index_version()
+        )
+
+    def index_version(self) -> tuple:
+        """Changes whenever the embedding matrix or the labels are rewritten."""
+        return self.embedding_store.version() + file_version(
+            "datasets/raw_direction_labels.npy",
+            "output/scenario_features.npy",
+        )
 
     def get_vehicle_for_index(self, index: int):
+        if isinstance(self.embedding_store, MutableEmbeddingStore):
+            return self.embedding_store.name_for_id(index)
         return self.vehicle_list[index].split("/")[-1]
 
     def get_bucket_encoding_for_direction_index(self, index: int):
@@ -111,156 +340,113 @@ class TRAGRetriever:
             self.bucket_embedding_cache[self.index_direction_mapping[index]]
         )
 
-    def benchmark_indirect_trajectory_retrieval(self):
-
-        occurences = {
-            "Left": 79230,
-            "Right": 68302,
-            "Stationary": 26222,
-            "Straight": 221035,
-            "Straight-Left": 35270,
-            "Straight-Right": 34643,
-            "Left-U-Turn": 2787,
-            "Right-U-Turn": 619,
-        }
-        cos_sim = torch.nn.CosineSimilarity()
-        for key in list(self.synonym_embedding_cache.keys()):
-            correct_bucket = self.synonym_bucket_mapping[key]
-            occurence = occurences[self.index_direction_mapping[correct_bucket]]
-
-            embedded_user_input = torch.Tensor(self.synonym_embedding_cache[key])
-            similarities = cos_sim(
-                torch.Tensor(self.encoded_trajectories_indirect), embedded_user_input
-            )
-            torch.clamp(similarities, min=-1, max=1)
-            values, indices = torch.topk(similarities, 468108)
-            vehicles = np.array(
-                [self.get_vehicle_for_index(index) for index in indices]
-            )
-            correct = 0
-            for i in indices[:occurence]:
-                if correct_bucket == self.trajectory_buckets[i]:
-                    correct += 1
-            print(key)
-            print(correct / occurence)
+    def benchmark_indirect_trajectory_retrieval(self, store=None, verbose: bool = True):
+        """Accuracy of every synonym among the top-k, with k the size of its bucket.
+
+        Args:
+            store: Store to search, e.g. a ProjectedEmbeddingStore. Defaults to
+                the retriever's embedding store.
+            verbose (bool): Whether every synonym and its accuracy is printed.
+        """
+        if store is None:
+            store = self.embedding_store
+        # Synonyms of the same bucket share k, so each group is one batched search
+        results = {}
+        keys = list(self.synonym_embedding_cache.keys())
+        for bucket in sorted({self.synonym_bucket_mapping[key] for key in keys}):
+            group = [key for key in keys if self.synonym_bucket_mapping[key] == bucket]
+            occurence = self.bucket_counts[bucket]
+            queries = np.array([self.synonym_embedding_cache[key] for key in group])
+            _, indices = store.search(queries, k=occurence)
+            accuracies = np.mean(self.trajectory_buckets[indices] == bucket, axis=1)
+            for key, accuracy in zip(group, accuracies):
+                if verbose:
+                    print(key)
+                    print(accuracy)
+                results[key] = float(accuracy)
+        return results
 
     def collect_scores_and_labels(self, key):
-        scores = []
-        labels = []
-        cos_sim = torch.nn.CosineSimilarity()
-
-        occurences = {
-            "Left": 79230,
-            "Right": 68302,
-            "Stationary": 26222,
-            "Straight": 221035,
-            "Straight-Left": 35270,
-            "Straight-Right": 34643,
-            "Left-U-Turn": 2787,
-            "Right-U-Turn": 619,
-        }
-
         correct_bucket = self.synonym_bucket_mapping[key]
-        occurence = occurences[self.index_direction_mapping[correct_bucket]]
+        occurence = self.bucket_counts[correct_bucket]
 
-        embedded_user_input = torch.Tensor(self.synonym_embedding_cache[key])
-        similarities = cos_sim(
-            torch.Tensor(self.encoded_trajectories_indirect), embedded_user_input
+        _, indices = self.embedding_store.search(
+            self.synonym_embedding_cache[key], k=occurence
         )
-        similarities = torch.clamp(similarities, min=-1, max=1)
-        _, indices = torch.topk(similarities, occurence)
-
-        preds = np.ones(occurence)
-        labels = np.array(self.trajectory_buckets[indices] == correct_bucket)
+        labels = self.trajectory_buckets[indices[0]] == correct_bucket
         print(key)
         print(f"Accuracy: {np.count_nonzero(labels)/occurence}")
-        # print(labels)
 
         return len(labels), labels
 
+    def evaluate_indirect_trajectory_retrieval(
+        self,
+        report_path: str = "output/direction_retrieval_report.json",
+        plot_folder: str = None,
+    ) -> dict:
+        """Evaluates indirect retrieval on the cached synonym embeddings.
+
+        Computes AUC, mAP, R-precision and precision/recall@k for every
+        synonym, their mean per direction bucket and the query latency
+        percentiles, and writes everything to one JSON report.
+
+        Args:
+            report_path (str): Where the JSON report is written.
+            plot_folder (str): If given, a ROC curve per synonym is saved there.
+        """
+        keys = list(self.synonym_embedding_cache.keys())
+        report = evaluate_retrieval(
+            query_embeddings={key: self.synonym_embedding_cache[key] for key in keys},
+            query_groups={
+                key: self.index_direction_mapping[self.synonym_bucket_mapping[key]]
+                for key in keys
+            },
+            relevance_masks={
+                direction: self.trajectory_buckets == index
+                for index, direction in self.index_direction_mapping.items()
+            },
+            score_fn=self.embedding_store.score,
+            plot_folder=plot_folder,
+        )
+        write_report(report, report_path)
+        return report
+
     def plot_roc_and_calculate_auc(self):
-        for key in list(self.synonym_embedding_cache.keys()):
-            occurence, labels = self.collect_scores_and_labels(key)
-
-            # Convert lists to numpy arrays for compatibility with scikit-learn functions
-            # scores = np.array(scores)
-            # print(scores[:10])
-            # labels = np.array(labels)
-
-            x, y = 0, 0
-            points_x = [x]
-            points_y = [y]
-
-            # Iterate through the boolean array
-            for value in labels:
-                if value:
-                    y += 1  # Move up for True
-                else:
-                    x += 1  # Move right for False
-                points_x.append(x)
-                points_y.append(y)
-
-            points_x = np.array(points_x) / (labels.shape[0] - np.count_nonzero(labels))
-            points_y = np.array(points_y) / np.count_nonzero(labels)
-
-            auc = np.trapz(points_y, points_x)
-
-            # Plot the ROC curve
-            plt.figure()
-            plt.plot(
-                points_x,
-                points_y,
-                color="darkorange",
-                lw=2,
-                label="ROC curve (area = %0.2f)" % auc,
-            )
-            plt.plot([0, 1], [0, 1], color="navy", lw=2, linestyle="--")
-            plt.xlim([0.0, 1.0])
-            plt.ylim([0.0, 1.05])
-            plt.xlabel("False Positive Rate")
-            plt.ylabel("True Positive Rate")
-            plt.title(f"Receiver Operating Characteristic ({key})")
-            plt.legend(loc="lower right")
-            plt.savefig(f"output/roc_{key}.png")
-
-
-# retriever = TRAGRetriever()
-# print(retriever.retrieve_trajectory_direct("Turn right")[1])
-# print(retriever.retrieve_trajectory_indirect("Turn right")[1])
-# retriever.benchmark_indirect_trajectory_retrieval()
-# retriever.plot_roc_and_calculate_auc()
-
-with open("datasets/results_indirect_retrieval.json") as results_indirect:
-    results = json.load(results_indirect)
-with open("datasets/synonym_bucket_mapping.json") as synonym_bucket_mapping:
-    mapping = json.load(synonym_bucket_mapping)
-
-direction_index_mapping = {
-    "Left": 0,
-    "Right": 1,
-    "Stationary": 2,
-    "Straight": 3,
-    "Straight-Left": 4,
-    "Straight-Right": 5,
-    "Right-U-Turn": 6,
-    "Left-U-Turn": 7,
-}
-
-accuracies = {}
-output = {}
-keys = list(direction_index_mapping.keys())
-for key in keys:
-    accuracies = []
-    bucket_number = direction_index_mapping[key]
-    sum = 0
-    for entry in results.items():
-        synonym, accuracy = entry
-        if mapping[synonym] == bucket_number:
-            accuracies.append(accuracy)
-            output[key] = accuracies
-            sum += accuracy
-    mean = np.array(output[key]).mean()
-    std_dev = np.array(output[key]).std()
-    print(key)
-    print(mean)
-    print(std_dev)
+        return self.evaluate_indirect_trajectory_retrieval(plot_folder="output")
+
+
+if __name__ == "__main__":
+    with open("datasets/results_indirect_retrieval.json") as results_indirect:
+        results = json.load(results_indirect)
+    with open("datasets/synonym_bucket_mapping.json") as synonym_bucket_mapping:
+        mapping = json.load(synonym_bucket_mapping)
+
+    direction_index_mapping = {
+        "Left": 0,
+        "Right": 1,
+        "Stationary": 2,
+        "Straight": 3,
+        "Straight-Left": 4,
+        "Straight-Right": 5,
+        "Right-U-Turn": 6,
+        "Left-U-Turn": 7,
+    }
+
+    accuracies = {}
+    output = {}
+    keys = list(direction_index_mapping.keys())
+    for key in keys:
+        accuracies = []
+        bucket_number = direction_index_mapping[key]
+        sum = 0
+        for entry in results.items():
+            synonym, accuracy = entry
+            if mapping[synonym] == bucket_number:
+                accuracies.append(accuracy)
+                output[key] = accuracies
+                sum += accuracy
+        mean = np.array(output[key]).mean()
+        std_dev = np.array(output[key]).std()
+        print(key)
+        print(mean)
+        print(std_dev)
@@ -1,3 +1,4 @@
+import os
 import torch
 from trajectory_encoder_dataset import TrajectoryEncoderDataset
 from torch.utils.data import DataLoader
@@ -7,6 +8,7 @@ from torch import nn
 import numpy as np
 
 from ego_trajectory_encoder import EgoTrajectoryEncoder
+from training_profiler import StepProfiler
 
 
 encoder = EgoTrajectoryEncoder()
@@ -16,7 +18,7 @@ optimizer = torch.optim.Adam(encoder.parameters(), lr=1e-4)
 # criterion = torch.nn.MSELoss(reduction="mean").cuda()
 # criterion = torch.nn.L1Loss().cuda()
 
-criterion = nn.CosineSimilarity().cuda()
+criterion = nn.CosineSimilarity()
 
 dataset = TrajectoryEncoderDataset()
 
@@ -39,10 +41,18 @@ train_sampler = SubsetRandomSampler(train_indices)
 valid_sampler = SubsetRandomSampler(val_indices)
 
 train_dataloader = torch.utils.data.DataLoader(
-    dataset, batch_size=batch_size, sampler=train_sampler
+    dataset,
+    batch_size=batch_size,
+    sampler=train_sampler,
+    collate_fn=dataset.collate,
+    num_workers=4,
 )
 validation_dataloader = torch.utils.data.DataLoader(
-    dataset, batch_size=batch_size, sampler=valid_sampler
+    dataset,
+    batch_size=batch_size,
+    sampler=valid_sampler,
+    collate_fn=dataset.collate,
+    num_workers=4,
 )
 
 
@@ -55,8 +65,12 @@ wandb.init()
 # Magic
 wandb.watch(encoder, log_freq=100)
 
-device = "cuda"
+device = "cuda" if torch.cuda.is_available() else "cpu"
+# Opt-in bf16 autocast on CPUs (TRAJECTORY_ENCODER_BF16=1), for several
+# processes see cpu_distributed_training.py
+use_bf16 = device == "cpu" and os.environ.get("TRAJECTORY_ENCODER_BF16") == "1"
 encoder.to(device)
+profiler = StepProfiler(device)
 
 # for epoch in range(1):  # loop over the dataset multiple times
 #     running_loss = 0.0
@@ -90,32 +104,47 @@ encoder.to(device)
 for epoch in range(10):  # Assuming you want to train for 10 epochs
     encoder.train()  # Set model to training mode
     running_loss = 0.0
-    for i, data in enumerate(train_dataloader):
+    for i, data in enumerate(profiler.iterate(train_dataloader)):
         inputs, labels = data
-        inputs, labels = inputs.to(device), labels.to(device)
+        with profiler.phase("transfer"):
+            inputs, labels = inputs.to(device), labels.to(device)
 
         optimizer.zero_grad()
 
-        outputs = encoder(inputs)
-        # loss = criterion(outputs, labels)
-
-        # For Cosine Similarity Loss function
-
-        loss = torch.mean(torch.abs(criterion(labels, outputs)))
-        print(loss)
+        with profiler.phase("forward"):
+            with torch.autocast("cpu", dtype=torch.bfloat16, enabled=use_bf16):
+                outputs = encoder(inputs).float()
+            # loss = criterion(outputs, labels)
 
-        # back-propagation on the above *loss* will try cos(angle) = 0. But I want angle between the vectors to be 0 or cos(angle) = 1.
+            # For Cosine Similarity Loss function
 
-        loss = 1 - loss
+            loss = torch.mean(torch.abs(criterion(labels, outputs)))
 
-        # End: For Cosine Similarity loss function
+            # back-propagation on the above *loss* will try cos(angle) = 0. But I want angle between the vectors to be 0 or cos(angle) = 1.
 
-        loss.backward()
-        optimizer.step()
+            loss = 1 - loss
 
-        running_loss += loss.item()
-        if i % 10 == 0:  # Log training loss every 10 mini-batches
-            wandb.log({"train_loss": loss.item()})
+            # End: For Cosine Similarity loss function
+
+        with profiler.phase("backward"):
+            loss.backward()
+        with profiler.phase("optimizer"):
+            optimizer.step()
+
+        # Logging is a phase of its own, not part of the next data wait
+        with profiler.phase("logging"):
+            running_loss += loss.item()
+            if i % 10 == 0:  # Log training loss every 10 mini-batches
+                summary = profiler.summary()
+                wandb.log(
+                    {
+                        "train_loss": loss.item(),
+                        **{f"profiler/{key}": value for key, value in summary.items()},
+                    }
+                )
+            if i % 100 == 99:
+                print(profiler.format_summary())
+        profiler.step_end(len(inputs))
 
     # Validation phase
     encoder.eval()  # Set model to evaluation mode
@@ -126,7 +155,8 @@ for epoch in range(10):  # Assuming you want to train for 10 epochs
             inputs, labels = data
             inputs, labels = inputs.to(device), labels.to(device)
 
-            outputs = encoder(inputs)
+            with torch.autocast("cpu", dtype=torch.bfloat16, enabled=use_bf16):
+                outputs = encoder(inputs).float()
             # loss = criterion(outputs, labels)
             loss = torch.mean(torch.abs(criterion(labels, outputs)))
             print(loss)
@@ -146,3 +176,4 @@ for epoch in range(10):  # Assuming you want to train for 10 epochs
 
 
 torch.save(encoder.state_dict(), "models/trajectory_encoder_wv_cos.pth")
+profiler.export_chrome_trace("output/trajectory_encoder_trace.json")
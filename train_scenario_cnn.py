@@ -1,3 +1,4 @@
+import os
 import numpy as np
 from npz_utils import list_vehicle_files_absolute
 import pytorch_lightning as pl
@@ -5,9 +6,11 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 from torch.utils.data import DataLoader, TensorDataset
-from scenario_encoder_dataset import ScenarioEncoderDataset
+from scenario_encoder_dataset import ScenarioRasterStream
 from pytorch_lightning.loggers import WandbLogger
-from scenario_cnn import SimpleCNN
+from scenario_cnn import ScenarioCNN
+from raster_codec import RasterStore
+from training_profiler import ThroughputProfiler
 
 # Dummy dataset with 1 sample for demonstration purposes
 # You will need to replace this with your actual dataset
@@ -15,11 +18,18 @@ torch.cuda.empty_cache()
 x_dummy = torch.randn(1, 25, 224, 224)
 y_dummy = torch.randn(1, 1024)  # Output dummy vector with 1024 dimensions
 
-dataset = ScenarioEncoderDataset()
-dataloader = DataLoader(dataset, batch_size=1)
+# Rasters are streamed from the bit-packed raster store (python raster_codec.py)
+# or else from the corpus. Instead of random targets the CNN learns the
+# trajectory embeddings of the same vehicles, in the same order.
+# ScenarioCNN advances the epoch of the stream, see on_train_epoch_start
+dataset = ScenarioRasterStream(
+    RasterStore() if os.path.exists("datasets/raster_store") else None,
+    targets=np.load("datasets/encoder_output_a_mse.npy", mmap_mode="r"),
+)
+dataloader = DataLoader(dataset, batch_size=32, num_workers=8, pin_memory=True)
 
 # Instantiate the model
-model = SimpleCNN()
+model = ScenarioCNN()
 
 
 def print_allocated_memory():
@@ -28,7 +38,12 @@ def print_allocated_memory():
 
 # Train the model
 wandb_logger = WandbLogger(log_model="all")
-trainer = pl.Trainer(max_epochs=10, logger=wandb_logger)
+# Logs where the time of a training step goes, see training_profiler.py
+trainer = pl.Trainer(
+    max_epochs=10,
+    logger=wandb_logger,
+    callbacks=[ThroughputProfiler(trace_path="output/scenario_cnn_trace.json")],
+)
 wandb_logger.watch(model)
 
 trainer.fit(model, dataloader)
@@ -37,7 +52,7 @@ path = list_vehicle_files_absolute()[0]
 scenario = np.load(path)
 vectors = scenario["raster"]
 
-vectors = vectors.reshape(1, 25, 224, 224)
+vectors = vectors.transpose(2, 0, 1).reshape(1, 25, 224, 224) / 255
 
 
 print("Model has been trained")
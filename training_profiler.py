@@ -0,0 +1,306 @@
+import json
+import os
+import resource
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+
+PHASES = ("data_wait", "transfer", "augmentation", "forward", "backward", "optimizer")
+
+
+def batch_size_of(batch) -> int:
+    """Leading dimension of the first tensor in a (nested) batch."""
+    if isinstance(batch, torch.Tensor):
+        return len(batch)
+    if isinstance(batch, dict):
+        batch = list(batch.values())
+    if isinstance(batch, (tuple, list)):
+        for item in batch:
+            size = batch_size_of(item)
+            if size:
+                return size
+    return 0
+
+
+class StepProfiler:
+    """Times the phases of every training step.
+
+    A step runs from the end of the previous step to ``step_end`` and is
+    split into phases, usually ``PHASES``. Phases are timed with ``phase``
+    (or ``begin`` and ``end``). The time from the end of the previous step
+    until a batch is ready is the data wait. The last ``window`` steps make
+    up the rolling summary. The last ``max_events`` phases are kept for a
+    Chrome trace, which can be opened in chrome://tracing or Perfetto.
+
+    On CUDA the device is synchronized at every phase boundary. Otherwise
+    asynchronous kernels would be counted in whichever phase waits for them.
+
+    Example for a plain training loop::
+
+        profiler = StepProfiler(device)
+        for inputs, labels in profiler.iterate(dataloader):
+            with profiler.phase("transfer"):
+                inputs, labels = inputs.to(device), labels.to(device)
+            with profiler.phase("forward"):
+                loss = criterion(model(inputs), labels)
+            ...
+            profiler.step_end(len(inputs))
+    """
+
+    def __init__(
+        self,
+        device=None,
+        window: int = 50,
+        max_events: int = 100000,
+        synchronize: bool = True,
+    ):
+        """
+        Args:
+            device: Device of the model, for synchronizing and peak memory.
+            window (int): Steps in the rolling summary.
+            max_events (int): Phases kept for the Chrome trace.
+            synchronize (bool): Whether CUDA is synchronized between phases.
+        """
+        self.device = torch.device("cpu" if device is None else device)
+        self.synchronize = synchronize and self.device.type == "cuda"
+        self.steps = deque(maxlen=window)
+        self.events = deque(maxlen=max_events)
+        self.origin = time.perf_counter()
+        self.current = {}
+        self.running = {}
+        self.last_step_end = None
+        self.num_steps = 0
+
+    def now(self) -> float:
+        if self.synchronize:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def start(self):
+        """Starts the first step, e.g. at the start of an epoch."""
+        self.current = {}
+        self.running = {}
+        self.last_step_end = self.now()
+
+    def begin(self, name: str, start: float = None):
+        self.running[name] = self.now() if start is None else start
+
+    def end(self, name: str):
+        if name not in self.running:
+            return
+        start = self.running.pop(name)
+        duration = self.now() - start
+        self.current[name] = self.current.get(name, 0.0) + duration
+        self.events.append((name, start, duration, self.num_steps))
+
+    @contextmanager
+    def phase(self, name: str):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def data_ready(self):
+        """Marks that the batch of this step is ready."""
+        if self.last_step_end is None:
+            self.start()
+        self.begin("data_wait", self.last_step_end)
+        self.end("data_wait")
+
+    def iterate(self, dataloader):
+        """Yields the batches of ``dataloader`` and times the wait for each."""
+        self.start()
+        for batch in dataloader:
+            self.data_ready()
+            yield batch
+
+    def step_end(self, batch_size: int):
+        if self.last_step_end is None:
+            self.start()
+        end = self.now()
+        step = dict(self.current)
+        step["step"] = end - self.last_step_end
+        step["samples"] = batch_size
+        self.events.append(("step", self.last_step_end, step["step"], self.num_steps))
+        self.steps.append(step)
+        self.current = {}
+        self.running = {}
+        self.last_step_end = end
+        self.num_steps += 1
+
+    def peak_memory_mb(self) -> float:
+        """Peak CUDA memory allocated, or the peak resident memory on the CPU."""
+        if self.device.type == "cuda":
+            return torch.cuda.max_memory_allocated(self.device) / 2**20
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def summary(self) -> dict:
+        """Mean phase times in ms, samples/s and peak memory of the window.
+
+        "other_ms" is the time of a step that is in none of its phases.
+        """
+        if not self.steps:
+            return {}
+        recorded = set().union(*self.steps) - {"step", "samples"}
+        names = [name for name in PHASES if name in recorded]
+        names += sorted(recorded - set(PHASES))
+        total = sum(step["step"] for step in self.steps)
+        summary = {}
+        for name in names:
+            summary[f"{name}_ms"] = 1000 * float(
+                np.mean([step.get(name, 0.0) for step in self.steps])
+            )
+        summary["step_ms"] = 1000 * total / len(self.steps)
+        summary["other_ms"] = summary["step_ms"] - sum(
+            summary[f"{name}_ms"] for name in names
+        )
+        summary["samples_per_second"] = (
+            sum(step["samples"] for step in self.steps) / total
+        )
+        summary["peak_memory_mb"] = self.peak_memory_mb()
+        return summary
+
+    def format_summary(self) -> str:
+        summary = self.summary()
+        if not summary:
+            return f"Step {self.num_steps}: no steps recorded"
+        phases = ", ".join(
+            f"{key[:-3]} {value:.1f}"
+            for key, value in summary.items()
+            if key.endswith("_ms") and key != "step_ms"
+        )
+        return (
+            f"Step {self.num_steps}: {summary['samples_per_second']:.1f} samples/s, "
+            f"{summary['step_ms']:.1f} ms/step ({phases}), "
+            f"peak memory {summary['peak_memory_mb']:.0f} MB"
+        )
+
+    def export_chrome_trace(self, path: str = "output/training_trace.json"):
+        """Saves the recorded phases in the Chrome trace event format."""
+        pid = os.getpid()
+        events = [
+            {
+                "name": name,
+                "cat": "step" if name == "step" else "phase",
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": duration * 1e6,
+                "pid": pid,
+                "tid": 0,
+                "args": {"step": step},
+            }
+            for name, start, duration, step in self.events
+        ]
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+        print(f"Saved {len(events)} trace events to {path}")
+
+
+class ThroughputProfiler(pl.Callback):
+    """Step profiling of Lightning training, e.g. ``REDEncoder`` or ``ScenarioCNN``.
+
+    Phases of a training step:
+    - data_wait: from the end of the previous step until the next batch
+      reaches ``on_before_batch_transfer``.
+    - transfer: host-to-device copy of the batch.
+    - augmentation: ``on_after_batch_transfer``, which creates the second
+      view in ``REDEncoder`` and converts rasters in ``ScenarioCNN``.
+    - forward: ``training_step`` up to the backward pass.
+    - backward and optimizer: the backward pass and the optimizer step.
+
+    Lightning prefetches one batch, so the wait for a batch shows up one
+    step early. Every ``log_every_n_steps`` steps the rolling summary is
+    logged as ``profiler/*`` metrics and printed.
+    """
+
+    def __init__(
+        self,
+        window: int = 50,
+        log_every_n_steps: int = 50,
+        trace_path: str = None,
+        synchronize: bool = True,
+    ):
+        """
+        Args:
+            window (int): Steps in the rolling summary.
+            log_every_n_steps (int): Steps between two summaries.
+            trace_path (str): Where a Chrome trace is saved when training
+                ends. Also available on demand from ``profiler``.
+            synchronize (bool): Whether CUDA is synchronized between phases.
+        """
+        self.window = window
+        self.log_every_n_steps = log_every_n_steps
+        self.trace_path = trace_path
+        self.synchronize = synchronize
+        self.profiler = None
+
+    def on_train_start(self, trainer, pl_module):
+        self.profiler = StepProfiler(
+            pl_module.device, self.window, synchronize=self.synchronize
+        )
+        profiler = self.profiler
+        before_batch_transfer = pl_module.on_before_batch_transfer
+        after_batch_transfer = pl_module.on_after_batch_transfer
+
+        # Callbacks have no hooks around the batch transfer, so the hooks of
+        # the module are wrapped for the time of the training
+        @wraps(before_batch_transfer)
+        def on_before_batch_transfer(batch, dataloader_idx):
+            if trainer.training:
+                profiler.data_ready()
+                profiler.begin("transfer")
+            return before_batch_transfer(batch, dataloader_idx)
+
+        @wraps(after_batch_transfer)
+        def on_after_batch_transfer(batch, dataloader_idx):
+            if not trainer.training:
+                return after_batch_transfer(batch, dataloader_idx)
+            profiler.end("transfer")
+            with profiler.phase("augmentation"):
+                return after_batch_transfer(batch, dataloader_idx)
+
+        pl_module.on_before_batch_transfer = on_before_batch_transfer
+        pl_module.on_after_batch_transfer = on_after_batch_transfer
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self.profiler.start()
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        self.profiler.begin("forward")
+
+    def on_before_backward(self, trainer, pl_module, loss):
+        self.profiler.end("forward")
+        self.profiler.begin("backward")
+
+    def on_after_backward(self, trainer, pl_module):
+        self.profiler.end("backward")
+
+    def on_before_optimizer_step(self, trainer, pl_module, optimizer):
+        self.profiler.begin("optimizer")
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self.profiler.end("optimizer")
+        self.profiler.step_end(batch_size_of(batch))
+        if self.profiler.num_steps % self.log_every_n_steps == 0:
+            summary = self.profiler.summary()
+            pl_module.log_dict(
+                {f"profiler/{key}": value for key, value in summary.items()}
+            )
+            if trainer.is_global_zero:
+                print(self.profiler.format_summary())
+
+    def on_train_end(self, trainer, pl_module):
+        del pl_module.on_before_batch_transfer
+        del pl_module.on_after_batch_transfer
+        if self.trace_path is not None and trainer.is_global_zero:
+            self.profiler.export_chrome_trace(self.trace_path)
+
+    def export_chrome_trace(self, path: str = "output/training_trace.json"):
+        self.profiler.export_chrome_trace(path)
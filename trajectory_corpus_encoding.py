@@ -0,0 +1,128 @@
+import json
+import os
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from ego_trajectory_encoder import EgoTrajectoryEncoder
+
+
+def load_trajectory_encoder(
+    model_path: str = "models/trajectory_encoder_wv_cos.pth", device: str = "cuda"
+) -> EgoTrajectoryEncoder:
+    model = EgoTrajectoryEncoder()
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model.eval()
+    return model.to(device)
+
+
+def encode_coordinates(
+    model: EgoTrajectoryEncoder,
+    coordinates: np.ndarray,
+    batch_size: int = 1024,
+    device: str = "cuda",
+    dtype=np.float32,
+) -> np.ndarray:
+    """Encodes ``(N, T, 2)`` trajectories in batches.
+
+    Returns:
+        np.ndarray: ``(N, dim)`` embeddings.
+    """
+    outputs = np.empty((len(coordinates), model.linear.out_features), dtype=dtype)
+    with torch.inference_mode():
+        for start in range(0, len(coordinates), batch_size):
+            # Copy out of the read-only memory map
+            batch = torch.from_numpy(
+                np.array(coordinates[start : start + batch_size], dtype=np.float32)
+            )
+            outputs[start : start + len(batch)] = (
+                model(batch.to(device, non_blocking=True)).float().cpu().numpy()
+            )
+    return outputs
+
+
+def encode_trajectory_corpus(
+    model: EgoTrajectoryEncoder,
+    coordinates_path: str = "datasets/trajectory_coordinates.npy",
+    output_path: str = "datasets/encoder_output_a_cos.npy",
+    batch_size: int = 1024,
+    dtype: str = "float32",
+    device: str = "cuda",
+    checkpoint_every: int = 64,
+    model_path: str = None,
+) -> np.ndarray:
+    """Encodes the trajectory coordinate store into a preallocated ``.npy`` file.
+
+    Row i of the output is the embedding of row i of the coordinate store,
+    which follows ``list_vehicle_files_absolute`` like the ids of the
+    embedding index created from it. Rows are written straight into the
+    memory-mapped output. Every ``checkpoint_every`` batches the output is
+    flushed and the number of finished rows is saved, so an interrupted run
+    resumes after the last checkpoint. A run only resumes if the coordinate
+    store and the model checkpoint are unchanged since.
+
+    Args:
+        model (EgoTrajectoryEncoder): Encoder, in eval mode on ``device``.
+        coordinates_path (str): ``(N, T, 2)`` float32 coordinate store, see
+            ``create_trajectory_coordinate_store``.
+        output_path (str): ``(N, dim)`` output file.
+        batch_size (int): Trajectories encoded at once.
+        dtype (str): "float32" or "float16" output rows.
+        device (str): Device of the model.
+        checkpoint_every (int): Batches between two checkpoints.
+        model_path (str): Checkpoint the model was loaded from. Without it a
+            run also resumes after the model was retrained.
+
+    Returns:
+        np.ndarray: The memory-mapped output.
+    """
+    coordinates = np.load(coordinates_path, mmap_mode="r")
+    shape = (len(coordinates), model.linear.out_features)
+    progress_path = os.path.splitext(output_path)[0] + "_progress.json"
+    source = {
+        "coordinates": os.path.abspath(coordinates_path),
+        "coordinates_mtime": os.stat(coordinates_path).st_mtime_ns,
+        "shape": list(shape),
+        "dtype": dtype,
+    }
+    if model_path is not None:
+        source["model"] = os.path.abspath(model_path)
+        source["model_mtime"] = os.stat(model_path).st_mtime_ns
+
+    start = 0
+    if os.path.exists(progress_path) and os.path.exists(output_path):
+        with open(progress_path) as progress_file:
+            progress = json.load(progress_file)
+        if progress["source"] == source:
+            start = progress["rows"]
+    if start:
+        print(f"Resuming at row {start} of {shape[0]}")
+        output = np.load(output_path, mmap_mode="r+")
+    else:
+        output = np.lib.format.open_memmap(
+            output_path, mode="w+", dtype=dtype, shape=shape
+        )
+
+    def checkpoint(rows):
+        output.flush()
+        with open(progress_path + ".tmp", "w") as progress_file:
+            json.dump({"source": source, "rows": rows}, progress_file)
+        os.replace(progress_path + ".tmp", progress_path)
+
+    batch_starts = range(start, shape[0], batch_size)
+    for i, batch_start in enumerate(tqdm(batch_starts)):
+        batch_end = min(batch_start + batch_size, shape[0])
+        output[batch_start:batch_end] = encode_coordinates(
+            model, coordinates[batch_start:batch_end], batch_size, device, dtype
+        )
+        if (i + 1) % checkpoint_every == 0:
+            checkpoint(batch_end)
+    checkpoint(shape[0])
+    print("Finished")
+    return output
+
+
+if __name__ == "__main__":
+    model_path = "models/trajectory_encoder_wv_cos.pth"
+    encode_trajectory_corpus(load_trajectory_encoder(model_path), model_path=model_path)
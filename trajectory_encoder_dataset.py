@@ -1,35 +1,114 @@
 from torch.utils.data import Dataset
 import torch
-from uae_explore import encode_with_uae
+import numpy as np
 
 import json
 
+from scenario_bitmap_index import DIRECTION_BUCKETS
+
 
 class TrajectoryEncoderDataset(Dataset):
-    def __init__(self, device="cuda:0"):
-        with open("datasets/processed_vehicle_a.json") as file:
-            self.data_json = json.load(file)
-            self.items = list(self.data_json.values())
-            self.coordinates = torch.Tensor([item["Coordinates"] for item in self.items])
+    """Trajectories and direction labels for training the trajectory encoder.
+
+    The coordinates are a memory-mapped ``(N, T, 2)`` float32 array and the
+    direction labels a ``(N,)`` uint8 column of ``DIRECTION_BUCKETS`` indices,
+    see ``create_trajectory_encoder_binary_dataset``. Items are
+    ``torch.from_numpy`` views of the memory map, so nothing is copied until
+    a batch is collated, and DataLoader workers share the page cache instead
+    of pickling the arrays. The 1024-d bucket embeddings are kept once in an
+    ``(8, 1024)`` table and gathered per batch in ``collate``.
+    """
+
+    def __init__(
+        self,
+        coordinates_path="datasets/trajectory_encoder_coordinates.npy",
+        labels_path="datasets/trajectory_encoder_labels.npy",
+        bucket_embeddings_path="datasets/uae_buckets_cache.json",
+    ):
+        self.coordinates_path = coordinates_path
+        self.labels_path = labels_path
 
-        with open("datasets/uae_buckets_cache.json") as cache:
-            self.direction_labels = json.load(cache)
-            directions = [item["Direction"] for item in self.items]
-            self.encoded_input_texts = torch.Tensor([self.direction_labels[direction] for direction in directions])
+        with open(bucket_embeddings_path) as cache:
+            direction_labels = json.load(cache)
+            self.bucket_embeddings = torch.Tensor(
+                [direction_labels[direction] for direction in DIRECTION_BUCKETS]
+            )
 
-        self.coordinates.to(device)
-        self.encoded_input_texts.to(device)
+        self.coordinates = None
+        self.labels = None
+        self.open()
 
+    def open(self):
+        # Copy-on-write mapping: the arrays are writable, as torch.from_numpy
+        # expects, but the files are never modified
+        self.coordinates = np.load(self.coordinates_path, mmap_mode="c")
+        labels = np.load(self.labels_path, mmap_mode="c")
+        self.labels = labels if labels.dtype == np.uint8 else labels.astype(np.uint8)
+
+    def __getstate__(self):
+        # Pickling a memory map copies its data, workers started with spawn
+        # reopen the files instead
+        state = self.__dict__.copy()
+        state["coordinates"] = None
+        state["labels"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
 
     def __len__(self):
-        return len(self.data_json)
+        return len(self.labels)
 
     def __getitem__(self, idx):
-        # item = list(self.data_json.values())[idx]
-        # coordinates = torch.Tensor(item["Coordinates"])
-        # direction = item["Direction"]
+        return torch.from_numpy(self.coordinates[idx]), int(self.labels[idx])
+
+    def collate(self, batch):
+        """Stacks the coordinates and gathers the bucket embeddings of a batch.
+
+        Pass as ``collate_fn`` to the DataLoader.
+
+        Returns:
+            tuple: ``(coordinates, embeddings)`` of shape ``(B, T, 2)`` and
+            ``(B, 1024)``.
+        """
+        coordinates = torch.stack([coordinates for coordinates, _ in batch])
+        labels = torch.tensor([label for _, label in batch], dtype=torch.long)
+        return coordinates, self.bucket_embeddings[labels]
+
+
+def create_trajectory_encoder_binary_dataset(
+    json_path="datasets/processed_vehicle_a.json",
+    coordinates_path="datasets/trajectory_encoder_coordinates.npy",
+    labels_path="datasets/trajectory_encoder_labels.npy",
+):
+    """Converts the JSON training data into the arrays of ``TrajectoryEncoderDataset``.
+
+    The coordinates are written row by row into a memory map, so next to the
+    parsed JSON only one trajectory is held in memory at a time. Any other
+    float32 ``(N, T, 2)`` array with a uint8 label column works as well, e.g.
+    ``datasets/trajectory_coordinates.npy`` of the npz corpus together with
+    ``datasets/raw_direction_labels.npy``.
+    """
+    print("Loading...")
+    with open(json_path) as file:
+        items = list(json.load(file).values())
+    num_steps = len(items[0]["Coordinates"])
+
+    coordinates = np.lib.format.open_memmap(
+        coordinates_path,
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(items), num_steps, 2),
+    )
+    labels = np.empty(len(items), dtype=np.uint8)
+    for index, item in enumerate(items):
+        coordinates[index] = item["Coordinates"]
+        labels[index] = DIRECTION_BUCKETS.index(item["Direction"])
+    coordinates.flush()
+    np.save(labels_path, labels)
+    print("Finished")
 
-        # Getting cached bucket embeddings
-        # encoded_input_text = torch.Tensor(self.direction_labels[direction])
 
-        return self.coordinates[idx], self.encoded_input_texts[idx]
+if __name__ == "__main__":
+    create_trajectory_encoder_binary_dataset()
@@ -0,0 +1,349 @@
+import os
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+from npz_utils import list_vehicle_files_absolute
+
+DISTANCES = ("euclidean", "dtw", "frechet")
+
+
+def gt_marginal_for_file(path: str) -> np.ndarray:
+    """``(80, 2)`` ego frame coordinates of an npz file, or None if unreadable."""
+    try:
+        with np.load(path) as data:
+            return data["gt_marginal"][:, :2]
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def create_trajectory_coordinate_store(
+    vehicle_list: list = None,
+    output_path: str = "datasets/trajectory_coordinates.npy",
+) -> np.ndarray:
+    """Writes the ``gt_marginal`` of every trajectory into one ``(N, 80, 2)`` array.
+
+    Rows follow ``vehicle_list``, by default the vehicle_a files in the order
+    of ``list_vehicle_files_absolute``, like the embedding store. Files that
+    cannot be read get a row of zeros and a False entry in the ``(N,)`` mask
+    saved next to the store as ``<output>_valid.npy``.
+    """
+    if vehicle_list is None:
+        vehicle_list = list_vehicle_files_absolute()
+
+    coordinates = None
+    valid = np.zeros(len(vehicle_list), dtype=bool)
+    for index in tqdm(range(len(vehicle_list))):
+        gt_marginal = gt_marginal_for_file(vehicle_list[index])
+        if gt_marginal is None:
+            continue
+        if coordinates is None:
+            # open_memmap zero-fills the rows of unreadable files
+            coordinates = np.lib.format.open_memmap(
+                output_path,
+                mode="w+",
+                dtype=np.float32,
+                shape=(len(vehicle_list), len(gt_marginal), 2),
+            )
+        coordinates[index] = gt_marginal
+        valid[index] = True
+
+    if coordinates is None:
+        raise ValueError("No trajectory could be read")
+    coordinates.flush()
+    np.save(os.path.splitext(output_path)[0] + "_valid.npy", valid)
+    if not valid.all():
+        print(f"Skipped {np.count_nonzero(~valid)} unreadable files")
+    return coordinates
+
+
+def query_coordinates(trajectory, num_steps: int = 80) -> np.ndarray:
+    """Ego frame coordinates of a ``NpzTrajectory``, a ``Trajectory`` or an array.
+
+    ``Trajectory`` coordinates are resampled to ``num_steps`` points, so they
+    can be compared with the ``gt_marginal`` of the corpus.
+    """
+    if hasattr(trajectory, "gt_marginal"):
+        return np.asarray(trajectory.gt_marginal[:, :2], dtype=np.float32)
+    if hasattr(trajectory, "rotated_coordinates"):
+        points = np.stack(
+            (
+                np.asarray(trajectory.rotated_coordinates["X"]),
+                np.asarray(trajectory.rotated_coordinates["Y"]),
+            ),
+            axis=1,
+        )
+        positions = np.linspace(0, len(points) - 1, num_steps)
+        return np.stack(
+            (
+                np.interp(positions, np.arange(len(points)), points[:, 0]),
+                np.interp(positions, np.arange(len(points)), points[:, 1]),
+            ),
+            axis=1,
+        ).astype(np.float32)
+    return np.asarray(trajectory, dtype=np.float32)
+
+
+class TrajectorySimilaritySearch:
+    """Query-by-example search over the future trajectories of the corpus.
+
+    Three distances between ``(T, 2)`` trajectories are supported:
+
+    - "euclidean": ``sqrt(sum_t |a_t - b_t|^2)``,
+    - "dtw": dynamic time warping with squared point distances (square root
+      of the cost), restricted to a Sakoe-Chiba band of ``window`` steps,
+    - "frechet": discrete Fréchet distance in the same band.
+
+    Before any exact distance is computed every trajectory gets two O(1)
+    lower bounds, from the start and end points and from the gap between
+    the bounding boxes. Candidates are visited in order of that bound, and
+    the search stops once the bound exceeds the current k-th distance or the
+    radius. Remaining candidates are checked against an LB_Keogh envelope of
+    the query, and the survivors' exact distances are computed in batches.
+    """
+
+    def __init__(
+        self,
+        coordinates: np.ndarray,
+        window: int = 8,
+        batch_size: int = 1024,
+        valid: np.ndarray = None,
+    ):
+        """
+        Args:
+            coordinates (np.ndarray): ``(N, T, 2)`` trajectories, e.g. the
+                memory-mapped output of ``create_trajectory_coordinate_store``.
+            window (int): Band of the DTW and Fréchet alignments in steps.
+            batch_size (int): Largest number of candidates bounded and compared
+                at once.
+            valid (np.ndarray): ``(N,)`` mask of the rows that may be returned.
+                The zero rows of unreadable files would otherwise match every
+                query near the origin. None for all rows.
+        """
+        self.coordinates = coordinates
+        self.valid = None if valid is None else np.asarray(valid, dtype=bool)
+        self.window = window
+        self.batch_size = batch_size
+        self.num_steps = coordinates.shape[1]
+
+        print("Computing trajectory bounds...")
+        self.starts = np.empty((len(coordinates), 2), dtype=np.float32)
+        self.ends = np.empty((len(coordinates), 2), dtype=np.float32)
+        self.boxes = np.empty((len(coordinates), 4), dtype=np.float32)
+        for start in range(0, len(coordinates), 65536):
+            chunk = np.asarray(coordinates[start : start + 65536])
+            self.starts[start : start + 65536] = chunk[:, 0]
+            self.ends[start : start + 65536] = chunk[:, -1]
+            self.boxes[start : start + 65536, :2] = chunk.min(axis=1)
+            self.boxes[start : start + 65536, 2:] = chunk.max(axis=1)
+        print("Finished")
+
+    @classmethod
+    def from_files(
+        cls, coordinates_path: str = "datasets/trajectory_coordinates.npy", **kwargs
+    ):
+        """Loads the coordinate store and, if it exists, its ``_valid.npy`` mask."""
+        valid_path = os.path.splitext(coordinates_path)[0] + "_valid.npy"
+        if "valid" not in kwargs and os.path.exists(valid_path):
+            kwargs["valid"] = np.load(valid_path)
+        return cls(np.load(coordinates_path, mmap_mode="r"), **kwargs)
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def cheap_lower_bounds(self, query: np.ndarray, distance: str) -> np.ndarray:
+        """Start/end point and bounding box lower bounds for every trajectory."""
+        start_gap = np.linalg.norm(self.starts - query[0], axis=1)
+        end_gap = np.linalg.norm(self.ends - query[-1], axis=1)
+        query_box = np.concatenate((query.min(axis=0), query.max(axis=0)))
+        # Per axis distance between the intervals, zero where they overlap
+        box_gap = np.maximum(
+            0,
+            np.maximum(
+                self.boxes[:, :2] - query_box[2:], query_box[:2] - self.boxes[:, 2:]
+            ),
+        )
+        box_gap = np.linalg.norm(box_gap, axis=1)
+
+        if distance == "frechet":
+            return np.maximum(np.maximum(start_gap, end_gap), box_gap)
+        # Every alignment matches the first and the last points and has at
+        # least T point pairs, each at least the box gap apart
+        return np.maximum(
+            np.sqrt(start_gap**2 + end_gap**2), np.sqrt(self.num_steps) * box_gap
+        )
+
+    def envelope(self, query: np.ndarray, window: int):
+        """Per-step lower and upper envelope of the query over the band."""
+        padded = np.pad(query, ((window, window), (0, 0)), mode="edge")
+        windows = np.lib.stride_tricks.sliding_window_view(
+            padded, 2 * window + 1, axis=0
+        )
+        return windows.min(axis=-1), windows.max(axis=-1)
+
+    def keogh_lower_bounds(
+        self,
+        candidates: np.ndarray,
+        lower: np.ndarray,
+        upper: np.ndarray,
+        distance: str,
+    ) -> np.ndarray:
+        """LB_Keogh: how far every candidate point lies outside the query envelope."""
+        excess = np.maximum(0, np.maximum(candidates - upper, lower - candidates))
+        point_excess = np.linalg.norm(excess, axis=-1)
+        if distance == "frechet":
+            return point_excess.max(axis=1)
+        return np.sqrt((point_excess**2).sum(axis=1))
+
+    def exact_distances(
+        self, query: np.ndarray, candidates: np.ndarray, distance: str
+    ) -> np.ndarray:
+        """Distances from the query to a ``(B, T, 2)`` batch of trajectories."""
+        if distance == "euclidean":
+            return np.sqrt(((candidates - query) ** 2).sum(axis=(1, 2)))
+
+        # Point distances of all pairs within the band, (B, T, T)
+        costs = np.linalg.norm(
+            candidates[:, None, :, :] - query[None, :, None, :], axis=-1
+        )
+        if distance == "dtw":
+            costs = costs**2
+        num_steps = len(query)
+        table = np.full((len(candidates), num_steps + 1, num_steps + 1), np.inf)
+        table[:, 0, 0] = 0
+        for i in range(1, num_steps + 1):
+            low, high = max(1, i - self.window), min(num_steps, i + self.window)
+            for j in range(low, high + 1):
+                previous = np.minimum(
+                    np.minimum(table[:, i - 1, j], table[:, i, j - 1]),
+                    table[:, i - 1, j - 1],
+                )
+                if distance == "dtw":
+                    table[:, i, j] = costs[:, i - 1, j - 1] + previous
+                else:
+                    table[:, i, j] = np.maximum(costs[:, i - 1, j - 1], previous)
+        result = table[:, num_steps, num_steps]
+        return np.sqrt(result) if distance == "dtw" else result
+
+    def search(
+        self,
+        trajectory,
+        k: int = 10,
+        radius: float = None,
+        distance: str = "euclidean",
+        exclude: np.ndarray = None,
+    ):
+        """Finds the trajectories closest to an example.
+
+        Args:
+            trajectory: ``NpzTrajectory``, ``Trajectory`` or ``(T, 2)`` array.
+            k (int): Maximum number of results. None for all within the radius.
+            radius (float): Only return trajectories within this distance.
+            distance (str): "euclidean", "dtw" or "frechet".
+            exclude (np.ndarray): Ids that are never returned, e.g. the query itself.
+
+        Returns:
+            tuple: ``(distances, ids, stats)`` sorted by ascending distance,
+            equal distances by id. ``stats`` counts how many candidates each
+            bound pruned and how many exact distances were computed.
+        """
+        if distance not in DISTANCES:
+            raise ValueError(f"Unknown distance: {distance}")
+        if k is None and radius is None:
+            raise ValueError("Either k or a radius is needed")
+        query = query_coordinates(trajectory, self.num_steps)
+        window = 0 if distance == "euclidean" else self.window
+        lower, upper = self.envelope(query, window)
+
+        bounds = self.cheap_lower_bounds(query, distance)
+        order = np.argsort(bounds, kind="stable")
+        if self.valid is not None:
+            order = order[self.valid[order]]
+        if exclude is not None:
+            order = order[~np.isin(order, exclude)]
+        stats = {
+            "candidates": len(order),
+            "pruned_cheap": 0,
+            "pruned_keogh": 0,
+            "exact": 0,
+        }
+
+        best_distances = np.empty(0)
+        best_ids = np.empty(0, dtype=np.int64)
+        threshold = np.inf if radius is None else radius
+        # Batches start at k and double, so a threshold exists early and
+        # later batches can be pruned by it
+        start = 0
+        size = self.batch_size if k is None else min(k, self.batch_size)
+        while start < len(order):
+            batch = order[start : start + size]
+            start, size = start + len(batch), min(2 * size, self.batch_size)
+            if k is not None and len(best_ids) == k:
+                threshold = min(threshold, best_distances[-1])
+            # The bounds are sorted, so once one exceeds the threshold all
+            # remaining trajectories are pruned
+            num_kept = np.searchsorted(bounds[batch], threshold, side="right")
+            last = num_kept < len(batch)
+            if last:
+                stats["pruned_cheap"] = int(len(order) - start + len(batch) - num_kept)
+            batch = batch[:num_kept]
+
+            if len(batch):
+                # Sorted ids read the memory map sequentially
+                batch = np.sort(batch)
+                candidates = np.asarray(self.coordinates[batch], dtype=np.float32)
+                if distance != "euclidean":
+                    keogh = self.keogh_lower_bounds(candidates, lower, upper, distance)
+                    keep = keogh <= threshold
+                    stats["pruned_keogh"] += int(np.count_nonzero(~keep))
+                    batch, candidates = batch[keep], candidates[keep]
+                stats["exact"] += len(batch)
+                distances = self.exact_distances(query, candidates, distance)
+
+                keep = distances <= threshold
+                best_distances = np.concatenate((best_distances, distances[keep]))
+                best_ids = np.concatenate((best_ids, batch[keep]))
+                best = np.lexsort((best_ids, best_distances))[:k]
+                best_distances, best_ids = best_distances[best], best_ids[best]
+            if last:
+                break
+        return best_distances, best_ids, stats
+
+
+def benchmark_similarity_search(
+    search: TrajectorySimilaritySearch,
+    num_queries: int = 20,
+    k: int = 10,
+    distances=DISTANCES,
+):
+    """Prints the pruning rate and latency of every distance for random corpus queries."""
+    rng = np.random.default_rng(0)
+    ids = np.arange(len(search))
+    if search.valid is not None:
+        ids = ids[search.valid]
+    query_ids = rng.choice(ids, num_queries, replace=False)
+    for distance in distances:
+        totals = {"candidates": 0, "pruned_cheap": 0, "pruned_keogh": 0, "exact": 0}
+        start = time.perf_counter()
+        for query_id in query_ids:
+            _, _, stats = search.search(
+                search.coordinates[query_id],
+                k=k,
+                distance=distance,
+                exclude=np.array([query_id]),
+            )
+            for key in totals:
+                totals[key] += stats[key]
+        elapsed = (time.perf_counter() - start) / num_queries
+        cheap = totals["pruned_cheap"] / totals["candidates"]
+        keogh = totals["pruned_keogh"] / totals["candidates"]
+        print(
+            f"{distance}: {elapsed * 1000:.1f} ms/query, "
+            f"pruned by start/end and box bounds: {cheap:.2%}, by LB_Keogh: {keogh:.2%}, "
+            f"exact distances: {totals['exact'] / num_queries:.0f}/query"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_similarity_search(TrajectorySimilaritySearch.from_files())
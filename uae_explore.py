@@ -1,4 +1,5 @@
 from angle_emb import AnglE, Prompts
+from functools import lru_cache
 import numpy as np
 
 # angle = AnglE.from_pretrained("WhereIsAI/UAE-Large-V1", pooling_strategy="cls").cuda()
@@ -79,12 +80,30 @@ def get_uae_encoding(input_text: str) -> dict:
     return output_dict
 
 
-def encode_with_uae(input_text: str) -> np.array:
+@lru_cache(maxsize=1)
+def load_uae_model():
+    """Loads the UAE model once per process and reuses it for every encoding."""
     angle = AnglE.from_pretrained(
         "WhereIsAI/UAE-Large-V1", pooling_strategy="cls"
     ).cuda()
     angle.set_prompt(prompt=Prompts.C)
+    return angle
+
+
+def encode_with_uae(input_text: str) -> np.array:
+    angle = load_uae_model()
 
     input_text_embedding = angle.encode({"text": input_text}, to_numpy=True)
 
     return input_text_embedding
+
+
+def encode_batch_with_uae(input_texts: list) -> np.array:
+    """Encodes several texts with a single forward pass of the UAE model.
+
+    Returns:
+        np.array: Embeddings of shape (len(input_texts), 1024).
+    """
+    angle = load_uae_model()
+
+    return angle.encode([{"text": text} for text in input_texts], to_numpy=True)